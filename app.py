@@ -1,20 +1,33 @@
 import os
-import json
+import time
 import uuid
 import eventlet
 import datetime
-import re
-from concurrent.futures import ThreadPoolExecutor
-from duckduckgo_search import DDGS
-import requests
-import html2text
+import atexit
+from collections import OrderedDict
+import sqlite3
 
 eventlet.monkey_patch()
 
-from flask import Flask, render_template, request
-from flask_socketio import SocketIO, emit
+from flask import Flask, render_template, request, jsonify
+from flask_socketio import SocketIO, emit, join_room, leave_room, rooms
 from flask_cors import CORS
-import ollama
+
+from storage import create_chat_store, unwrap_store, CachedChatStore, BlobChatStore
+from search_index import ChatSearchIndex
+from llm import OllamaRouter, ModelResidencyManager
+from context import (
+    build_context, build_anchored_context, anchor_id, prompt_content, estimate_tokens, estimated, MESSAGE_OVERHEAD_TOKENS,
+    SYSTEM_PROMPT_DEFAULT, SYSTEM_PROMPT_WEB, SYSTEM_PROMPT_STABLE,
+)
+from web_search import search_the_web
+from summaries import SummaryStore, RollingSummarizer, apply_summary
+from metrics import Metrics
+from scheduler import GenerationScheduler, AdmissionRejected
+from response_cache import ResponseCache, SemanticCache, cache_key
+from streaming import StreamCoalescer, flush_window_ms
+from generations import GenerationRegistry, GenerationWorkerPool, GenerationCancelled, chat_room
+from checkpoints import CheckpointStore, ResponseAccumulator
 
 app = Flask(__name__)
 CORS(app)
@@ -22,116 +35,389 @@ socketio = SocketIO(app, async_mode='eventlet')
 
 # --- Configuration ---
 OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+# Comma-separated list of Ollama instances; defaults to OLLAMA_HOST alone.
+OLLAMA_HOSTS = [h.strip() for h in os.environ.get("OLLAMA_HOSTS", OLLAMA_HOST).split(',') if h.strip()]
+OLLAMA_AFFINITY = os.environ.get("OLLAMA_AFFINITY", "1") == "1"
+OLLAMA_AFFINITY_SLACK = int(os.environ.get("OLLAMA_AFFINITY_SLACK", "2"))
+OLLAMA_EJECT_AFTER = int(os.environ.get("OLLAMA_EJECT_AFTER", "3"))
+OLLAMA_HEALTH_INTERVAL = int(os.environ.get("OLLAMA_HEALTH_INTERVAL", "10"))
 OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "gemma2:2b")
+OLLAMA_CONTEXT_TOKENS = int(os.environ.get("OLLAMA_CONTEXT_TOKENS", "4096"))
+OLLAMA_RESPONSE_TOKENS = int(os.environ.get("OLLAMA_RESPONSE_TOKENS", "1024"))
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+# Sampling overrides; unset keeps the model's defaults.
+OLLAMA_TEMPERATURE = os.environ.get("OLLAMA_TEMPERATURE")
+OLLAMA_SEED = os.environ.get("OLLAMA_SEED")
+MODEL_RESIDENCY_INTERVAL = int(os.environ.get("MODEL_RESIDENCY_INTERVAL", "60"))
+MODEL_MEMORY_BUDGET_MB = int(os.environ.get("MODEL_MEMORY_BUDGET_MB", "0"))
+COLD_START_THRESHOLD_MS = float(os.environ.get("COLD_START_THRESHOLD_MS", "500"))
+GENERATION_MAX_CONCURRENT = int(os.environ.get("GENERATION_MAX_CONCURRENT", "4"))
+GENERATION_PER_BACKEND = int(os.environ.get("GENERATION_PER_BACKEND", "2"))
+GENERATION_MAX_QUEUED_PER_USER = int(os.environ.get("GENERATION_MAX_QUEUED_PER_USER", "3"))
+GENERATION_MAX_WAIT = float(os.environ.get("GENERATION_MAX_WAIT", "120"))
+OLLAMA_MAX_CONNECTIONS = int(os.environ.get("OLLAMA_MAX_CONNECTIONS", "10"))
+OLLAMA_KEEPALIVE_EXPIRY = float(os.environ.get("OLLAMA_KEEPALIVE_EXPIRY", "300"))
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_READ_TIMEOUT = float(os.environ.get("OLLAMA_READ_TIMEOUT", "300"))
+OLLAMA_PROBE_TIMEOUT = float(os.environ.get("OLLAMA_PROBE_TIMEOUT", "3"))
+# Streamed tokens are sent in frames at most this far apart (the window
+# grows with client RTT up to the max) or once this many bytes are waiting.
+STREAM_FLUSH_MIN_MS = float(os.environ.get("STREAM_FLUSH_MIN_MS", "30"))
+STREAM_FLUSH_MAX_MS = float(os.environ.get("STREAM_FLUSH_MAX_MS", "150"))
+STREAM_FLUSH_BYTES = int(os.environ.get("STREAM_FLUSH_BYTES", "512"))
+# Workers bound the replies being prepared and streamed at once, independent
+# of how many sockets are connected; GENERATION_MAX_CONCURRENT still caps
+# what reaches Ollama.
+GENERATION_WORKERS = int(os.environ.get("GENERATION_WORKERS", "16"))
+# How much of each answer is kept for clients that reconnect mid-stream, and
+# how long a queued request waits for its disconnected client to come back.
+GENERATION_REPLAY_CHARS = int(os.environ.get("GENERATION_REPLAY_CHARS", "262144"))
+GENERATION_RESUME_GRACE = float(os.environ.get("GENERATION_RESUME_GRACE", "30"))
+# Partial replies are checkpointed every this many chunks or seconds.
+CHECKPOINT_DB_PATH = os.environ.get("CHECKPOINT_DB_PATH", "checkpoints.db")
+CHECKPOINT_EVERY_TOKENS = int(os.environ.get("CHECKPOINT_EVERY_TOKENS", "64"))
+CHECKPOINT_EVERY_SECONDS = float(os.environ.get("CHECKPOINT_EVERY_SECONDS", "5"))
 CHAT_SESSIONS_DIR = 'chat_sessions'
-SYSTEM_PROMPT_DEFAULT = "You are TheroGPT, a helpful AI assistant. You do NOT have access to the internet or live search results."
-SYSTEM_PROMPT_WEB = "You are TheroGPT, a helpful AI assistant. You have been provided with a series of web search results. Please use them to answer the user's query."
-
-stop_generating = {}
+CHAT_LOG_COMPACT_MIN_DEAD = int(os.environ.get("CHAT_LOG_COMPACT_MIN_DEAD", "50"))
+CHAT_LOG_COMPACT_RATIO = float(os.environ.get("CHAT_LOG_COMPACT_RATIO", "0.5"))
+CHAT_STORAGE_BACKEND = os.environ.get("CHAT_STORAGE_BACKEND", "file")
+CHAT_DB_PATH = os.environ.get("CHAT_DB_PATH", "therogpt.db")
+CHAT_DB_POOL_SIZE = int(os.environ.get("CHAT_DB_POOL_SIZE", "4"))
+CHAT_LIST_PAGE_SIZE = int(os.environ.get("CHAT_LIST_PAGE_SIZE", "50"))
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "50"))
+STORAGE_MAINTENANCE_INTERVAL = int(os.environ.get("STORAGE_MAINTENANCE_INTERVAL", "3600"))
+CHAT_ARCHIVE_AFTER_DAYS = float(os.environ.get("CHAT_ARCHIVE_AFTER_DAYS", "30"))
+CHAT_BLOB_MIN_BYTES = int(os.environ.get("CHAT_BLOB_MIN_BYTES", "0"))
+CHAT_BLOB_CACHE_BYTES = int(os.environ.get("CHAT_BLOB_CACHE_BYTES", str(16 * 1024 * 1024)))
+SUMMARY_DB_PATH = os.environ.get("SUMMARY_DB_PATH", "summaries.db")
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", OLLAMA_MODEL)
+SUMMARY_TRIGGER_TOKENS = int(os.environ.get("SUMMARY_TRIGGER_TOKENS", "2048"))
+SUMMARY_KEEP_RECENT_TOKENS = int(os.environ.get("SUMMARY_KEEP_RECENT_TOKENS", "1024"))
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", "400"))
+# Models kept loaded, in priority order for MODEL_MEMORY_BUDGET_MB.
+OLLAMA_WARM_MODELS = [
+    m.strip() for m in os.environ.get(
+        "OLLAMA_WARM_MODELS", OLLAMA_MODEL if SUMMARY_TRIGGER_TOKENS <= 0 else f"{OLLAMA_MODEL},{SUMMARY_MODEL}"
+    ).split(',') if m.strip()
+]
+# "deterministic" caches answers only when OLLAMA_TEMPERATURE=0 or OLLAMA_SEED
+# is set, "always" caches sampled answers too, "off" disables the cache.
+RESPONSE_CACHE_MODE = os.environ.get("RESPONSE_CACHE_MODE", "deterministic")
+RESPONSE_CACHE_DB_PATH = os.environ.get("RESPONSE_CACHE_DB_PATH", "response_cache.db")
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+# Reuses answers to paraphrased standalone questions; needs NumPy and an
+# embedding model pulled into Ollama.
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "0") == "1"
+SEMANTIC_CACHE_MODEL = os.environ.get("SEMANTIC_CACHE_MODEL", "nomic-embed-text")
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+# Answers are only reused for the user who got them unless this is set, since
+# a paraphrase match can hand one user's reply to a different question.
+SEMANTIC_CACHE_SHARED = os.environ.get("SEMANTIC_CACHE_SHARED", "0") == "1"
+SEARCH_INDEX_PATH = os.environ.get("SEARCH_INDEX_PATH", "search_index.db")
+SEARCH_RESULTS_LIMIT = int(os.environ.get("SEARCH_RESULTS_LIMIT", "20"))
+HISTORY_CACHE_ENTRIES = int(os.environ.get("HISTORY_CACHE_ENTRIES", "256"))
+HISTORY_CACHE_MAX_BYTES = int(os.environ.get("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# "stable" keeps the prompt prefix byte-identical between turns so Ollama can
+# reuse its KV cache; "legacy" is the original toggle-dependent layout.
+PROMPT_LAYOUT = os.environ.get("PROMPT_LAYOUT", "stable")
+PROMPT_REANCHOR_RATIO = float(os.environ.get("PROMPT_REANCHOR_RATIO", "0.5"))
+PROMPT_ANCHOR_ENTRIES = 4096
+
+CHAT_OPTIONS = {'num_ctx': OLLAMA_CONTEXT_TOKENS}
+if OLLAMA_TEMPERATURE is not None:
+    CHAT_OPTIONS['temperature'] = float(OLLAMA_TEMPERATURE)
+if OLLAMA_SEED is not None:
+    CHAT_OPTIONS['seed'] = int(OLLAMA_SEED)
+
+maintenance_report = {}
+prompt_anchors = OrderedDict()
+metrics = Metrics()
+generations = GenerationRegistry(metrics, replay_chars=GENERATION_REPLAY_CHARS)
+generation_pool = GenerationWorkerPool(
+    lambda job: run_generation(job),
+    workers=GENERATION_WORKERS,
+    spawn=socketio.start_background_task,
+)
+
+chat_store = create_chat_store(
+    CHAT_STORAGE_BACKEND,
+    CHAT_SESSIONS_DIR,
+    CHAT_DB_PATH,
+    compact_min_dead=CHAT_LOG_COMPACT_MIN_DEAD,
+    compact_ratio=CHAT_LOG_COMPACT_RATIO,
+    pool_size=CHAT_DB_POOL_SIZE,
+    cache_entries=HISTORY_CACHE_ENTRIES,
+    cache_bytes=HISTORY_CACHE_MAX_BYTES,
+    blob_min_bytes=CHAT_BLOB_MIN_BYTES,
+    blob_cache_bytes=CHAT_BLOB_CACHE_BYTES,
+)
+if hasattr(chat_store, 'flush'):
+    atexit.register(chat_store.flush)
+history_cache = unwrap_store(chat_store, CachedChatStore)
+search_index = ChatSearchIndex(SEARCH_INDEX_PATH)
+checkpoint_store = CheckpointStore(CHECKPOINT_DB_PATH)
+ollama_router = OllamaRouter(
+    OLLAMA_HOSTS,
+    affinity=OLLAMA_AFFINITY,
+    affinity_slack=OLLAMA_AFFINITY_SLACK,
+    eject_after=OLLAMA_EJECT_AFTER,
+    probe_interval=OLLAMA_HEALTH_INTERVAL,
+    per_backend_limit=GENERATION_PER_BACKEND,
+    max_connections=OLLAMA_MAX_CONNECTIONS,
+    keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY,
+    connect_timeout=OLLAMA_CONNECT_TIMEOUT,
+    read_timeout=OLLAMA_READ_TIMEOUT,
+    probe_timeout=OLLAMA_PROBE_TIMEOUT,
+)
+atexit.register(ollama_router.close)
+scheduler = GenerationScheduler(
+    max_concurrent=GENERATION_MAX_CONCURRENT,
+    per_backend=GENERATION_PER_BACKEND,
+    healthy_backends=ollama_router.healthy_count,
+    max_queued_per_user=GENERATION_MAX_QUEUED_PER_USER,
+    max_wait=GENERATION_MAX_WAIT,
+    metrics=metrics,
+)
+summarizer = None
+if SUMMARY_TRIGGER_TOKENS > 0:
+    summarizer = RollingSummarizer(
+        chat_store,
+        SummaryStore(SUMMARY_DB_PATH),
+        ollama_router.client,
+        SUMMARY_MODEL,
+        trigger_tokens=SUMMARY_TRIGGER_TOKENS,
+        keep_recent_tokens=SUMMARY_KEEP_RECENT_TOKENS,
+        max_summary_tokens=SUMMARY_MAX_TOKENS,
+        busy=lambda: generations.active() > 0,
+        options={'num_ctx': OLLAMA_CONTEXT_TOKENS},
+        keep_alive=OLLAMA_KEEP_ALIVE,
+        scheduler=scheduler,
+    )
+response_cache = ResponseCache(
+    RESPONSE_CACHE_DB_PATH,
+    mode=RESPONSE_CACHE_MODE,
+    ttl=RESPONSE_CACHE_TTL,
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+)
+semantic_cache = None
+if SEMANTIC_CACHE_ENABLED:
+    semantic_cache = SemanticCache(
+        ollama_router.client,
+        SEMANTIC_CACHE_MODEL,
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        ttl=RESPONSE_CACHE_TTL,
+        max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+        metrics=metrics,
+    )
+model_residency = ModelResidencyManager(
+    ollama_router,
+    OLLAMA_WARM_MODELS,
+    keep_alive=OLLAMA_KEEP_ALIVE,
+    check_interval=MODEL_RESIDENCY_INTERVAL,
+    memory_budget_bytes=MODEL_MEMORY_BUDGET_MB * 1024 * 1024,
+    options={'num_ctx': OLLAMA_CONTEXT_TOKENS},
+)
 
 # --- Helper Functions ---
 
-def get_chat_filepath(user_id, chat_id):
-    user_dir = os.path.join(CHAT_SESSIONS_DIR, user_id)
-    return os.path.join(user_dir, f"{chat_id}.json")
+def strip_system_prompt(history):
+    # The system prompt depends on the per-message web toggle, so it is
+    # injected on load and never persisted.
+    if history and history[0].get('role') == 'system':
+        return history[1:]
+    return list(history)
 
-def fetch_and_parse(url):
+def load_chat_history(user_id, chat_id, use_internet=False):
+    if PROMPT_LAYOUT == 'stable':
+        system_prompt = SYSTEM_PROMPT_STABLE
+    else:
+        system_prompt = SYSTEM_PROMPT_WEB if use_internet else SYSTEM_PROMPT_DEFAULT
     try:
-        print(f"Fetching content from: {url}")
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        response = requests.get(url, timeout=10, headers=headers)
-        response.raise_for_status()
-
-        content_type = response.headers.get('Content-Type', '')
-        if 'text/html' not in content_type:
-            print(f"Skipping non-HTML content at {url}")
-            return None
-
-        html = response.text
-
-        if len(html) > 2_000_000:
-            html = html[:2_000_000]
-
-        text_maker = html2text.HTML2Text()
-        text_maker.ignore_links = False
-        text_maker.ignore_images = True
-        text_maker.ignore_emphasis = False
-        text_maker.body_width = 0
-
-        text = text_maker.handle(html)
-        text = re.sub(r'\s+', ' ', text).strip()
+        history = chat_store.load_messages(user_id, chat_id)
+    except (IOError, sqlite3.Error) as e:
+        print(f"Error loading chat history for {chat_id}: {e}")
+        history = []
+    return [{'role': 'system', 'content': system_prompt}] + history
 
-        return text
+def save_chat_history(user_id, chat_id, history):
+    messages = strip_system_prompt(history)
+    try:
+        chat_store.save_messages(user_id, chat_id, messages)
+    except (IOError, sqlite3.Error) as e:
+        print(f"Error saving chat history for {chat_id}: {e}")
+        return False
+    try:
+        search_index.index_chat(user_id, chat_id, messages)
+    except sqlite3.Error as e:
+        print(f"Error indexing chat {chat_id}: {e}")
+    return True
+
+def persisted_messages(history):
+    # Legacy-layout web results are injected per turn and never stored.
+    return [msg for msg in history if not (msg['role'] == 'system' and msg.get('content', '').startswith('Web search results'))]
+
+def client_messages(messages):
+    # Token counts, blob previews and web results are for building prompts.
+    return [
+        dict({'id': msg['id'], 'role': msg['role'], 'content': msg['content']}, **({'interrupted': True} if msg.get('interrupted') else {}))
+        for msg in messages
+    ]
 
-    except requests.exceptions.RequestException as e:
-        print(f"Request failed for {url}: {e}")
+def assemble_prompt(user_id, chat_id, history):
+    budget = OLLAMA_CONTEXT_TOKENS - OLLAMA_RESPONSE_TOKENS
+    if PROMPT_LAYOUT != 'stable':
+        prompt_history = summarizer.apply(user_id, chat_id, history) if summarizer else history
+        return build_context(prompt_history, budget)
+    # Keep sending the same summary and window start for as long as they fit,
+    # so each turn only appends to the prompt of the previous one.
+    key = (user_id, chat_id)
+    anchor = prompt_anchors.get(key)
+    if anchor:
+        prompt_anchors.move_to_end(key)
+        result = build_anchored_context(apply_summary(history, anchor['summary']), budget, anchor['start_id'])
+        if result:
+            return result
+    summary = summarizer.current(user_id, chat_id) if summarizer else None
+    prompt_history = apply_summary(history, summary)
+    result = build_anchored_context(prompt_history, budget, 0)
+    if result is None:
+        # Over budget: restart the window with room to grow before the next
+        # re-anchor.
+        result = build_context(prompt_history, int(budget * PROMPT_REANCHOR_RATIO))
+    context, used, dropped = result
+    prompt_anchors[key] = {'summary': summary, 'start_id': anchor_id(prompt_history, context)}
+    while len(prompt_anchors) > PROMPT_ANCHOR_ENTRIES:
+        prompt_anchors.popitem(last=False)
+    return context, used, dropped
+
+def cached_response(key):
+    if key is None:
         return None
-    except Exception as e:
-        print(f"An unexpected error occurred processing {url}: {e}")
+    try:
+        return response_cache.get(key)
+    except sqlite3.Error as e:
+        print(f"Error reading response cache: {e}")
         return None
 
-def search_the_web(query):
-    print(f"Performing web search for: {query}")
+def cache_response(key, content, tokens):
     try:
-        with DDGS() as ddgs:
-            results = list(ddgs.text(query, max_results=5))
-
-        if not results:
-            return "No search results found."
-
-        urls_to_fetch = [r['href'] for r in results[:3] if 'href' in r]
-        
-        fetched_contents = []
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            fetched_contents = list(executor.map(fetch_and_parse, urls_to_fetch))
-
-        context_parts = []
-        for i, content in enumerate(fetched_contents):
-            if content:
-                result_meta = results[i]
-                context_parts.append(
-                    f"Source [{i+1}]: {result_meta.get('title', 'N/A')}\n"
-                    f"URL: {result_meta.get('href', 'N/A')}\n"
-                    f"CONTENT:\n{content[:2500]}\n"
-                )
-
-        if not context_parts:
-            return "Could not retrieve content from any search results. Please try a different query."
-            
-        return "\n---\n".join(context_parts)
-
-    except Exception as e:
-        print(f"An error occurred in the main search function: {e}")
-        return "Sorry, an error occurred during the web search."
-
-def load_chat_history(user_id, chat_id, use_internet=False):
-    filepath = get_chat_filepath(user_id, chat_id)
-    system_prompt = SYSTEM_PROMPT_WEB if use_internet else SYSTEM_PROMPT_DEFAULT
-    if not os.path.exists(filepath):
-        return [{'role': 'system', 'content': system_prompt}]
+        response_cache.put(key, OLLAMA_MODEL, content, tokens)
+    except sqlite3.Error as e:
+        print(f"Error writing response cache: {e}")
+
+def standalone_question(history, messages):
+    # Only a first question with nothing but the system prompt before it and
+    # no web results has an answer that does not depend on anything else.
+    return len(messages) == 2 and messages[0]['role'] == 'system' and not history[-1].get('web_results')
+
+def record_prompt_eval(chat_id, chunk, follow_up):
+    count, duration = chunk.get('prompt_eval_count'), chunk.get('prompt_eval_duration')
+    if count is None:
+        return
+    kind = 'follow_up' if follow_up else 'first_turn'
+    metrics.record(f"prompt.{PROMPT_LAYOUT}.{kind}.eval_count", count)
+    if duration is not None:
+        metrics.record(f"prompt.{PROMPT_LAYOUT}.{kind}.eval_ms", duration / 1e6)
+    print(f"Prompt eval for {chat_id}: {count} tokens in {(duration or 0) / 1e6:.0f} ms ({PROMPT_LAYOUT}, {kind})")
+
+def record_model_load(chat_id, chunk):
+    load_ms = (chunk.get('load_duration') or 0) / 1e6
+    if load_ms >= COLD_START_THRESHOLD_MS:
+        metrics.record('model.cold_start_load_ms', load_ms)
+        print(f"Cold start: {OLLAMA_MODEL} took {load_ms:.0f} ms to load for chat {chat_id}")
+
+def record_stream(chat_id, coalescer, window_ms):
+    if not coalescer.chunks:
+        return
+    metrics.record('generation.chunks_per_frame', coalescer.chunks / max(1, coalescer.frames))
+    metrics.record('generation.flush_window_ms', window_ms)
+    rate = coalescer.frames_per_sec()
+    if rate is not None:
+        metrics.record('generation.frames_per_sec', rate)
+    print(f"Streamed {coalescer.chunks} chunks for {chat_id} in {coalescer.frames} frames ({window_ms:.0f} ms window)")
+
+def publish_frame(generation, content, first):
+    offset = generation.append(content)
+    socketio.emit('response', {
+        'content': content, 'first_chunk': first, 'chatId': generation.chat_id,
+        'generationId': generation.id, 'offset': offset,
+    }, to=generation.room)
+
+def subscribe_chat(user_id, chat_id):
+    # A socket follows the chat it has open; replies stream to the chat's room.
+    room = chat_room(user_id, chat_id)
+    for other in rooms():
+        if other.startswith('chat:') and other != room:
+            leave_room(other)
+    join_room(room)
+
+def drop_abandoned_generations(sid):
+    # A flaky connection usually comes back within seconds and resumes;
+    # requests still queued for a socket that did not are dropped.
+    socketio.sleep(GENERATION_RESUME_GRACE)
+    generations.cancel_sid(sid, queued_only=True)
+
+def save_checkpoint(generation, after_id, content):
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            content = f.read()
-            history = json.loads(content) if content else []
-            if not history or history[0].get('role') != 'system':
-                history.insert(0, {'role': 'system', 'content': system_prompt})
-            else:
-                history[0]['content'] = system_prompt
-            return history
-    except (json.JSONDecodeError, IOError) as e:
-        print(f"Error loading chat history for {chat_id}: {e}")
-        return [{'role': 'system', 'content': system_prompt}]
-
-def save_chat_history(user_id, chat_id, history):
-    filepath = get_chat_filepath(user_id, chat_id)
+        checkpoint_store.save(generation.id, generation.user_id, generation.chat_id, after_id, content)
+    except sqlite3.Error as e:
+        print(f"Error checkpointing generation {generation.id}: {e}")
+
+def remove_checkpoint_when_saved(user_id, chat_id, generation_id):
+    # With write-behind the reply may not be on disk yet; until it is, the
+    # checkpoint is what a crash would recover it from.
+    chat_store.after_persisted(user_id, chat_id, lambda: checkpoint_store.remove(generation_id))
+
+def recover_interrupted_generations():
+    # Checkpoints left behind by a crash or restart become partial replies
+    # marked as interrupted, which the user can ask to continue.
+    recovered = 0
+    for checkpoint in checkpoint_store.pending():
+        user_id, chat_id = checkpoint['user_id'], checkpoint['chat_id']
+        try:
+            messages = chat_store.load_messages(user_id, chat_id)
+            if checkpoint['content'] and messages and messages[-1]['id'] == checkpoint['after_id']:
+                messages.append(estimated({'role': 'assistant', 'content': checkpoint['content'], 'interrupted': True}))
+                if not save_chat_history(user_id, chat_id, messages):
+                    continue
+                recovered += 1
+        except (IOError, sqlite3.Error) as e:
+            print(f"Error recovering generation {checkpoint['generation_id']}: {e}")
+            continue
+        remove_checkpoint_when_saved(user_id, chat_id, checkpoint['generation_id'])
+    if recovered:
+        print(f"Recovered {recovered} interrupted replies")
+
+def backfill_search_index():
+    # Chats imported or migrated while the server was down were stored
+    # without being indexed.
     try:
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(history, f, indent=4, ensure_ascii=False)
-    except IOError as e:
-        print(f"Error saving chat history for {chat_id}: {e}")
+        chats, messages = search_index.backfill(chat_store)
+    except (IOError, sqlite3.Error) as e:
+        print(f"Error backfilling search index: {e}")
+        return
+    if chats:
+        print(f"Indexed {messages} messages from {chats} chats for search")
+
+def run_storage_maintenance():
+    # Archives inactive chats, compacts logs and purges dead data off the
+    # request path, then sleeps until the next pass.
+    while True:
+        socketio.sleep(STORAGE_MAINTENANCE_INTERVAL)
+        started = datetime.datetime.now()
+        try:
+            report = chat_store.run_maintenance(CHAT_ARCHIVE_AFTER_DAYS * 86400)
+        except Exception as e:
+            print(f"!!! ERROR during storage maintenance: {e}")
+            continue
+        report['finished_at'] = datetime.datetime.now().isoformat()
+        report['duration_seconds'] = (datetime.datetime.now() - started).total_seconds()
+        maintenance_report.clear()
+        maintenance_report.update(report)
+        print(f"Storage maintenance: archived {report['archived']}, compacted {report['compacted']}, "
+              f"purged {report['purged']}, reclaimed {report['reclaimed']} bytes")
 
 # --- Socket.IO Event Handlers ---
 
@@ -139,6 +425,24 @@ def save_chat_history(user_id, chat_id, history):
 def index():
     return render_template('index.html')
 
+@app.route('/stats')
+def stats():
+    return jsonify({
+        'history_cache': history_cache.stats() if history_cache else None,
+        'message_blobs': unwrap_store(chat_store, BlobChatStore).stats(),
+        'storage_maintenance': maintenance_report or None,
+        'search_index': search_index.stats(),
+        'ollama': ollama_router.stats(),
+        'scheduler': scheduler.stats(),
+        'generations': dict(generations.stats(), checkpoints_pending=checkpoint_store.count(), workers=generation_pool.stats()),
+        'response_cache': response_cache.stats(),
+        'semantic_cache': semantic_cache.stats() if semantic_cache else None,
+        'summaries': summarizer.stats() if summarizer else None,
+        'prompt_eval': metrics.snapshot('prompt.'),
+        'generation': metrics.snapshot('generation.'),
+        'model_residency': dict(model_residency.stats(), cold_starts=metrics.snapshot('model.')),
+    })
+
 @socketio.on('connect')
 def handle_connect():
     print(f"Client connected: {request.sid}")
@@ -146,65 +450,144 @@ def handle_connect():
 @socketio.on('disconnect')
 def handle_disconnect():
     print(f"Client disconnected: {request.sid}")
-    if request.sid in stop_generating:
-        del stop_generating[request.sid]
+    # Replies keep streaming into their rooms and are saved either way.
+    socketio.start_background_task(drop_abandoned_generations, request.sid)
 
 @socketio.on('get_chats')
 def handle_get_chats(data):
     user_id = data.get('userId')
     if not user_id: return
-
-    user_dir = os.path.join(CHAT_SESSIONS_DIR, user_id)
-    if not os.path.exists(user_dir):
-        emit('chat_list', {'chats': []}, to=request.sid)
-        return
-
-    chat_files = [f for f in os.listdir(user_dir) if f.endswith('.json')]
-    chats = []
-    for filename in sorted(chat_files, key=lambda f: os.path.getmtime(os.path.join(user_dir, f)), reverse=True):
-        chat_id = os.path.splitext(filename)[0]
-        history = load_chat_history(user_id, chat_id)
-        title = next((msg['content'] for msg in history if msg['role'] == 'user'), 'New Chat')
-        chats.append({'id': chat_id, 'title': title[:50]})
-    emit('chat_list', {'chats': chats}, to=request.sid)
+    limit = min(int(data.get('limit') or CHAT_LIST_PAGE_SIZE), CHAT_LIST_PAGE_SIZE)
+    cursor = data.get('cursor')
+    chats, next_cursor = chat_store.list_chats(user_id, limit=limit, cursor=cursor)
+    emit('chat_list', {
+        'chats': [{'id': c['id'], 'title': c['title'], 'updated': c['updated'], 'count': c['count']} for c in chats],
+        'nextCursor': next_cursor,
+        'append': bool(cursor),
+    }, to=request.sid)
 
 @socketio.on('get_history')
 def handle_get_history(data):
     user_id, chat_id = data.get('userId'), data.get('chatId')
-    history = load_chat_history(user_id, chat_id)
-    display_history = [msg for msg in history if msg['role'] != 'system']
-    emit('chat_history', {'chatId': chat_id, 'history': display_history}, to=request.sid)
+    before = data.get('before')
+    limit = min(int(data.get('limit') or HISTORY_PAGE_SIZE), HISTORY_PAGE_SIZE)
+    if before is None:
+        subscribe_chat(user_id, chat_id)
+    try:
+        page, has_more = chat_store.load_page(user_id, chat_id, limit, before=before)
+    except (IOError, sqlite3.Error) as e:
+        print(f"Error loading chat history for {chat_id}: {e}")
+        page, has_more = [], False
+    display_history = client_messages(msg for msg in page if msg['role'] != 'system')
+    emit('chat_history', {
+        'chatId': chat_id,
+        'history': display_history,
+        'hasMore': has_more,
+        'prepend': before is not None,
+        **(chat_store.chat_version(user_id, chat_id) or {}),
+    }, to=request.sid)
+
+@socketio.on('sync_history')
+def handle_sync_history(data):
+    # Clients send the (epoch, version) of the history they have cached and
+    # receive only what changed since: nothing, the newer messages, a fresh
+    # first page if the chat was rewritten, or a tombstone if it is gone.
+    user_id, chat_id = data.get('userId'), data.get('chatId')
+    client_epoch, client_version = data.get('epoch'), data.get('version')
+    subscribe_chat(user_id, chat_id)
+    try:
+        info = chat_store.chat_version(user_id, chat_id)
+        if info is None:
+            emit('chat_sync', {'chatId': chat_id, 'mode': 'deleted'}, to=request.sid)
+            return
+        if client_epoch == info['epoch'] and client_version == info['version']:
+            emit('chat_sync', {'chatId': chat_id, 'mode': 'current', **info}, to=request.sid)
+            return
+        if client_epoch == info['epoch'] and client_version is not None and client_version < info['version']:
+            messages = chat_store.load_since(user_id, chat_id, client_version)
+            if len(messages) <= HISTORY_PAGE_SIZE:
+                emit('chat_sync', {'chatId': chat_id, 'mode': 'delta', 'history': client_messages(messages), **info}, to=request.sid)
+                return
+        page, has_more = chat_store.load_page(user_id, chat_id, HISTORY_PAGE_SIZE)
+    except (IOError, sqlite3.Error) as e:
+        print(f"Error syncing chat history for {chat_id}: {e}")
+        return
+    emit('chat_sync', {'chatId': chat_id, 'mode': 'reset', 'history': client_messages(page), 'hasMore': has_more, **info}, to=request.sid)
 
 @socketio.on('new_chat')
 def handle_new_chat(data):
     user_id = data.get('userId')
     if not user_id: return
     chat_id = str(uuid.uuid4())
-    save_chat_history(user_id, chat_id, [])
+    chat_store.create_chat(user_id, chat_id)
     emit('chat_created', {'id': chat_id, 'title': 'New Chat'}, to=request.sid)
 
 @socketio.on('delete_chat')
 def handle_delete_chat(data):
     user_id, chat_id = data.get('userId'), data.get('chatId')
-    filepath = get_chat_filepath(user_id, chat_id)
-    if os.path.exists(filepath):
-        os.remove(filepath)
+    chat_store.delete_chat(user_id, chat_id)
+    search_index.remove_chat(user_id, chat_id)
+    if summarizer:
+        summarizer.summaries.remove(user_id, chat_id)
+    prompt_anchors.pop((user_id, chat_id), None)
     emit('chat_deleted', {'chatId': chat_id}, to=request.sid)
 
+@socketio.on('search_chats')
+def handle_search_chats(data):
+    user_id, query = data.get('userId'), (data.get('query') or '').strip()
+    if not user_id: return
+    started = datetime.datetime.now()
+    try:
+        results = search_index.search(user_id, query, limit=SEARCH_RESULTS_LIMIT) if query else []
+    except sqlite3.Error as e:
+        print(f"Error searching chats for {user_id}: {e}")
+        results = []
+    elapsed_ms = (datetime.datetime.now() - started).total_seconds() * 1000
+    emit('search_results', {'query': query, 'results': results, 'elapsedMs': round(elapsed_ms, 2)}, to=request.sid)
+
+@socketio.on('latency_probe')
+def handle_latency_probe(data=None):
+    # Acknowledged right away; the client times the round trip and sends it
+    # with its messages.
+    return {'ok': True}
+
+@socketio.on('resume_generation')
+def handle_resume_generation(data):
+    user_id, chat_id, generation_id = data.get('userId'), data.get('chatId'), data.get('generationId')
+    offset = int(data.get('offset') or 0)
+    generation, missed = generations.resume(generation_id, user_id, request.sid, offset)
+    if generation is None:
+        # Already finished, so the answer is in the saved history.
+        emit('response_end', {'chatId': chat_id, 'generationId': generation_id, 'status': 'completed'}, to=request.sid)
+        return
+    print(f"Resuming generation {generation_id} for {request.sid} at offset {offset} ({len(missed or '')} chars missed)")
+    # Nothing yields between the replay and joining the room, so no frame
+    # can fall in between.
+    if missed:
+        emit('response', {
+            'content': missed, 'first_chunk': offset == 0, 'chatId': generation.chat_id,
+            'generationId': generation.id, 'offset': offset,
+        }, to=request.sid)
+    elif missed is None:
+        print(f"Generation {generation_id} no longer buffers offset {offset}; the client gets it on sync")
+    subscribe_chat(generation.user_id, generation.chat_id)
+
 @socketio.on('stop_generation')
-def handle_stop_generation(data):
-    stop_generating[request.sid] = True
-    print(f"Stop request received for SID: {request.sid}")
+def handle_stop_generation(data=None):
+    generation_id = (data or {}).get('generationId')
+    print(f"Stop request received for SID: {request.sid} (generation {generation_id})")
+    if generation_id:
+        generations.cancel(generation_id, data.get('userId'))
+    else:
+        generations.cancel_sid(request.sid)
 
 @socketio.on('message')
 def handle_message(data):
     user_id = data.get('userId')
     chat_id = data.get('chatId')
-    user_message = data.get('message')
+    user_message = data.get('message') or ''
     use_internet = data.get('useInternet', False)
-
-    history = load_chat_history(user_id, chat_id, use_internet)
-    is_first_user_message = not any(msg['role'] == 'user' for msg in history)
+    continuing = bool(data.get('continue'))
     
     time_query_triggers = [
         'what time is it', 'what is the time', "what's the time"
@@ -215,7 +598,7 @@ def handle_message(data):
     ]
     normalized_message = user_message.lower().strip().rstrip('?').strip()
 
-    if use_internet and (normalized_message in time_query_triggers or normalized_message in date_query_triggers):
+    if use_internet and not continuing and (normalized_message in time_query_triggers or normalized_message in date_query_triggers):
         now = datetime.datetime.now()
         date_str = now.strftime("%A, %B %d, %Y")
         time_str = now.strftime("%I:%M %p")
@@ -225,58 +608,217 @@ def handle_message(data):
         else:
             ai_response_content = f"Today is {date_str}."
         
-        history.append({'role': 'user', 'content': user_message})
-        history.append({'role': 'assistant', 'content': ai_response_content})
+        history = load_chat_history(user_id, chat_id, use_internet)
+        history.append(estimated({'role': 'user', 'content': user_message}))
+        history.append(estimated({'role': 'assistant', 'content': ai_response_content}))
         save_chat_history(user_id, chat_id, history)
         
         emit('response', {'content': ai_response_content, 'first_chunk': True, 'chatId': chat_id}, to=request.sid)
         emit('response_end', {'chatId': chat_id, 'status': 'completed'}, to=request.sid)
         return
 
-    if use_internet:
-        search_results = search_the_web(user_message)
-        history.append({'role': 'system', 'content': f"Web search results:\n{search_results}"})
-
-    history.append({'role': 'user', 'content': user_message})
-    
-    if is_first_user_message:
-        emit('chat_title_updated', {'chatId': chat_id, 'title': user_message[:50]})
-
+    # The reply is produced by a worker; this socket (and any other viewing
+    # the chat) follows it through the chat's room.
+    generation = generations.start(user_id, chat_id, request.sid, data.get('generationId'))
+    subscribe_chat(user_id, chat_id)
+    emit('generation_started', {'chatId': chat_id, 'generationId': generation.id}, to=request.sid)
+    # The request takes its place in the scheduler's queue now, so its wait
+    # is ordered fairly, reported and bounded from the moment it is sent.
+    room = generation.room
     try:
-        stop_generating[request.sid] = False
-        client = ollama.Client(host=OLLAMA_HOST)
-        stream = client.chat(model=OLLAMA_MODEL, messages=history, stream=True)
+        ticket = scheduler.enqueue(
+            user_id, data.get('priority', 'interactive'),
+            on_position=lambda position, total: socketio.emit(
+                'queue_position', {'chatId': chat_id, 'generationId': generation.id, 'position': position, 'queued': total}, to=room,
+            ),
+        )
+    except AdmissionRejected as e:
+        generations.finish(generation)
+        emit('response_error', {'chatId': chat_id, 'generationId': generation.id, 'error': str(e)}, to=room)
+        emit('response_end', {'chatId': chat_id, 'generationId': generation.id, 'status': 'completed'}, to=room)
+        return
+    generation_pool.submit({
+        'generation': generation,
+        'ticket': ticket,
+        'message': user_message,
+        'use_internet': use_internet,
+        'continue': continuing,
+        'rtt_ms': data.get('rttMs'),
+        'priority': data.get('priority', 'interactive'),
+    })
+
+def run_generation(job):
+    generation = job['generation']
+    user_id, chat_id = generation.user_id, generation.chat_id
+    user_message, use_internet, continuing = job['message'], job['use_internet'], job['continue']
+    room = generation.room
+
+    ticket = job['ticket']
+    accumulator = None
+    saved = False
+    try:
+        if generation.cancelled:
+            return
+        history = load_chat_history(user_id, chat_id, use_internet)
+        is_first_user_message = not any(msg['role'] == 'user' for msg in history)
+        prefill = ''
+        if continuing:
+            # Carry on from a reply cut short by a restart instead of starting
+            # over. The interrupted reply stays stored until this generation
+            # is admitted, so giving up before that leaves it as it was.
+            if not history or not history[-1].get('interrupted'):
+                return
+            prefill = history.pop()['content']
+            user_message = next((msg['content'] for msg in reversed(history) if msg['role'] == 'user'), '')
+        elif use_internet and PROMPT_LAYOUT == 'stable':
+            history.append(estimated({'role': 'user', 'content': user_message, 'web_results': search_the_web(user_message)}))
+        elif use_internet:
+            search_results = search_the_web(user_message)
+            history.append(estimated({'role': 'system', 'content': f"Web search results:\n{search_results}"}))
+            history.append(estimated({'role': 'user', 'content': user_message}))
+        else:
+            history.append(estimated({'role': 'user', 'content': user_message}))
+        
+        if is_first_user_message and not continuing:
+            socketio.emit('chat_title_updated', {'chatId': chat_id, 'title': user_message[:50]}, to=room)
+        if generation.cancelled:
+            return
+
+        context, context_tokens, dropped = assemble_prompt(user_id, chat_id, history)
+        if dropped:
+            print(f"Context for {chat_id}: {len(context)} messages (~{context_tokens} tokens), {dropped} older messages left out")
+        messages = [{'role': msg['role'], 'content': prompt_content(msg)} for msg in context]
+        if continuing:
+            # Ollama continues a trailing assistant message.
+            messages.append({'role': 'assistant', 'content': prefill})
+        key = cache_key(OLLAMA_MODEL, CHAT_OPTIONS, messages) if response_cache.applies(CHAT_OPTIONS) and not continuing else None
+        cached = cached_response(key)
+        semantic_scope = semantic_vector = None
+        if cached is None and semantic_cache and semantic_cache.enabled and standalone_question(history, messages):
+            semantic_scope = cache_key(OLLAMA_MODEL, CHAT_OPTIONS, messages[:-1])
+            if not SEMANTIC_CACHE_SHARED:
+                semantic_scope = f"{user_id}:{semantic_scope}"
+            cached, semantic_vector = semantic_cache.lookup(semantic_scope, user_message)
 
         ai_response_content = ""
-        first_chunk = True
-        for chunk in stream:
-            if stop_generating.get(request.sid):
-                print(f"Stopping generation for SID: {request.sid}")
-                break
-
-            chunk_content = chunk['message']['content']
-            ai_response_content += chunk_content
-            emit('response', {'content': chunk_content, 'first_chunk': first_chunk, 'chatId': chat_id}, to=request.sid)
-            if first_chunk:
-                first_chunk = False
+        response_tokens = None
+        if cached:
+            # Replayed through the same events as a generated reply.
+            print(f"Response cache hit for chat {chat_id}")
+            # No model call, so the slot (or place in line) goes to someone else.
+            scheduler.release(ticket)
+            ai_response_content = cached['content']
+            response_tokens = cached['tokens']
+            publish_frame(generation, ai_response_content, True)
+        else:
+            with generation_pool.idle():
+                if scheduler.wait(ticket, cancelled=lambda: generation.cancelled) is None:
+                    return
+            generation.admitted = True
+            if not continuing:
+                # Store the question now so a crash mid-reply leaves something
+                # for the checkpoint to attach to.
+                save_chat_history(user_id, chat_id, persisted_messages(history))
+            after_id = history[-1].get('id', 0)
+            accumulator = ResponseAccumulator(
+                lambda content: save_checkpoint(generation, after_id, content),
+                every_tokens=CHECKPOINT_EVERY_TOKENS, every_seconds=CHECKPOINT_EVERY_SECONDS, initial=prefill,
+            )
+            if continuing:
+                # The interrupted reply is checkpointed before it is dropped
+                # from the stored history, so a crash leaves one or the other.
+                accumulator.checkpoint()
+                save_chat_history(user_id, chat_id, persisted_messages(history))
+            client = ollama_router.client(affinity=chat_id)
+            started = time.time()
+            stream = client.chat(
+                model=OLLAMA_MODEL, messages=messages, stream=True,
+                options=CHAT_OPTIONS, keep_alive=OLLAMA_KEEP_ALIVE,
+            )
+
+            window_ms = flush_window_ms(job['rtt_ms'], STREAM_FLUSH_MIN_MS, STREAM_FLUSH_MAX_MS)
+            coalescer = StreamCoalescer(
+                lambda content, first: publish_frame(generation, content, first),
+                window_ms=window_ms, max_bytes=STREAM_FLUSH_BYTES,
+            )
+            completed = False
+            first_chunk = True
+            if prefill:
+                coalescer.add(prefill)
+            try:
+                for chunk in generation.stream(stream):
+                    if chunk.get('done'):
+                        completed = True
+                        response_tokens = chunk.get('eval_count')
+                        record_prompt_eval(chat_id, chunk, not is_first_user_message)
+                        record_model_load(chat_id, chunk)
+                    chunk_content = chunk['message']['content']
+                    accumulator.add(chunk_content)
+                    coalescer.add(chunk_content)
+                    if first_chunk:
+                        metrics.record('generation.ttft_ms', (time.time() - started) * 1000)
+                        first_chunk = False
+            except GenerationCancelled:
+                pass
+            if generation.cancelled:
+                print(f"Stopped generation {generation.id} for chat {chat_id}")
+            # Whatever is still buffered was generated and will be saved.
+            coalescer.flush()
+            ai_response_content = accumulator.text()
+            record_stream(chat_id, coalescer, window_ms)
+
+            # Only whole answers are worth replaying.
+            if key and completed and ai_response_content:
+                cache_response(key, ai_response_content, response_tokens)
+            if semantic_vector is not None and completed and ai_response_content:
+                semantic_cache.put(semantic_scope, semantic_vector, user_message, ai_response_content, response_tokens)
         
         if ai_response_content:
-             history.append({'role': 'assistant', 'content': ai_response_content})
+            reply = {'role': 'assistant', 'content': ai_response_content}
+            if response_tokens:
+                # eval_count only covers what this generation added to the
+                # continued reply.
+                reply['tokens'] = response_tokens + MESSAGE_OVERHEAD_TOKENS + (estimate_tokens(prefill) if prefill else 0)
+            else:
+                # Stopped before Ollama reported a count.
+                estimated(reply)
+            history.append(reply)
         
-        history_to_save = [msg for msg in history if not (msg['role'] == 'system' and msg.get('content', '').startswith('Web search results'))]
-        save_chat_history(user_id, chat_id, history_to_save)
+        saved = save_chat_history(user_id, chat_id, persisted_messages(history))
+        if summarizer:
+            summarizer.request(user_id, chat_id)
+
+    except AdmissionRejected as e:
+        socketio.emit('response_error', {'chatId': chat_id, 'generationId': generation.id, 'error': str(e)}, to=room)
 
     except Exception as e:
         print(f"!!! ERROR communicating with Ollama: {e}")
-        emit('response_error', {'error': "Sorry, I couldn't connect to the AI model. Please ensure Ollama is running."}, to=request.sid)
+        socketio.emit('response_error', {
+            'chatId': chat_id, 'generationId': generation.id,
+            'error': "Sorry, I couldn't connect to the AI model. Please ensure Ollama is running.",
+        }, to=room)
+        partial = accumulator.text() if accumulator else ''
+        if partial and not saved:
+            history.append(estimated({'role': 'assistant', 'content': partial, 'interrupted': True}))
+            saved = save_chat_history(user_id, chat_id, persisted_messages(history))
     
     finally:
-        status = 'stopped' if stop_generating.get(request.sid) else 'completed'
-        emit('response_end', {'chatId': chat_id, 'status': status}, to=request.sid)
-        if request.sid in stop_generating:
-            del stop_generating[request.sid]
+        if accumulator is not None and accumulator.checkpoints and saved:
+            remove_checkpoint_when_saved(user_id, chat_id, generation.id)
+        scheduler.release(ticket)
+        generations.finish(generation)
+        status = 'stopped' if generation.cancelled else 'completed'
+        socketio.emit('response_end', {'chatId': chat_id, 'generationId': generation.id, 'status': status}, to=room)
 
 if __name__ == '__main__':
     if not os.path.exists(CHAT_SESSIONS_DIR):
         os.makedirs(CHAT_SESSIONS_DIR)
+    if STORAGE_MAINTENANCE_INTERVAL > 0:
+        socketio.start_background_task(run_storage_maintenance)
+    if OLLAMA_HEALTH_INTERVAL > 0:
+        socketio.start_background_task(ollama_router.run_health_checks, socketio.sleep)
+    recover_interrupted_generations()
+    socketio.start_background_task(backfill_search_index)
+    if MODEL_RESIDENCY_INTERVAL > 0:
+        socketio.start_background_task(model_residency.run, socketio.sleep)
     socketio.run(app, host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,291 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import httpx
+import ollama
+
+from llm import OllamaRouter, CONNECTION_ERRORS
+from context import build_context, prompt_content, SYSTEM_PROMPT_STABLE
+from metrics import Metrics
+
+# --- Batch Inference ---
+# Runs a JSONL file of prompts (evals, bulk summarization, ...) through the
+# same prompt pipeline as the chat: the same system prompt, web results
+# attached to the question, the same context budget and model options. Each
+# input line is one request:
+#
+#   {"id": "q1", "prompt": "..."}                        single question
+#   {"id": "q2", "messages": [{"role": ..., "content": ...}, ...]}
+#   optional: "system", "model", "options", "web_search": true
+#
+# ("message"/"body" are accepted for the prompt and "request_id" for the id.)
+# Results are appended to the output JSONL as they finish, with timing and
+# token stats; re-running with the same output skips requests that already
+# succeeded, so an interrupted run resumes where it stopped. Batch runs talk
+# to Ollama directly, outside the chat server's scheduler, so they must be
+# given dedicated instances (--hosts or OLLAMA_BATCH_HOSTS) and refuse hosts
+# the chat server uses (OLLAMA_HOSTS / OLLAMA_HOST) unless
+# --allow-interactive-hosts is passed, which also limits them to one request
+# at a time.
+#
+#   OLLAMA_BATCH_HOSTS=http://gpu2:11434 python batch.py prompts.jsonl results.jsonl --concurrency 4
+
+RETRYABLE_ERRORS = CONNECTION_ERRORS + (httpx.HTTPError,)
+
+def split_hosts(value):
+    return [h.strip().rstrip('/') for h in (value or '').split(',') if h.strip()]
+
+def interactive_hosts():
+    return set(split_hosts(os.environ.get("OLLAMA_HOSTS") or os.environ.get("OLLAMA_HOST", "http://localhost:11434")))
+
+def request_id(request, line_number):
+    return str(request.get('id') or request.get('request_id') or f"line-{line_number}")
+
+def read_requests(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Skipping line {line_number}: {e}")
+                continue
+            yield request_id(request, line_number), request
+
+def completed_ids(path):
+    # The last result for an id wins, so requests that failed before run again.
+    done = {}
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by a crash
+            done[result.get('id')] = result.get('status') == 'ok'
+    return {rid for rid, ok in done.items() if ok}
+
+
+class BatchRunner:
+    def __init__(self, router, model, options, keep_alive=None, context_tokens=4096, response_tokens=1024,
+                 retries=3, backoff=2.0, web_search=False):
+        self.router = router
+        self.model = model
+        self.options = options
+        self.keep_alive = keep_alive
+        self.budget = context_tokens - response_tokens
+        self.retries = retries
+        self.backoff = backoff
+        self.web_search = web_search
+        self.metrics = Metrics(window=100000)
+        self.counters = {'ok': 0, 'error': 0, 'retries': 0, 'skipped': 0}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def build_messages(self, request):
+        history = [{'role': 'system', 'content': request.get('system') or SYSTEM_PROMPT_STABLE}]
+        if request.get('messages'):
+            history += [{'role': msg['role'], 'content': msg['content']} for msg in request['messages']]
+        else:
+            history.append({'role': 'user', 'content': request.get('prompt') or request.get('message') or request.get('body') or ''})
+        if request.get('web_search', self.web_search) and history[-1]['role'] == 'user':
+            from web_search import search_the_web
+            history[-1]['web_results'] = search_the_web(history[-1]['content'])
+        context, _, _ = build_context(history, self.budget)
+        return [{'role': msg['role'], 'content': prompt_content(msg)} for msg in context]
+
+    def generate(self, model, messages, options):
+        started = time.time()
+        first_token_at = None
+        parts = []
+        final = {}
+        stream = self.router.client().chat(
+            model=model, messages=messages, stream=True, options=options, keep_alive=self.keep_alive,
+        )
+        for chunk in stream:
+            if first_token_at is None and chunk['message']['content']:
+                first_token_at = time.time()
+            parts.append(chunk['message']['content'])
+            if chunk.get('done'):
+                final = chunk
+        total_ms = (time.time() - started) * 1000
+        eval_count = final.get('eval_count')
+        eval_ns = final.get('eval_duration')
+        return {
+            'response': ''.join(parts),
+            'ttft_ms': round((first_token_at - started) * 1000, 1) if first_token_at else None,
+            'total_ms': round(total_ms, 1),
+            'prompt_eval_count': final.get('prompt_eval_count'),
+            'prompt_eval_ms': round(final['prompt_eval_duration'] / 1e6, 1) if final.get('prompt_eval_duration') else None,
+            'eval_count': eval_count,
+            'tokens_per_sec': round(eval_count / (eval_ns / 1e9), 2) if eval_count and eval_ns else None,
+            'load_ms': round(final['load_duration'] / 1e6, 1) if final.get('load_duration') else None,
+            'done_reason': final.get('done_reason'),
+        }
+
+    def run_one(self, rid, request):
+        result = {'id': rid, 'model': request.get('model') or self.model, 'started_at': time.time()}
+        options = dict(self.options, **(request.get('options') or {}))
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                messages = self.build_messages(request)
+                result.update(self.generate(result['model'], messages, options))
+                result['status'] = 'ok'
+                break
+            except (ollama.ResponseError, *RETRYABLE_ERRORS) as e:
+                # Client errors (unknown model, bad options) will not fix themselves.
+                permanent = isinstance(e, ollama.ResponseError) and 400 <= e.status_code < 500
+                if permanent or attempt > self.retries or self.stopped.is_set():
+                    result.update(status='error', error=str(e))
+                    break
+                self.count('retries')
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            except Exception as e:
+                result.update(status='error', error=str(e))
+                break
+        result['attempts'] = attempt
+        self.count(result['status'])
+        if result['status'] == 'ok':
+            for name in ('total_ms', 'ttft_ms', 'tokens_per_sec'):
+                if result.get(name) is not None:
+                    self.metrics.record(name, result[name])
+        return result
+
+    def run(self, input_path, output_path, concurrency=2, limit=None):
+        done = completed_ids(output_path)
+        started = time.time()
+        submitted = 0
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        with open(output_path, 'a', encoding='utf-8') as out:
+            # future -> request id, for whatever has not been written yet.
+            pending = {}
+
+            def drain(block):
+                if block:
+                    wait(pending, return_when=FIRST_COMPLETED)
+                for future in [f for f in pending if f.done() and not f.cancelled()]:
+                    del pending[future]
+                    result = future.result()
+                    out.write(json.dumps(result, ensure_ascii=False) + '\n')
+                    out.flush()
+                    if result['status'] != 'ok':
+                        print(f"Request {result['id']} failed after {result['attempts']} attempts: {result['error']}")
+
+            try:
+                # Read the input lazily, keeping only a couple of requests per
+                # worker in flight.
+                for rid, request in read_requests(input_path):
+                    if rid in done:
+                        self.count('skipped')
+                        continue
+                    if limit is not None and submitted >= limit:
+                        break
+                    while len(pending) >= concurrency * 2:
+                        drain(block=True)
+                    pending[executor.submit(self.run_one, rid, request)] = rid
+                    submitted += 1
+                    if submitted % 100 == 0:
+                        drain(block=False)
+                        self.report(started)
+                while pending:
+                    drain(block=True)
+            except KeyboardInterrupt:
+                # Queued requests are cancelled and running ones stop retrying;
+                # what finished is still written, the rest is left for the
+                # next run together with everything not read yet.
+                self.stopped.set()
+                executor.shutdown(wait=False, cancel_futures=True)
+                drain(block=False)
+                self.report(started)
+                if pending:
+                    unprocessed = sorted(pending.values())
+                    shown = ', '.join(unprocessed[:20]) + (' ...' if len(unprocessed) > 20 else '')
+                    print(f"{len(unprocessed)} submitted requests were not processed: {shown}")
+                raise
+            finally:
+                executor.shutdown(wait=not self.stopped.is_set())
+        self.report(started)
+
+    def report(self, started):
+        elapsed = time.time() - started
+        with self.lock:
+            counters = dict(self.counters)
+        finished = counters['ok'] + counters['error']
+        print(f"{finished} done ({counters['ok']} ok, {counters['error']} failed, {counters['retries']} retries, "
+              f"{counters['skipped']} already done) in {elapsed:.1f}s, {finished / elapsed if elapsed else 0:.2f} req/s")
+        for name, summary in self.metrics.snapshot().items():
+            if summary['count']:
+                print(f"  {name}: avg {summary['avg']}, p50 {summary['p50']}, p95 {summary['p95']}, max {summary['max']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through the TheroGPT model pipeline.")
+    parser.add_argument('input', help="JSONL file of requests")
+    parser.add_argument('output', help="JSONL file results are appended to (and resumed from)")
+    parser.add_argument('--hosts', default=os.environ.get("OLLAMA_BATCH_HOSTS"),
+                        help="comma-separated Ollama hosts reserved for batch work (default: OLLAMA_BATCH_HOSTS)")
+    parser.add_argument('--allow-interactive-hosts', action='store_true',
+                        help="allow hosts the chat server uses, one request at a time")
+    parser.add_argument('--model', default=os.environ.get("OLLAMA_MODEL", "gemma2:2b"))
+    parser.add_argument('--concurrency', type=int, default=2)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--backoff', type=float, default=2.0, help="seconds before the first retry, doubling after")
+    parser.add_argument('--limit', type=int, help="run at most this many new requests")
+    parser.add_argument('--web-search', action='store_true', help="attach web results to every question")
+    parser.add_argument('--context-tokens', type=int, default=int(os.environ.get("OLLAMA_CONTEXT_TOKENS", "4096")))
+    parser.add_argument('--response-tokens', type=int, default=int(os.environ.get("OLLAMA_RESPONSE_TOKENS", "1024")))
+    parser.add_argument('--keep-alive', default=os.environ.get("OLLAMA_KEEP_ALIVE", "30m"))
+    parser.add_argument('--temperature', type=float, default=os.environ.get("OLLAMA_TEMPERATURE"))
+    parser.add_argument('--seed', type=int, default=os.environ.get("OLLAMA_SEED"))
+    args = parser.parse_args(argv)
+
+    options = {'num_ctx': args.context_tokens}
+    if args.temperature is not None:
+        options['temperature'] = float(args.temperature)
+    if args.seed is not None:
+        options['seed'] = int(args.seed)
+    hosts = split_hosts(args.hosts)
+    if not hosts:
+        parser.error("no batch hosts; set OLLAMA_BATCH_HOSTS or pass --hosts")
+    shared = interactive_hosts().intersection(hosts)
+    if shared and not args.allow_interactive_hosts:
+        parser.error(f"{', '.join(sorted(shared))} also serves chat; use dedicated hosts or pass --allow-interactive-hosts")
+    if shared and args.concurrency > 1:
+        print(f"Sharing {', '.join(sorted(shared))} with the chat server; running one request at a time")
+        args.concurrency = 1
+    router = OllamaRouter(hosts, affinity=False, max_connections=max(2, args.concurrency))
+    runner = BatchRunner(
+        router, args.model, options,
+        keep_alive=args.keep_alive,
+        context_tokens=args.context_tokens,
+        response_tokens=args.response_tokens,
+        retries=args.retries,
+        backoff=args.backoff,
+        web_search=args.web_search,
+    )
+    try:
+        runner.run(args.input, args.output, concurrency=args.concurrency, limit=args.limit)
+    except KeyboardInterrupt:
+        print("Interrupted; re-run with the same output file to resume.")
+        return 130
+    finally:
+        router.close()
+    return 0 if runner.counters['error'] == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
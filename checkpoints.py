@@ -0,0 +1,77 @@
+import time
+
+from storage import SqliteConnectionPool
+
+# --- Response Checkpoints ---
+# Replies used to reach storage only once they finished, so a crash or restart
+# during a long generation lost all of it. The accumulator collects the
+# streamed text and every `every_tokens` chunks or `every_seconds` upserts it
+# into a one-row-per-generation checkpoint table: one small write instead of a
+# rewrite of the chat. Finished generations delete their row; rows still there
+# at startup belong to interrupted generations and become partial replies
+# marked `interrupted`, which the user can continue rather than regenerate.
+
+class CheckpointStore:
+    def __init__(self, db_path, pool_size=2):
+        self.pool = SqliteConnectionPool(db_path, size=pool_size)
+        with self.pool.transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS generation_checkpoints (
+                    generation_id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    chat_id TEXT NOT NULL,
+                    after_id INTEGER NOT NULL,
+                    content TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+
+    def save(self, generation_id, user_id, chat_id, after_id, content):
+        with self.pool.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO generation_checkpoints (generation_id, user_id, chat_id, after_id, content, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (generation_id, user_id, chat_id, after_id, content, time.time()),
+            )
+
+    def remove(self, generation_id):
+        with self.pool.transaction() as conn:
+            conn.execute("DELETE FROM generation_checkpoints WHERE generation_id = ?", (generation_id,))
+
+    def pending(self):
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT * FROM generation_checkpoints ORDER BY updated_at").fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self):
+        with self.pool.connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM generation_checkpoints").fetchone()[0]
+
+
+class ResponseAccumulator:
+    def __init__(self, on_checkpoint=None, every_tokens=64, every_seconds=5.0, initial=''):
+        self.parts = [initial] if initial else []
+        self.on_checkpoint = on_checkpoint
+        self.every_tokens = every_tokens
+        self.every_seconds = every_seconds
+        self.pending = 0
+        self.last_checkpoint = time.monotonic()
+        self.checkpoints = 0
+
+    def add(self, text):
+        self.parts.append(text)
+        self.pending += 1
+        if self.on_checkpoint and (self.pending >= self.every_tokens
+                                   or time.monotonic() - self.last_checkpoint >= self.every_seconds):
+            self.checkpoint()
+
+    def checkpoint(self):
+        self.on_checkpoint(self.text())
+        self.pending = 0
+        self.last_checkpoint = time.monotonic()
+        self.checkpoints += 1
+
+    def text(self):
+        if len(self.parts) > 1:
+            self.parts = [''.join(self.parts)]
+        return self.parts[0] if self.parts else ''
@@ -0,0 +1,107 @@
+import re
+
+# --- System Prompts ---
+# Shared by the chat server and batch runs. The legacy layout switches between
+# DEFAULT and WEB per message; the stable layout always sends STABLE.
+
+SYSTEM_PROMPT_DEFAULT = "You are TheroGPT, a helpful AI assistant. You do NOT have access to the internet or live search results."
+SYSTEM_PROMPT_WEB = "You are TheroGPT, a helpful AI assistant. You have been provided with a series of web search results. Please use them to answer the user's query."
+SYSTEM_PROMPT_STABLE = "You are TheroGPT, a helpful AI assistant. You cannot browse the internet yourself, but some user messages come with web search results; when they do, use them to answer."
+
+# --- Context Window ---
+# Chooses which messages of a chat are sent to the model. The leading system
+# messages (prompt, chat summary) and the current turn (the user message plus
+# any web results injected just before it) are always kept; older messages are
+# added newest first until the token budget is used up, so prompt size stays
+# flat however long the chat is.
+#
+# Token counts are estimated (no tokenizer for the served model is available
+# here) unless a message carries 'tokens': assistant replies store the
+# eval_count Ollama reports, and messages built by the server store their
+# estimate when they are created, so a long chat isn't re-estimated every
+# turn. message_tokens never writes back, since loaded messages belong to the
+# caller (and often to the history cache).
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def estimate_tokens(text):
+    # Roughly one token per short word or symbol and one per ~4 characters of
+    # longer words, which tracks BPE tokenizers well enough for budgeting.
+    return sum((len(piece) + 3) // 4 for piece in TOKEN_PATTERN.findall(text or ''))
+
+def message_tokens(msg):
+    tokens = msg.get('tokens')
+    if tokens is None:
+        tokens = estimate_tokens(prompt_content(msg)) + MESSAGE_OVERHEAD_TOKENS
+    return tokens
+
+def estimated(msg):
+    """Stores the token estimate on a message that has just been built."""
+    msg['tokens'] = estimate_tokens(prompt_content(msg)) + MESSAGE_OVERHEAD_TOKENS
+    return msg
+
+def split_history(history):
+    """Splits into (pinned head, older turns, current turn)."""
+    pinned = 0
+    while pinned < len(history) - 1 and history[pinned]['role'] == 'system':
+        pinned += 1
+    start = len(history) - 1
+    while start > pinned and history[start - 1]['role'] == 'system':
+        start -= 1
+    return history[:pinned], history[pinned:start], history[start:]
+
+def build_context(history, budget):
+    """Returns (messages, total_tokens, dropped) for a history ending in the new user message."""
+    head, middle, tail = split_history(history)
+    start = len(head) + len(middle)
+    used = sum(message_tokens(msg) for msg in head + tail)
+
+    kept = []
+    index = start - 1
+    while index >= len(head):
+        tokens = message_tokens(history[index])
+        if used + tokens > budget:
+            break
+        used += tokens
+        kept.append(history[index])
+        index -= 1
+    kept.reverse()
+    # Don't open the window on a reply whose question was cut off.
+    if kept and kept[0]['role'] == 'assistant' and index >= len(head):
+        used -= message_tokens(kept.pop(0))
+    dropped = len(history) - len(head) - len(tail) - len(kept)
+    return head + kept + tail, used, dropped
+
+# --- Stable Prompt Prefix ---
+# Ollama reuses its KV cache for the longest prefix a new prompt shares with
+# the previous one. The sliding window above moves its start every turn once
+# a chat is over budget, which invalidates the whole cache. The anchored
+# window instead opens at a fixed message id and only ever appends, and is
+# re-anchored (leaving room to grow) when it no longer fits.
+
+def prompt_content(msg):
+    # Web results are kept with the user message they were fetched for, so
+    # the turn reads the same every time it is replayed.
+    if msg.get('web_results'):
+        return f"{msg['content']}\n\nWeb search results:\n{msg['web_results']}"
+    return msg['content']
+
+def build_anchored_context(history, budget, start_id):
+    """Returns (messages, total_tokens, dropped) opening at `start_id`, or None if that no longer fits."""
+    head, middle, tail = split_history(history)
+    window = [msg for msg in middle if msg['id'] >= start_id]
+    messages = head + window + tail
+    used = sum(message_tokens(msg) for msg in messages)
+    if used > budget:
+        return None
+    return messages, used, len(middle) - len(window)
+
+def anchor_id(history, context):
+    """The message id an anchored window should open at to reproduce `context`."""
+    _, middle, _ = split_history(history)
+    kept = {id(msg) for msg in context}
+    for msg in middle:
+        if id(msg) in kept:
+            return msg['id']
+    return middle[-1]['id'] + 1 if middle else 0
@@ -0,0 +1,262 @@
+import time
+import uuid
+import queue
+import itertools
+import threading
+from contextlib import contextmanager
+
+import greenlet
+from eventlet import hubs
+
+from scheduler import PRIORITIES
+
+# --- Generation Registry ---
+# Every reply being generated has an id, so Stop cancels that one generation
+# rather than everything on the socket. Cancelling must also stop Ollama: a
+# flag checked between chunks leaves the HTTP stream open (and the backend
+# computing) until the next token arrives, which during a long prompt eval can
+# be seconds. So while the generating greenlet is blocked reading from Ollama,
+# cancel() raises GenerationCancelled inside that read; httpcore closes the
+# connection on the way out, Ollama sees the disconnect and aborts, and the
+# handler releases its slot right away. Between reads the flag is enough.
+#
+# Output is not tied to the socket that asked for it: frames are published to
+# the chat's room and kept in a per-generation ring buffer, so a client that
+# reconnects mid-answer subscribes with (generation id, offset) and gets the
+# tail it missed followed by the live stream. Offsets count characters.
+
+def chat_room(user_id, chat_id):
+    return f"chat:{user_id}:{chat_id}"
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+class Generation:
+    def __init__(self, generation_id, user_id, chat_id, sid, replay_chars=262144):
+        self.id = generation_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.sid = sid
+        self.started_at = time.time()
+        self.cancelled_at = None
+        self.admitted = False
+        self.reading = False
+        self.greenlet = None
+        self.replay_chars = replay_chars
+        self.buffer = ''
+        self.base = 0
+
+    @property
+    def room(self):
+        return chat_room(self.user_id, self.chat_id)
+
+    @property
+    def length(self):
+        return self.base + len(self.buffer)
+
+    def append(self, text):
+        """Adds output to the ring buffer; returns the offset it starts at."""
+        offset = self.length
+        self.buffer += text
+        overflow = len(self.buffer) - self.replay_chars
+        if overflow > 0:
+            self.buffer = self.buffer[overflow:]
+            self.base += overflow
+        return offset
+
+    def replay(self, offset):
+        """The output from `offset` on, or None if it has left the buffer."""
+        if offset < self.base:
+            return None
+        return self.buffer[offset - self.base:]
+
+    @property
+    def cancelled(self):
+        return self.cancelled_at is not None
+
+    def cancel(self):
+        if self.cancelled:
+            return False
+        self.cancelled_at = time.time()
+        if self.reading:
+            hubs.get_hub().schedule_call_global(0, self.interrupt)
+        return True
+
+    def interrupt(self):
+        # Runs in the hub; by now the generation may have moved past the read.
+        if self.reading and not self.greenlet.dead:
+            self.greenlet.throw(GenerationCancelled())
+
+    def stream(self, chunks):
+        """Yields from `chunks` until cancelled, closing the upstream response on cancel."""
+        # Whichever greenlet reads the stream is the one to interrupt.
+        self.greenlet = greenlet.getcurrent()
+        try:
+            while not self.cancelled:
+                self.reading = True
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+                finally:
+                    self.reading = False
+                yield chunk
+        finally:
+            # Closing an unfinished stream drops its connection to Ollama.
+            chunks.close()
+
+
+class GenerationRegistry:
+    def __init__(self, metrics=None, replay_chars=262144):
+        self.generations = {}
+        self.metrics = metrics
+        self.replay_chars = replay_chars
+        self.lock = threading.Lock()
+        self.counters = {'started': 0, 'cancelled': 0, 'resumed': 0}
+
+    def start(self, user_id, chat_id, sid, generation_id=None):
+        generation_id = str(generation_id or uuid.uuid4().hex)[:64]
+        with self.lock:
+            if generation_id in self.generations:
+                generation_id = uuid.uuid4().hex
+            generation = Generation(generation_id, user_id, chat_id, sid, self.replay_chars)
+            self.generations[generation_id] = generation
+            self.counters['started'] += 1
+        return generation
+
+    def get(self, generation_id):
+        with self.lock:
+            return self.generations.get(generation_id)
+
+    def resume(self, generation_id, user_id, sid, offset):
+        """Moves a generation to a reconnected socket; returns (generation, missed output)."""
+        generation = self.get(generation_id)
+        if generation is None or generation.user_id != user_id:
+            return None, None
+        generation.sid = sid
+        with self.lock:
+            self.counters['resumed'] += 1
+        return generation, generation.replay(max(0, offset))
+
+    def cancel(self, generation_id, user_id):
+        generation = self.get(generation_id)
+        if generation is None or generation.user_id != user_id:
+            return False
+        return self.cancel_generation(generation)
+
+    def cancel_sid(self, sid, queued_only=False):
+        """Cancels a socket's generations (only those still waiting for a slot with `queued_only`)."""
+        with self.lock:
+            generations = [g for g in self.generations.values() if g.sid == sid]
+        return sum(1 for g in generations if not (queued_only and g.admitted) and self.cancel_generation(g))
+
+    def cancel_generation(self, generation):
+        if not generation.cancel():
+            return False
+        with self.lock:
+            self.counters['cancelled'] += 1
+        print(f"Cancelling generation {generation.id} for chat {generation.chat_id}")
+        return True
+
+    def finish(self, generation):
+        with self.lock:
+            self.generations.pop(generation.id, None)
+        if generation.cancelled and self.metrics:
+            # From Stop to the slot (and the Ollama request) being given back.
+            self.metrics.record('generation.cancel_to_idle_ms', (time.time() - generation.cancelled_at) * 1000)
+
+    def active(self):
+        with self.lock:
+            return len(self.generations)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, active=len(self.generations))
+
+
+# --- Generation Workers ---
+# Socket handlers take a scheduler ticket, enqueue a job and subscribe to the
+# chat's room; a pool of workers runs the jobs, interactive before batch and
+# otherwise in submission order. How much generation work is in flight is then
+# set by the pool size rather than by how many sockets happen to be sending
+# messages, and a generation outlives the handler (and the socket) that asked
+# for it. A job waiting for its ticket to be granted steps out of the pool
+# (a stand-in worker takes its place), so the scheduler's fair queue, not the
+# pool, is where requests wait.
+
+class GenerationWorkerPool:
+    def __init__(self, run_job, workers=16, spawn=None):
+        self.run_job = run_job
+        self.workers = workers
+        self.spawn = spawn or (lambda target: threading.Thread(target=target, daemon=True).start())
+        self.jobs = queue.PriorityQueue()
+        self.order = itertools.count()
+        self.started = False
+        self.live = 0
+        self.busy = 0
+        self.waiting = 0
+        self.lock = threading.Lock()
+        self.counters = {'submitted': 0, 'completed': 0, 'failed': 0}
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            self.live = self.workers
+        for _ in range(self.workers):
+            self.spawn(self.run_worker)
+
+    @contextmanager
+    def idle(self):
+        """Lets the current job block (e.g. for admission) without holding a worker."""
+        with self.lock:
+            self.waiting += 1
+            spawn = self.live - self.waiting < self.workers
+            if spawn:
+                self.live += 1
+        if spawn:
+            self.spawn(self.run_worker)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    def submit(self, job):
+        self.start()
+        priority = job.get('priority')
+        rank = PRIORITIES.index(priority) if priority in PRIORITIES else 0
+        with self.lock:
+            self.counters['submitted'] += 1
+        self.jobs.put((rank, next(self.order), job))
+
+    def run_worker(self):
+        while True:
+            with self.lock:
+                # Stand-ins retire once the jobs they covered for are running again.
+                if self.live - self.waiting > self.workers:
+                    self.live -= 1
+                    return
+            _, _, job = self.jobs.get()
+            with self.lock:
+                self.busy += 1
+            try:
+                self.run_job(job)
+            except Exception as e:
+                with self.lock:
+                    self.counters['failed'] += 1
+                print(f"!!! ERROR in generation worker: {e}")
+            else:
+                with self.lock:
+                    self.counters['completed'] += 1
+            finally:
+                with self.lock:
+                    self.busy -= 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, workers=self.workers, live=self.live, busy=self.busy,
+                        waiting_for_admission=self.waiting, queued=self.jobs.qsize())
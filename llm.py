@@ -0,0 +1,444 @@
+import time
+import threading
+from collections import OrderedDict
+
+import httpx
+import ollama
+
+# --- Shared Ollama Clients ---
+# One sync and one async ollama client per process, each on a pooled httpx
+# transport with keep-alive, so a chat turn reuses an open connection instead
+# of paying for a new client and TCP handshake. The transports trace
+# connection setup so /stats can show how often connections are reused.
+
+class TracingTransport(httpx.HTTPTransport):
+    def __init__(self, manager, **kwargs):
+        super().__init__(**kwargs)
+        self.manager = manager
+
+    def handle_request(self, request):
+        self.manager.count('requests')
+        request.extensions['trace'] = self.manager.trace
+        try:
+            return super().handle_request(request)
+        except httpx.TransportError:
+            self.manager.count('errors')
+            raise
+
+
+class AsyncTracingTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, manager, **kwargs):
+        super().__init__(**kwargs)
+        self.manager = manager
+
+    async def handle_async_request(self, request):
+        self.manager.count('requests')
+        request.extensions['trace'] = self.manager.async_trace
+        try:
+            return await super().handle_async_request(request)
+        except httpx.TransportError:
+            self.manager.count('errors')
+            raise
+
+
+class OllamaClientManager:
+    def __init__(self, host, max_connections=10, keepalive_expiry=300.0, connect_timeout=5.0, read_timeout=300.0,
+                 probe_timeout=3.0):
+        self.host = host
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        # Streams can pause for a long time while the model thinks, so only
+        # connecting is held to a short timeout.
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        # Health probes get a client of their own with a short overall
+        # timeout, so a hung backend is noticed in seconds, not minutes.
+        self.probe_timeout = httpx.Timeout(probe_timeout)
+        self.lock = threading.Lock()
+        self.sync_client = None
+        self.probe_client_instance = None
+        self.sync_transport = None
+        self.async_client_instance = None
+        self.async_transport = None
+        self.connect_started = {}
+        self.counters = {'requests': 0, 'errors': 0, 'connections_opened': 0, 'connect_ms': 0.0}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def trace(self, event, info):
+        if event == 'connection.connect_tcp.started':
+            self.connect_started[threading.get_ident()] = time.perf_counter()
+        elif event == 'connection.connect_tcp.complete':
+            started = self.connect_started.pop(threading.get_ident(), None)
+            with self.lock:
+                self.counters['connections_opened'] += 1
+                if started is not None:
+                    self.counters['connect_ms'] += (time.perf_counter() - started) * 1000
+
+    async def async_trace(self, event, info):
+        self.trace(event, info)
+
+    def client(self):
+        with self.lock:
+            if self.sync_client is None:
+                self.sync_transport = TracingTransport(self, limits=self.limits)
+                self.sync_client = ollama.Client(host=self.host, timeout=self.timeout, transport=self.sync_transport)
+            return self.sync_client
+
+    def probe_client(self):
+        with self.lock:
+            if self.probe_client_instance is None:
+                self.probe_client_instance = ollama.Client(host=self.host, timeout=self.probe_timeout)
+            return self.probe_client_instance
+
+    def async_client(self):
+        # httpx async connections belong to the event loop that opened them;
+        # use this from a single long-lived loop.
+        with self.lock:
+            if self.async_client_instance is None:
+                self.async_transport = AsyncTracingTransport(self, limits=self.limits)
+                self.async_client_instance = ollama.AsyncClient(
+                    host=self.host, timeout=self.timeout, transport=self.async_transport,
+                )
+            return self.async_client_instance
+
+    def close(self):
+        with self.lock:
+            if self.sync_client is not None:
+                self.sync_client._client.close()
+                self.sync_client = self.sync_transport = None
+            if self.probe_client_instance is not None:
+                self.probe_client_instance._client.close()
+                self.probe_client_instance = None
+
+    def pool_state(self, transport):
+        pool = getattr(transport, '_pool', None)
+        if pool is None:
+            return None
+        connections = list(pool.connections)
+        idle = sum(1 for conn in connections if conn.is_idle())
+        return {'open': len(connections), 'idle': idle, 'active': len(connections) - idle}
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+        opened = counters['connections_opened']
+        return dict(
+            counters,
+            connect_ms=round(counters['connect_ms'], 2),
+            avg_connect_ms=round(counters['connect_ms'] / opened, 2) if opened else None,
+            reuse_rate=round(1 - opened / counters['requests'], 4) if counters['requests'] else None,
+            max_connections=self.limits.max_connections,
+            keepalive_expiry=self.limits.keepalive_expiry,
+            sync_pool=self.pool_state(self.sync_transport),
+            async_pool=self.pool_state(self.async_transport),
+        )
+
+
+# --- Backend Routing ---
+# Requests are spread over one or more Ollama hosts (OLLAMA_HOSTS). Each goes
+# to the healthy backend with the fewest requests in flight; with affinity, a
+# chat stays on the backend that already holds its KV cache unless that one is
+# noticeably busier. Backends that fail requests or health probes repeatedly
+# are ejected and re-admitted once a probe succeeds. A request that cannot
+# connect is retried on the next backend before any output is produced.
+
+CONNECTION_ERRORS = (ConnectionError, httpx.TransportError)
+
+class OllamaBackend:
+    def __init__(self, host, **pool_options):
+        self.host = host
+        self.clients = OllamaClientManager(host, **pool_options)
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+        self.healthy = True
+        self.last_error = None
+
+    def stats(self):
+        return {
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'consecutive_failures': self.failures,
+            'ejections': self.ejections,
+            'last_error': self.last_error,
+            'pool': self.clients.stats(),
+        }
+
+
+class OllamaRouter:
+    def __init__(self, hosts, affinity=True, affinity_slack=2, affinity_entries=10000,
+                 eject_after=3, probe_interval=10, per_backend_limit=None, **pool_options):
+        self.backends = [OllamaBackend(host, **pool_options) for host in hosts]
+        self.affinity_enabled = affinity
+        self.affinity_slack = affinity_slack
+        self.affinity_entries = affinity_entries
+        self.affinity = OrderedDict()
+        self.eject_after = eject_after
+        self.probe_interval = probe_interval
+        self.per_backend_limit = per_backend_limit
+        self.lock = threading.Lock()
+        self.counters = {'affinity_hits': 0, 'affinity_moves': 0, 'retries': 0}
+
+    def client(self, affinity=None):
+        return RoutedClient(self, affinity)
+
+    def pick(self, affinity_key=None, exclude=()):
+        with self.lock:
+            candidates = [b for b in self.backends if b not in exclude]
+            # With every backend ejected, still try them rather than fail outright.
+            candidates = [b for b in candidates if b.healthy] or candidates
+            backend = min(candidates, key=lambda b: (b.outstanding, b.requests))
+            if affinity_key is not None and self.affinity_enabled and len(self.backends) > 1:
+                host = self.affinity.get(affinity_key)
+                pinned = next((b for b in candidates if b.host == host), None)
+                if (pinned is not None and pinned.outstanding <= backend.outstanding + self.affinity_slack
+                        and (self.per_backend_limit is None or pinned.outstanding < self.per_backend_limit)):
+                    backend = pinned
+                    self.counters['affinity_hits'] += 1
+                elif host is not None:
+                    self.counters['affinity_moves'] += 1
+                self.affinity[affinity_key] = backend.host
+                self.affinity.move_to_end(affinity_key)
+                while len(self.affinity) > self.affinity_entries:
+                    self.affinity.popitem(last=False)
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+
+    def healthy_count(self):
+        return sum(1 for backend in self.backends if backend.healthy)
+
+    def count_retry(self):
+        with self.lock:
+            self.counters['retries'] += 1
+
+    def release(self, backend):
+        with self.lock:
+            backend.outstanding -= 1
+
+    def record_success(self, backend):
+        with self.lock:
+            backend.failures = 0
+            if not backend.healthy:
+                backend.healthy = True
+                print(f"Ollama backend {backend.host} re-admitted")
+
+    def record_failure(self, backend, error):
+        with self.lock:
+            backend.failures += 1
+            backend.last_error = str(error)
+            if backend.healthy and backend.failures >= self.eject_after:
+                backend.healthy = False
+                backend.ejections += 1
+                print(f"Ollama backend {backend.host} ejected after {backend.failures} failures: {error}")
+
+    def probe_backend(self, backend):
+        try:
+            backend.clients.probe_client().ps()
+        except Exception as e:
+            self.record_failure(backend, e)
+        else:
+            self.record_success(backend)
+
+    def probe(self):
+        # Backends are probed side by side (green threads once eventlet has
+        # patched the process), so one slow host does not delay the others.
+        threads = [threading.Thread(target=self.probe_backend, args=(backend,), daemon=True) for backend in self.backends]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_health_checks(self, sleep):
+        while True:
+            self.probe()
+            sleep(self.probe_interval)
+
+    def close(self):
+        for backend in self.backends:
+            backend.clients.close()
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                self.counters,
+                affinity_entries=len(self.affinity),
+                backends={backend.host: backend.stats() for backend in self.backends},
+            )
+
+
+class RoutedClient:
+    """The parts of ollama.Client the app uses, sent through the router."""
+
+    def __init__(self, router, affinity=None):
+        self.router = router
+        self.affinity = affinity
+
+    def chat(self, **kwargs):
+        return self.stream('chat', kwargs) if kwargs.get('stream') else self.call('chat', kwargs)
+
+    def generate(self, **kwargs):
+        return self.stream('generate', kwargs) if kwargs.get('stream') else self.call('generate', kwargs)
+
+    def embed(self, **kwargs):
+        return self.call('embed', kwargs)
+
+    def call(self, method, kwargs):
+        tried = []
+        while True:
+            backend = self.router.pick(self.affinity, exclude=tried)
+            try:
+                result = getattr(backend.clients.client(), method)(**kwargs)
+            except CONNECTION_ERRORS as e:
+                self.router.record_failure(backend, e)
+                tried.append(backend)
+                if len(tried) >= len(self.router.backends):
+                    raise
+                self.router.count_retry()
+                continue
+            finally:
+                self.router.release(backend)
+            self.router.record_success(backend)
+            return result
+
+    def stream(self, method, kwargs):
+        tried = []
+        while True:
+            backend = self.router.pick(self.affinity, exclude=tried)
+            try:
+                chunks = getattr(backend.clients.client(), method)(**kwargs)
+                try:
+                    # The request is only sent once the stream is read.
+                    first = next(chunks)
+                except StopIteration:
+                    self.router.record_success(backend)
+                    return
+                except CONNECTION_ERRORS as e:
+                    self.router.record_failure(backend, e)
+                    tried.append(backend)
+                    if len(tried) >= len(self.router.backends):
+                        raise
+                    self.router.count_retry()
+                    continue
+                self.router.record_success(backend)
+                yield first
+                yield from chunks
+                return
+            finally:
+                self.router.release(backend)
+
+
+# --- Model Residency ---
+# Keeps the configured models loaded in Ollama so no user message pays for a
+# cold load: they are preloaded at startup with an empty generate request and
+# re-warmed before their keep_alive runs out, as long as they fit the memory
+# budget (models earlier in the list win). Warm-ups use the same options as
+# real requests, since Ollama reloads a model whose num_ctx changes.
+
+def model_key(name):
+    return name if ':' in name else f"{name}:latest"
+
+
+class ModelResidencyManager:
+    def __init__(self, router, models, keep_alive='30m', check_interval=60,
+                 memory_budget_bytes=0, options=None):
+        self.router = router
+        self.models = list(dict.fromkeys(models))
+        self.keep_alive = keep_alive
+        self.check_interval = check_interval
+        self.memory_budget_bytes = memory_budget_bytes
+        self.options = options or {}
+        self.model_sizes = {}
+        self.loaded = {}
+        self.lock = threading.Lock()
+        self.counters = {'warmups': 0, 'warmup_errors': 0, 'checks': 0, 'skipped_for_budget': 0}
+        self.last_warmup_ms = {}
+
+    def warm(self, backend, model):
+        started = time.time()
+        try:
+            response = backend.clients.client().generate(
+                model=model, prompt='', keep_alive=self.keep_alive, options=self.options,
+            )
+        except Exception as e:
+            with self.lock:
+                self.counters['warmup_errors'] += 1
+            print(f"Error warming model {model} on {backend.host}: {e}")
+            return False
+        elapsed_ms = (time.time() - started) * 1000
+        with self.lock:
+            self.counters['warmups'] += 1
+            self.last_warmup_ms[f"{backend.host} {model}"] = round(elapsed_ms, 1)
+        load_ms = (response.get('load_duration') or 0) / 1e6
+        print(f"Warmed model {model} on {backend.host} in {elapsed_ms:.0f} ms (load {load_ms:.0f} ms)")
+        return True
+
+    def running_models(self, backend):
+        loaded = {}
+        for entry in backend.clients.client().ps().models:
+            name = model_key(entry.model or entry.name)
+            loaded[name] = entry
+            if entry.size:
+                self.model_sizes[name] = int(entry.size)
+        return loaded
+
+    def check(self):
+        for backend in self.router.backends:
+            if backend.healthy:
+                self.check_backend(backend)
+
+    def check_backend(self, backend):
+        """Warms configured models that are unloaded or about to expire on one backend."""
+        try:
+            loaded = self.running_models(backend)
+        except Exception as e:
+            print(f"Error checking loaded models on {backend.host}: {e}")
+            return
+        with self.lock:
+            self.counters['checks'] += 1
+            self.loaded[backend.host] = {
+                name: entry.expires_at.isoformat() if entry.expires_at else None for name, entry in loaded.items()
+            }
+        now = time.time()
+        # Other models Ollama holds count against the budget as well.
+        configured = {model_key(model) for model in self.models}
+        used = sum(self.model_sizes.get(name, 0) for name in loaded if name not in configured)
+        for model in self.models:
+            name = model_key(model)
+            size = self.model_sizes.get(name, 0)
+            if self.memory_budget_bytes and used + size > self.memory_budget_bytes:
+                with self.lock:
+                    self.counters['skipped_for_budget'] += 1
+                continue
+            used += size
+            entry = loaded.get(name)
+            expires = entry.expires_at.timestamp() if entry is not None and entry.expires_at else None
+            if entry is None or (expires is not None and expires - now < 2 * self.check_interval):
+                if self.warm(backend, model) and name not in self.model_sizes:
+                    # Learn the size now that it is loaded, for the budget.
+                    self.running_models(backend)
+                    used += self.model_sizes.get(name, 0)
+
+    def run(self, sleep):
+        while True:
+            self.check()
+            sleep(self.check_interval)
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                self.counters,
+                models=self.models,
+                keep_alive=self.keep_alive,
+                loaded=dict(self.loaded),
+                model_sizes=dict(self.model_sizes),
+                memory_budget_bytes=self.memory_budget_bytes,
+                last_warmup_ms=dict(self.last_warmup_ms),
+            )
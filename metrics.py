@@ -0,0 +1,50 @@
+import threading
+from collections import deque
+
+# --- Metrics ---
+# Small in-process counters for /stats: each series keeps a running count and
+# total plus a window of recent values for percentiles.
+
+class MetricSeries:
+    def __init__(self, window=500):
+        self.values = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, value):
+        self.values.append(value)
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        recent = sorted(self.values)
+        return {
+            'count': self.count,
+            'avg': round(self.total / self.count, 2),
+            'p50': round(recent[len(recent) // 2], 2),
+            'p95': round(recent[min(len(recent) - 1, int(len(recent) * 0.95))], 2),
+            'max': round(recent[-1], 2),
+        }
+
+
+class Metrics:
+    def __init__(self, window=500):
+        self.window = window
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, value):
+        with self.lock:
+            series = self.series.get(name)
+            if series is None:
+                series = self.series[name] = MetricSeries(self.window)
+            series.record(value)
+
+    def snapshot(self, prefix=''):
+        with self.lock:
+            return {
+                name[len(prefix):]: series.summary()
+                for name, series in sorted(self.series.items()) if name.startswith(prefix)
+            }
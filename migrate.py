@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+from storage import SqliteChatStore, create_chat_store, parse_chat_log, parse_timestamp, unwrap_store
+from search_index import ChatSearchIndex
+
+# --- Legacy Chat Migration ---
+# Streams every older storage generation into the configured chat store:
+#   chat_sessions/<user>/<chat>.json(l)   one file per chat
+#   chat.db / database.db                 chat(session_id, role, message, timestamp)
+#   therogpt.db                           messages rows that have no user_id yet
+# Chats that already exist in the target are skipped, so the tool can be
+# interrupted and re-run; finished sources are also recorded in a state file.
+# Imported chats are added to the search index at the end of the run.
+#
+#   python migrate.py --backend sqlite --db therogpt.db --legacy-user thero
+
+LEGACY_ROLES = {'ai': 'assistant', 'bot': 'assistant', 'human': 'user'}
+
+def normalize_messages(messages):
+    normalized = []
+    for msg in messages:
+        role = LEGACY_ROLES.get(msg.get('role'), msg.get('role'))
+        if role not in ('user', 'assistant') or msg.get('content') is None:
+            continue
+        normalized.append({'role': role, 'content': msg['content']})
+    return normalized
+
+# --- Sources ---
+
+def find_session_files(sessions_dir):
+    if not os.path.isdir(sessions_dir):
+        return
+    for user_id in sorted(os.listdir(sessions_dir)):
+        user_dir = os.path.join(sessions_dir, user_id)
+        if not os.path.isdir(user_dir):
+            continue
+        filenames = set(os.listdir(user_dir))
+        for filename in sorted(filenames):
+            chat_id, ext = os.path.splitext(filename)
+            if filename.startswith('_') or ext not in ('.json', '.jsonl'):
+                continue
+            if ext == '.json' and f"{chat_id}.jsonl" in filenames:
+                continue
+            yield user_id, chat_id, os.path.join(user_dir, filename)
+
+def parse_session_file(job):
+    user_id, chat_id, path = job
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        if path.endswith('.jsonl'):
+            messages = parse_chat_log(content)
+        else:
+            messages = json.loads(content) if content else []
+    except (json.JSONDecodeError, IOError) as e:
+        return {'user_id': user_id, 'chat_id': chat_id, 'error': str(e)}
+    return {
+        'user_id': user_id,
+        'chat_id': chat_id,
+        'messages': normalize_messages(messages),
+        'updated': os.path.getmtime(path),
+    }
+
+def iter_session_chats(sessions_dir, workers):
+    jobs = find_session_files(sessions_dir)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            chunk = list(itertools.islice(jobs, workers * 256))
+            if not chunk:
+                break
+            yield from executor.map(parse_session_file, chunk, chunksize=32)
+
+def iter_legacy_db_chats(db_path, legacy_user):
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if 'chat' in tables:
+        rows = conn.execute(
+            "SELECT session_id, role, message, timestamp FROM chat ORDER BY session_id, rowid"
+        )
+    elif 'messages' in tables:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(messages)")}
+        where = "WHERE user_id IS NULL" if 'user_id' in columns else ""
+        rows = conn.execute(
+            f"SELECT session_id, role, content, ts FROM messages {where} ORDER BY session_id, id"
+        )
+    else:
+        conn.close()
+        return
+    for session_id, group in itertools.groupby(rows, key=lambda row: row[0]):
+        group = list(group)
+        yield {
+            'user_id': legacy_user,
+            'chat_id': session_id,
+            'messages': normalize_messages([{'role': row[1], 'content': row[2]} for row in group]),
+            'updated': max(parse_timestamp(row[3]) for row in group),
+        }
+    conn.close()
+
+# --- Import ---
+
+def load_state(path):
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {'completed_sources': []}
+
+def save_state(path, state):
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_path, path)
+
+def import_source(store, chats, args, totals, expected):
+    batch, batch_messages = [], 0
+
+    def flush():
+        nonlocal batch, batch_messages
+        if batch and not args.dry_run:
+            totals['imported'] += store.import_chats(batch)
+        batch, batch_messages = [], 0
+
+    for chat in chats:
+        if 'error' in chat:
+            totals['errors'] += 1
+            print(f"Skipping unreadable chat {chat['user_id']}/{chat['chat_id']}: {chat['error']}")
+            continue
+        totals['chats'] += 1
+        totals['messages'] += len(chat['messages'])
+        expected[(chat['user_id'], chat['chat_id'])] = len(chat['messages'])
+        batch.append(chat)
+        batch_messages += len(chat['messages'])
+        if batch_messages >= args.batch_size:
+            flush()
+            print(f"  {totals['chats']} chats, {totals['messages']} messages read, {totals['imported']} chats imported")
+    flush()
+
+def verify(store, expected):
+    mismatches = []
+    for (user_id, chat_id), count in expected.items():
+        stored = store.message_count(user_id, chat_id)
+        # A chat that kept growing after it was imported is not a mismatch.
+        if stored is None or stored < count:
+            mismatches.append((user_id, chat_id, count, stored))
+    return mismatches
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import legacy TheroGPT chat data into the current chat store.")
+    parser.add_argument('--backend', default=os.environ.get("CHAT_STORAGE_BACKEND", "file"), choices=['file', 'sqlite'])
+    parser.add_argument('--db', default=os.environ.get("CHAT_DB_PATH", "therogpt.db"), help="target database for the sqlite backend")
+    parser.add_argument('--target-sessions-dir', default='chat_sessions', help="target directory for the file backend")
+    parser.add_argument('--sessions-dir', default='chat_sessions', help="legacy per-chat JSON files to import")
+    parser.add_argument('--legacy-db', action='append', help="legacy SQLite database (repeatable); defaults to chat.db, database.db and therogpt.db")
+    parser.add_argument('--legacy-user', default='legacy', help="user that owns chats from databases without user ids")
+    parser.add_argument('--batch-size', type=int, default=5000, help="messages per import transaction")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2, help="processes used to parse chat files")
+    parser.add_argument('--state', default='migrate_state.json', help="progress file used to resume an interrupted run")
+    parser.add_argument('--index', default=os.environ.get("SEARCH_INDEX_PATH", "search_index.db"), help="search index to add imported chats to")
+    parser.add_argument('--dry-run', action='store_true', help="read and count everything without writing")
+    args = parser.parse_args(argv)
+
+    store = create_chat_store(args.backend, args.target_sessions_dir, args.db)
+    sqlite_store = unwrap_store(store, SqliteChatStore)
+    state = load_state(args.state)
+    totals = {'chats': 0, 'messages': 0, 'imported': 0, 'errors': 0}
+    expected = {}
+    started = time.time()
+
+    sources = []
+    same_dir = args.backend == 'file' and os.path.abspath(args.sessions_dir) == os.path.abspath(args.target_sessions_dir)
+    if same_dir:
+        print(f"Skipping {args.sessions_dir}: it is the target directory and upgrades its own legacy files on load")
+    else:
+        sources.append((f"sessions:{os.path.abspath(args.sessions_dir)}", lambda: iter_session_chats(args.sessions_dir, args.workers)))
+    legacy_dbs = args.legacy_db or [path for path in ('chat.db', 'database.db', 'therogpt.db') if os.path.exists(path)]
+    for db_path in legacy_dbs:
+        key = f"db:{os.path.abspath(db_path)}"
+        if sqlite_store and os.path.abspath(db_path) == os.path.abspath(args.db):
+            sources.append((key, None))
+        else:
+            sources.append((key, lambda db_path=db_path: iter_legacy_db_chats(db_path, args.legacy_user)))
+
+    for key, chats in sources:
+        if key in state['completed_sources']:
+            print(f"Already migrated {key}, skipping")
+            continue
+        print(f"Migrating {key}")
+        if chats is None:
+            # The legacy rows already live in the target database.
+            if not args.dry_run:
+                for chat_id, count in sqlite_store.adopt_orphan_messages(args.legacy_user):
+                    expected[(args.legacy_user, chat_id)] = count
+                    totals['chats'] += 1
+                    totals['messages'] += count
+                    totals['imported'] += 1
+        else:
+            import_source(store, chats(), args, totals, expected)
+        if not args.dry_run:
+            state['completed_sources'].append(key)
+            save_state(args.state, state)
+
+    elapsed = time.time() - started
+    print(f"Read {totals['chats']} chats / {totals['messages']} messages, imported {totals['imported']} chats "
+          f"in {elapsed:.1f}s ({totals['errors']} unreadable)")
+    if args.dry_run:
+        return 0
+    index_started = time.time()
+    indexed_chats, indexed_messages = ChatSearchIndex(args.index).backfill(store)
+    print(f"Indexed {indexed_messages} messages from {indexed_chats} chats for search in {time.time() - index_started:.1f}s")
+    mismatches = verify(store, expected)
+    for user_id, chat_id, count, stored in mismatches[:20]:
+        print(f"  count mismatch for {user_id}/{chat_id}: source {count}, stored {stored}")
+    if mismatches:
+        print(f"Verification failed for {len(mismatches)} chats")
+        return 1
+    print(f"Verified {len(expected)} chats")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,239 @@
+import json
+import time
+import hashlib
+import threading
+
+from storage import SqliteConnectionPool
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# --- Response Cache ---
+# Replays the stored answer when the exact same prompt (model, options and
+# messages) comes in again, e.g. onboarding questions or scripted prompts,
+# instead of paying for another generation. Entries live in SQLite so they
+# survive restarts, expire after `ttl` seconds and the least recently used
+# ones are evicted beyond `max_entries`.
+#
+# A cached answer is only a faithful replay when sampling is deterministic
+# (temperature 0 or a fixed seed); mode "always" lets the operator cache
+# sampled answers as well.
+
+MODES = ('off', 'deterministic', 'always')
+
+def is_deterministic(options):
+    return options.get('temperature') == 0 or options.get('seed') is not None
+
+def cache_key(model, options, messages):
+    trimmed = [{'role': msg['role'], 'content': msg['content'].strip()} for msg in messages]
+    payload = json.dumps([model, options, trimmed], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, db_path, mode='deterministic', ttl=86400, max_entries=10000, pool_size=2):
+        self.mode = mode if mode in MODES else 'off'
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.pool = SqliteConnectionPool(db_path, size=pool_size)
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+        with self.pool.transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    tokens INTEGER,
+                    created_at REAL NOT NULL,
+                    used_at REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_used ON responses(used_at)")
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def applies(self, options):
+        if self.mode == 'always':
+            return True
+        return self.mode == 'deterministic' and is_deterministic(options)
+
+    def get(self, key):
+        """Returns {'content', 'tokens'} for a live entry, or None."""
+        now = time.time()
+        with self.pool.transaction() as conn:
+            row = conn.execute(
+                "SELECT content, tokens, created_at FROM responses WHERE key = ?", (key,),
+            ).fetchone()
+            if row is not None and now - row['created_at'] > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                conn.execute("UPDATE responses SET used_at = ?, hits = hits + 1 WHERE key = ?", (now, key))
+        self.count('hits' if row is not None else 'misses')
+        return {'content': row['content'], 'tokens': row['tokens']} if row is not None else None
+
+    def put(self, key, model, content, tokens=None):
+        now = time.time()
+        with self.pool.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, content, tokens, created_at, used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, content, tokens, now, now),
+            )
+            evicted = conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)).rowcount
+            excess = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+            if excess > 0:
+                evicted += conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used_at LIMIT ?)",
+                    (excess,),
+                ).rowcount
+        with self.lock:
+            self.counters['stored'] += 1
+            self.counters['evicted'] += evicted
+
+    def stats(self):
+        with self.pool.connection() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        with self.lock:
+            counters = dict(self.counters)
+        lookups = counters['hits'] + counters['misses']
+        return dict(
+            counters,
+            mode=self.mode,
+            entries=entries,
+            ttl=self.ttl,
+            max_entries=self.max_entries,
+            hit_rate=round(counters['hits'] / lookups, 4) if lookups else None,
+        )
+
+
+# --- Semantic Cache ---
+# Exact matching misses paraphrases ("what's the capital of France" vs
+# "capital of france?"). Standalone questions are embedded with the Ollama
+# embedding model and compared against the questions answered before; above
+# `threshold` cosine similarity the earlier answer is reused. The index is an
+# in-process brute-force NumPy matrix of unit vectors, which is fast enough
+# for a few thousand entries; past `max_entries` the least recently used are
+# evicted. Answers are only shared within a scope (model, options and system
+# prompt, and the server adds the user unless SEMANTIC_CACHE_SHARED is set).
+# Needs NumPy; without it the cache stays disabled.
+
+class SemanticCache:
+    def __init__(self, client_factory, model, threshold=0.92, ttl=86400, max_entries=5000, metrics=None):
+        self.client_factory = client_factory
+        self.model = model
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.metrics = metrics
+        self.enabled = np is not None
+        if not self.enabled:
+            print("NumPy is not installed; the semantic response cache is disabled")
+        # Row i of `vectors` and `scope_ids` belongs to entries[i].
+        self.vectors = None
+        self.scope_ids = None
+        self.scopes = {}
+        self.entries = []
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0, 'embed_errors': 0}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def embed(self, text):
+        started = time.time()
+        try:
+            response = self.client_factory().embed(model=self.model, input=text)
+        except Exception as e:
+            self.count('embed_errors')
+            print(f"Error embedding question for the semantic cache: {e}")
+            return None
+        if self.metrics:
+            self.metrics.record('semantic_cache.embed_ms', (time.time() - started) * 1000)
+        vector = np.asarray(response['embeddings'][0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def lookup(self, scope, question):
+        """Returns (cached answer or None, question vector to store the new answer under)."""
+        vector = self.embed(question.strip())
+        if vector is None:
+            return None, None
+        now = time.time()
+        with self.lock:
+            rows = len(self.entries)
+            scope_id = self.scopes.get(scope)
+            entry = None
+            if rows and scope_id is not None and vector.shape[0] == self.vectors.shape[1]:
+                scores = self.vectors[:rows] @ vector
+                scores[self.scope_ids[:rows] != scope_id] = -1.0
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold and now - self.entries[best]['created_at'] <= self.ttl:
+                    entry = self.entries[best]
+                    entry['used_at'] = now
+                    similarity = float(scores[best])
+            self.counters['hits' if entry else 'misses'] += 1
+        if entry is None:
+            return None, vector
+        if self.metrics:
+            self.metrics.record('semantic_cache.hit_similarity', similarity)
+        print(f"Semantic cache hit ({similarity:.3f}): {question[:60]!r} ~ {entry['question'][:60]!r}")
+        return {'content': entry['content'], 'tokens': entry['tokens']}, vector
+
+    def put(self, scope, vector, question, content, tokens=None):
+        now = time.time()
+        with self.lock:
+            if self.vectors is None or self.vectors.shape[1] != vector.shape[0]:
+                # First entry, or the embedding model changed.
+                self.vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+                self.scope_ids = np.zeros(self.max_entries, dtype=np.int32)
+                self.entries = []
+            self.evict(now)
+            row = len(self.entries)
+            self.vectors[row] = vector
+            self.scope_ids[row] = self.scopes.setdefault(scope, len(self.scopes))
+            self.entries.append({
+                'question': question, 'content': content, 'tokens': tokens,
+                'created_at': now, 'used_at': now,
+            })
+            self.counters['stored'] += 1
+
+    def evict(self, now):
+        # Descending, so the row swapped into a freed slot was already checked.
+        for row in range(len(self.entries) - 1, -1, -1):
+            if now - self.entries[row]['created_at'] > self.ttl:
+                self.remove_row(row)
+        if len(self.entries) >= self.max_entries:
+            self.remove_row(min(range(len(self.entries)), key=lambda row: self.entries[row]['used_at']))
+
+    def remove_row(self, row):
+        last = len(self.entries) - 1
+        if row != last:
+            self.vectors[row] = self.vectors[last]
+            self.scope_ids[row] = self.scope_ids[last]
+            self.entries[row] = self.entries[last]
+        self.entries.pop()
+        self.counters['evicted'] += 1
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+            entries = len(self.entries)
+        lookups = counters['hits'] + counters['misses']
+        return dict(
+            counters,
+            enabled=self.enabled,
+            model=self.model,
+            threshold=self.threshold,
+            entries=entries,
+            max_entries=self.max_entries,
+            hit_rate=round(counters['hits'] / lookups, 4) if lookups else None,
+            timings=self.metrics.snapshot('semantic_cache.') if self.metrics else None,
+        )
@@ -0,0 +1,188 @@
+import time
+import threading
+from collections import OrderedDict, deque
+
+# --- Generation Scheduler ---
+# Admission control in front of Ollama. At most `max_concurrent` generations
+# run at once (further capped at `per_backend` times the number of healthy
+# backends); the rest wait in per-user queues that are served round-robin, so
+# one user's burst of tabs cannot push everyone else back. Interactive work is
+# always served before batch work. Each user may only have a few requests
+# waiting and nobody waits longer than `max_wait`; beyond that requests are
+# turned away immediately, which keeps queueing delay bounded under overload.
+
+PRIORITIES = ('interactive', 'batch')
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class Ticket:
+    def __init__(self, user_id, priority, on_position):
+        self.user_id = user_id
+        self.priority = priority
+        self.on_position = on_position
+        self.enqueued_at = time.time()
+        self.granted = threading.Event()
+        self.released = False
+        self.position = None
+
+
+class GenerationScheduler:
+    def __init__(self, max_concurrent=4, per_backend=2, healthy_backends=None,
+                 max_queued_per_user=3, max_wait=120, metrics=None):
+        self.max_concurrent = max_concurrent
+        self.per_backend = per_backend
+        self.healthy_backends = healthy_backends or (lambda: 1)
+        self.max_queued_per_user = max_queued_per_user
+        self.max_wait = max_wait
+        self.metrics = metrics
+        self.active = 0
+        # priority -> user_id -> deque of tickets; dict order is the
+        # round-robin order of users with something waiting.
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self.lock = threading.Lock()
+        self.counters = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timed_out': 0, 'cancelled': 0}
+
+    def capacity(self):
+        return max(1, min(self.max_concurrent, self.per_backend * max(1, self.healthy_backends())))
+
+    def queued_count(self):
+        return sum(len(tickets) for users in self.queues.values() for tickets in users.values())
+
+    def service_order(self):
+        # The order tickets would be granted in if nothing else arrived.
+        order = []
+        for priority in PRIORITIES:
+            pending = [list(tickets) for tickets in self.queues[priority].values()]
+            while pending:
+                for tickets in pending:
+                    order.append(tickets.pop(0))
+                pending = [tickets for tickets in pending if tickets]
+        return order
+
+    def next_ticket(self):
+        for priority in PRIORITIES:
+            users = self.queues[priority]
+            if users:
+                user_id, tickets = next(iter(users.items()))
+                ticket = tickets.popleft()
+                # Rotate the user to the back so the next grant goes to someone else.
+                del users[user_id]
+                if tickets:
+                    users[user_id] = tickets
+                return ticket
+        return None
+
+    def remove(self, ticket):
+        users = self.queues[ticket.priority]
+        tickets = users.get(ticket.user_id)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del users[ticket.user_id]
+            return True
+        return False
+
+    def dispatch(self):
+        """Grants free slots to waiting tickets; returns position updates to send."""
+        while self.active < self.capacity():
+            ticket = self.next_ticket()
+            if ticket is None:
+                break
+            self.active += 1
+            ticket.granted.set()
+            self.counters['admitted'] += 1
+            self.record_wait(ticket)
+        updates = []
+        order = self.service_order()
+        for position, ticket in enumerate(order, 1):
+            if ticket.position != position and ticket.on_position:
+                updates.append((ticket, position, len(order)))
+            ticket.position = position
+        return updates
+
+    def notify(self, updates):
+        for ticket, position, total in updates:
+            try:
+                ticket.on_position(position, total)
+            except Exception as e:
+                print(f"Error sending queue position: {e}")
+
+    def enqueue(self, user_id, priority='interactive', on_position=None):
+        """Asks for a generation slot. Returns a ticket (granted straight away if
+        a slot is free) to wait() on and release, or raises AdmissionRejected."""
+        if priority not in self.queues:
+            priority = 'interactive'
+        ticket = Ticket(user_id, priority, on_position)
+        with self.lock:
+            if self.active < self.capacity() and not self.queued_count():
+                self.active += 1
+                ticket.granted.set()
+                self.counters['admitted'] += 1
+                self.record_wait(ticket)
+                return ticket
+            waiting = sum(len(users.get(user_id, ())) for users in self.queues.values())
+            if waiting >= self.max_queued_per_user:
+                self.counters['rejected'] += 1
+                raise AdmissionRejected("You already have several messages waiting; please wait for them to finish.")
+            self.queues[priority].setdefault(user_id, deque()).append(ticket)
+            self.counters['queued'] += 1
+            updates = self.dispatch()
+        self.notify(updates)
+        return ticket
+
+    def wait(self, ticket, cancelled=None):
+        """Blocks until `ticket` is granted. Returns it, None if `cancelled()`
+        became true while waiting, or raises AdmissionRejected once the ticket
+        has waited `max_wait` since it was enqueued."""
+        if ticket.granted.is_set():
+            return ticket
+        deadline = ticket.enqueued_at + self.max_wait
+        while not ticket.granted.wait(0.5):
+            expired = time.time() >= deadline
+            if not expired and not (cancelled and cancelled()):
+                continue
+            with self.lock:
+                if ticket.granted.is_set():
+                    break
+                self.remove(ticket)
+                ticket.released = True
+                self.counters['timed_out' if expired else 'cancelled'] += 1
+                updates = self.dispatch()
+            self.notify(updates)
+            if expired:
+                raise AdmissionRejected("The server is busy right now; please try again in a moment.")
+            return None
+        return ticket
+
+    def acquire(self, user_id, priority='interactive', on_position=None, cancelled=None):
+        """enqueue() and wait() in one go."""
+        return self.wait(self.enqueue(user_id, priority, on_position), cancelled)
+
+    def release(self, ticket):
+        """Gives back a granted slot, or withdraws a ticket that is still waiting."""
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if self.remove(ticket):
+                self.counters['cancelled'] += 1
+            else:
+                self.active -= 1
+            updates = self.dispatch()
+        self.notify(updates)
+
+    def record_wait(self, ticket):
+        if self.metrics:
+            self.metrics.record(f"scheduler.{ticket.priority}.wait_ms", (time.time() - ticket.enqueued_at) * 1000)
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                self.counters,
+                active=self.active,
+                capacity=self.capacity(),
+                waiting={priority: sum(len(t) for t in users.values()) for priority, users in self.queues.items()},
+                wait_ms=self.metrics.snapshot('scheduler.') if self.metrics else None,
+            )
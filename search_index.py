@@ -0,0 +1,197 @@
+import os
+import re
+import sys
+import html
+import time
+import hashlib
+import argparse
+
+from storage import SqliteConnectionPool, create_chat_store
+
+# --- Chat Search Index ---
+# A SQLite FTS5 index over every stored message, kept in its own database so
+# it works the same with either chat storage backend. `indexed_messages` maps
+# FTS rowids back to (user, chat, message id) and records how far each chat
+# has been indexed, so saves only add the messages that are new. Chats that
+# reach the store without a save (imports, migrations) are picked up by
+# backfill(), which the server runs at startup and migrate.py after importing.
+#
+# Rebuild from scratch with:  python search_index.py rebuild
+
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'
+
+def user_key(user_id):
+    # User ids contain separators the tokenizer would split on; a single
+    # hashed token makes the per-user filter an exact match.
+    return 'u' + hashlib.sha1(user_id.encode('utf-8')).hexdigest()[:20]
+
+def build_match_query(user_id, query):
+    terms = re.findall(r'\w+', query)
+    if not terms:
+        return None
+    phrases = ' '.join(f'"{term}"' for term in terms[:-1])
+    phrases = f'{phrases} "{terms[-1]}"*'.strip()
+    return f'user_key : "{user_key(user_id)}" AND content : ({phrases})'
+
+def render_snippet(snippet):
+    escaped = html.escape(snippet)
+    return escaped.replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+
+
+class ChatSearchIndex:
+    def __init__(self, db_path, pool_size=2):
+        self.pool = SqliteConnectionPool(db_path, size=pool_size)
+        self.init_schema()
+
+    def init_schema(self):
+        with self.pool.transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS indexed_messages (
+                    rowid INTEGER PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    chat_id TEXT NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    role TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_indexed_messages_chat ON indexed_messages(user_id, chat_id, message_id)")
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS message_fts
+                USING fts5(content, user_key, tokenize = 'porter unicode61')
+            """)
+
+    def insert_messages(self, conn, user_id, chat_id, messages):
+        key = user_key(user_id)
+        for msg in messages:
+            if msg['role'] not in ('user', 'assistant') or not msg.get('content'):
+                continue
+            rowid = conn.execute(
+                "INSERT INTO indexed_messages (user_id, chat_id, message_id, role) VALUES (?, ?, ?, ?)",
+                (user_id, chat_id, msg['id'], msg['role']),
+            ).lastrowid
+            conn.execute(
+                "INSERT INTO message_fts (rowid, content, user_key) VALUES (?, ?, ?)",
+                (rowid, msg['content'], key),
+            )
+
+    def delete_chat_rows(self, conn, user_id, chat_id):
+        conn.execute(
+            "DELETE FROM message_fts WHERE rowid IN "
+            "(SELECT rowid FROM indexed_messages WHERE user_id = ? AND chat_id = ?)",
+            (user_id, chat_id),
+        )
+        conn.execute("DELETE FROM indexed_messages WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+
+    def index_chat(self, user_id, chat_id, messages):
+        with self.pool.transaction() as conn:
+            last_id = conn.execute(
+                "SELECT MAX(message_id) FROM indexed_messages WHERE user_id = ? AND chat_id = ?",
+                (user_id, chat_id),
+            ).fetchone()[0] or 0
+            if messages and messages[-1]['id'] < last_id:
+                # The history was rewritten; start this chat over.
+                self.delete_chat_rows(conn, user_id, chat_id)
+                last_id = 0
+            self.insert_messages(conn, user_id, chat_id, [msg for msg in messages if msg['id'] > last_id])
+
+    def remove_chat(self, user_id, chat_id):
+        with self.pool.transaction() as conn:
+            self.delete_chat_rows(conn, user_id, chat_id)
+
+    def search(self, user_id, query, limit=20):
+        match = build_match_query(user_id, query)
+        if match is None:
+            return []
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT m.chat_id, m.message_id, m.role, bm25(message_fts) AS score, "
+                "snippet(message_fts, 0, ?, ?, '…', 16) AS snippet "
+                "FROM message_fts JOIN indexed_messages m ON m.rowid = message_fts.rowid "
+                "WHERE message_fts MATCH ? ORDER BY rank LIMIT ?",
+                (SNIPPET_START, SNIPPET_END, match, limit * 5),
+            ).fetchall()
+        # One hit per chat, best first.
+        results, seen = [], set()
+        for row in rows:
+            if row['chat_id'] in seen:
+                continue
+            seen.add(row['chat_id'])
+            results.append({
+                'chatId': row['chat_id'],
+                'messageId': row['message_id'],
+                'role': row['role'],
+                'snippet': render_snippet(row['snippet']),
+                'score': round(-row['score'], 4),
+            })
+            if len(results) >= limit:
+                break
+        return results
+
+    def rebuild(self, store):
+        with self.pool.transaction() as conn:
+            conn.execute("DELETE FROM indexed_messages")
+            conn.execute("DELETE FROM message_fts")
+        chats = messages = 0
+        for user_id in store.list_users():
+            user_chats, _ = store.list_chats(user_id)
+            with self.pool.transaction() as conn:
+                for chat in user_chats:
+                    chat_messages = store.export_messages(user_id, chat['id'])
+                    self.insert_messages(conn, user_id, chat['id'], chat_messages)
+                    chats += 1
+                    messages += len(chat_messages)
+        with self.pool.connection() as conn:
+            conn.execute("INSERT INTO message_fts (message_fts) VALUES ('optimize')")
+        return chats, messages
+
+    def backfill(self, store):
+        """Indexes stored chats that have nothing in the index yet; returns (chats, messages)."""
+        with self.pool.connection() as conn:
+            indexed = {
+                (row['user_id'], row['chat_id'])
+                for row in conn.execute("SELECT DISTINCT user_id, chat_id FROM indexed_messages")
+            }
+        chats = messages = 0
+        for user_id in store.list_users():
+            user_chats, _ = store.list_chats(user_id)
+            for chat in user_chats:
+                if not chat['count'] or (user_id, chat['id']) in indexed:
+                    continue
+                chat_messages = store.export_messages(user_id, chat['id'])
+                with self.pool.transaction() as conn:
+                    # A save may have indexed the chat since the scan above.
+                    if conn.execute(
+                        "SELECT 1 FROM indexed_messages WHERE user_id = ? AND chat_id = ? LIMIT 1",
+                        (user_id, chat['id']),
+                    ).fetchone():
+                        continue
+                    self.insert_messages(conn, user_id, chat['id'], chat_messages)
+                chats += 1
+                messages += len(chat_messages)
+                time.sleep(0)
+        return chats, messages
+
+    def stats(self):
+        with self.pool.connection() as conn:
+            indexed = conn.execute("SELECT COUNT(*) FROM indexed_messages").fetchone()[0]
+        return {'indexed_messages': indexed}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the TheroGPT chat search index.")
+    parser.add_argument('command', choices=['rebuild', 'backfill'])
+    parser.add_argument('--backend', default=os.environ.get("CHAT_STORAGE_BACKEND", "file"), choices=['file', 'sqlite'])
+    parser.add_argument('--db', default=os.environ.get("CHAT_DB_PATH", "therogpt.db"))
+    parser.add_argument('--sessions-dir', default='chat_sessions')
+    parser.add_argument('--index', default=os.environ.get("SEARCH_INDEX_PATH", "search_index.db"))
+    args = parser.parse_args(argv)
+
+    store = create_chat_store(args.backend, args.sessions_dir, args.db)
+    index = ChatSearchIndex(args.index)
+    started = time.time()
+    chats, messages = index.rebuild(store) if args.command == 'rebuild' else index.backfill(store)
+    print(f"Indexed {messages} messages from {chats} chats in {time.time() - started:.1f}s")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
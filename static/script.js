@@ -7,6 +7,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const newChatBtn = document.getElementById('new-chat-btn');
     const chatList = document.getElementById('chat-list');
     const internetSearchToggle = document.getElementById('internet-search-toggle');
+    const chatSearch = document.getElementById('chat-search');
+    const searchResults = document.getElementById('search-results');
     const converter = new showdown.Converter({
         omitExtraWLInCodeBlocks: true,
         simplifiedAutoLink: true,
@@ -25,6 +27,57 @@ document.addEventListener('DOMContentLoaded', () => {
     let currentChatId = null;
     let currentResponseContent = '';
     let isResponding = false;
+    let chatListCursor = null;
+    let oldestMessageId = null;
+    let historyHasMore = false;
+    let isLoadingHistory = false;
+    let isLoadingChats = false;
+    let searchTimer = null;
+    let rttMs = null;
+    let currentGenerationId = null;
+    let receivedChars = 0;
+    let continuingElement = null;
+
+    // --- Local History Cache ---
+    // Chat histories are kept in IndexedDB with the (epoch, version) the
+    // server sent, so opening a chat or reconnecting only asks for changes.
+    const historyDb = new Promise((resolve) => {
+        if (!window.indexedDB) {
+            resolve(null);
+            return;
+        }
+        const request = indexedDB.open('therogpt', 1);
+        request.onupgradeneeded = () => request.result.createObjectStore('histories', { keyPath: 'key' });
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => resolve(null);
+    });
+
+    function historyStore(mode, action) {
+        return historyDb.then(db => new Promise((resolve) => {
+            if (!db) {
+                resolve(null);
+                return;
+            }
+            const request = action(db.transaction('histories', mode).objectStore('histories'));
+            request.onsuccess = () => resolve(request.result || null);
+            request.onerror = () => resolve(null);
+        }));
+    }
+
+    const getCachedHistory = (chatId) => historyStore('readonly', store => store.get(`${userId}:${chatId}`));
+    const putCachedHistory = (entry) => historyStore('readwrite', store => store.put({ ...entry, key: `${userId}:${entry.chatId}` }));
+    const deleteCachedHistory = (chatId) => historyStore('readwrite', store => store.delete(`${userId}:${chatId}`));
+
+    function syncChat(chatId, fetchIfMissing = true) {
+        return getCachedHistory(chatId).then(cached => {
+            if (cached) {
+                socket.emit('sync_history', { userId, chatId, epoch: cached.epoch, version: cached.version });
+            } else if (fetchIfMissing) {
+                socket.emit('get_history', { userId, chatId });
+            }
+            return cached;
+        });
+    }
 
     // --- UI State Management ---
     function setRespondingState(responding) {
@@ -58,15 +111,21 @@ document.addEventListener('DOMContentLoaded', () => {
             if (isResponding) return;
             currentChatId = chat.id;
             currentResponseContent = '';
+            oldestMessageId = null;
+            historyHasMore = false;
             chatWindow.innerHTML = '';
-            socket.emit('get_history', { userId, chatId: chat.id });
+            syncChat(chat.id).then(cached => {
+                if (cached && currentChatId === chat.id) {
+                    renderHistory(cached);
+                }
+            });
             document.querySelectorAll('.chat-item').forEach(el => el.classList.remove('active'));
             chatElement.classList.add('active');
         });
         return chatElement;
     }
 
-    function appendMessage(sender, text, isStreaming = false) {
+    function createMessageElement(sender, text, isStreaming = false, interrupted = false) {
         const messageElement = document.createElement('div');
         messageElement.classList.add('message', sender);
         if (isStreaming) {
@@ -80,33 +139,99 @@ document.addEventListener('DOMContentLoaded', () => {
             contentElement.textContent = text;
         }
         messageElement.appendChild(contentElement);
-        chatWindow.appendChild(messageElement);
+        if (interrupted) {
+            // The server restarted before this reply finished.
+            const continueBtn = document.createElement('button');
+            continueBtn.classList.add('continue-btn');
+            continueBtn.textContent = 'Continue';
+            messageElement.appendChild(continueBtn);
+        }
+        return messageElement;
+    }
+
+    function appendMessage(sender, text, isStreaming = false, interrupted = false) {
+        chatWindow.appendChild(createMessageElement(sender, text, isStreaming, interrupted));
         chatWindow.scrollTop = chatWindow.scrollHeight;
     }
 
+    function prependMessages(messages) {
+        const previousHeight = chatWindow.scrollHeight;
+        const fragment = document.createDocumentFragment();
+        messages.forEach(message => {
+            fragment.appendChild(createMessageElement(message.role, message.content, false, message.interrupted));
+        });
+        chatWindow.prepend(fragment);
+        chatWindow.scrollTop += chatWindow.scrollHeight - previousHeight;
+    }
+
+    function renderHistory(entry) {
+        historyHasMore = entry.hasMore;
+        oldestMessageId = entry.messages.length > 0 ? entry.messages[0].id : null;
+        chatWindow.innerHTML = '';
+        entry.messages.forEach(message => {
+            appendMessage(message.role, message.content, false, message.interrupted);
+        });
+    }
+
+    function isOtherGeneration(data) {
+        // Replies stream to everyone viewing the chat; follow only our own.
+        return data.generationId !== undefined && data.generationId !== currentGenerationId;
+    }
+
+    function startGeneration() {
+        setRespondingState(true);
+        showThinkingIndicator(true);
+        currentGenerationId = 'gen_' + Date.now().toString(36) + Math.random().toString(36).substr(2, 9);
+        receivedChars = 0;
+        return currentGenerationId;
+    }
+
     function sendMessage() {
         const message = messageInput.value.trim();
         if (message && !isResponding) {
             appendMessage('user', message);
-            setRespondingState(true);
-            showThinkingIndicator(true);
+            chatWindow.lastElementChild.classList.add('local');
             socket.emit('message', { 
                 userId, 
                 chatId: currentChatId, 
+                generationId: startGeneration(),
                 message,
-                useInternet: internetSearchToggle.checked
+                useInternet: internetSearchToggle.checked,
+                rttMs
             });
             messageInput.value = '';
             messageInput.style.height = 'auto';
         }
     }
 
+    function continueReply(messageElement) {
+        if (isResponding) return;
+        // Only the last reply can be continued, and it stays on screen until
+        // the continued reply streams in again from its saved beginning.
+        const messages = chatWindow.querySelectorAll('.message:not(.thinking-indicator)');
+        if (messageElement !== messages[messages.length - 1]) return;
+        continuingElement = messageElement;
+        socket.emit('message', {
+            userId,
+            chatId: currentChatId,
+            generationId: startGeneration(),
+            continue: true,
+            rttMs
+        });
+    }
+
     // --- Event Listeners ---
     sendBtn.addEventListener('click', sendMessage);
 
     stopBtn.addEventListener('click', () => {
         if (isResponding) {
-            socket.emit('stop_generation', { userId, chatId: currentChatId });
+            socket.emit('stop_generation', { userId, chatId: currentChatId, generationId: currentGenerationId });
+        }
+    });
+
+    chatWindow.addEventListener('click', (event) => {
+        if (event.target.classList.contains('continue-btn')) {
+            continueReply(event.target.closest('.message'));
         }
     });
 
@@ -122,22 +247,81 @@ document.addEventListener('DOMContentLoaded', () => {
         messageInput.style.height = (messageInput.scrollHeight) + 'px';
     });
 
+    chatSearch.addEventListener('input', () => {
+        clearTimeout(searchTimer);
+        const query = chatSearch.value.trim();
+        if (!query) {
+            searchResults.style.display = 'none';
+            chatList.style.display = '';
+            return;
+        }
+        searchTimer = setTimeout(() => socket.emit('search_chats', { userId, query }), 200);
+    });
+
+    chatWindow.addEventListener('scroll', () => {
+        if (chatWindow.scrollTop < 100 && historyHasMore && !isLoadingHistory && currentChatId) {
+            isLoadingHistory = true;
+            socket.emit('get_history', { userId, chatId: currentChatId, before: oldestMessageId });
+        }
+    });
+
+    chatList.addEventListener('scroll', () => {
+        const nearBottom = chatList.scrollTop + chatList.clientHeight >= chatList.scrollHeight - 50;
+        if (nearBottom && chatListCursor && !isLoadingChats) {
+            isLoadingChats = true;
+            socket.emit('get_chats', { userId, cursor: chatListCursor });
+        }
+    });
+
     newChatBtn.addEventListener('click', () => {
         if (isResponding) return;
         socket.emit('new_chat', { userId });
     });
 
+    // --- Latency Probe ---
+    // The server batches streamed tokens into frames spaced by our round-trip
+    // time, so measure it now and then and send it along with messages.
+    function probeLatency() {
+        if (!socket.connected) return;
+        const sentAt = performance.now();
+        socket.emit('latency_probe', {}, () => {
+            const sample = performance.now() - sentAt;
+            rttMs = rttMs === null ? sample : Math.round(0.7 * rttMs + 0.3 * sample);
+        });
+    }
+    setInterval(probeLatency, 30000);
+
     // --- Socket.IO Handlers ---
     socket.on('connect', () => {
         console.log('Connected to server');
+        probeLatency();
+        if (isResponding && currentGenerationId) {
+            // Pick the answer up where the dropped connection left it.
+            socket.emit('resume_generation', {
+                userId,
+                chatId: currentChatId,
+                generationId: currentGenerationId,
+                offset: receivedChars
+            });
+        }
         socket.emit('get_chats', { userId });
+        if (currentChatId && !isResponding) {
+            syncChat(currentChatId);
+        }
     });
 
     socket.on('chat_list', (data) => {
-        chatList.innerHTML = '';
+        isLoadingChats = false;
+        chatListCursor = data.nextCursor;
+        if (!data.append) {
+            chatList.innerHTML = '';
+        }
         data.chats.forEach(chat => {
-            chatList.appendChild(createChatElement(chat));
+            if (!chatList.querySelector(`.chat-item[data-chat-id="${chat.id}"]`)) {
+                chatList.appendChild(createChatElement(chat));
+            }
         });
+        if (data.append) return;
         if (!currentChatId && data.chats.length > 0) {
             chatList.children[0].click();
         } else if (currentChatId) {
@@ -154,31 +338,118 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     socket.on('chat_history', (data) => {
-        chatWindow.innerHTML = '';
-        data.history.forEach(message => {
-            appendMessage(message.role, message.content);
+        if (data.chatId !== currentChatId) return;
+        isLoadingHistory = false;
+        if (data.prepend) {
+            historyHasMore = data.hasMore;
+            if (data.history.length > 0) {
+                oldestMessageId = data.history[0].id;
+            }
+            prependMessages(data.history);
+            getCachedHistory(data.chatId).then(cached => {
+                if (cached) {
+                    putCachedHistory({ ...cached, hasMore: data.hasMore, messages: data.history.concat(cached.messages) });
+                }
+            });
+            return;
+        }
+        const entry = { chatId: data.chatId, epoch: data.epoch, version: data.version, hasMore: data.hasMore, messages: data.history };
+        renderHistory(entry);
+        putCachedHistory(entry);
+    });
+
+    socket.on('chat_sync', (data) => {
+        if (data.mode === 'deleted') {
+            deleteCachedHistory(data.chatId);
+            const chatElement = document.querySelector(`.chat-item[data-chat-id="${data.chatId}"]`);
+            if (chatElement) chatElement.remove();
+            if (data.chatId === currentChatId) {
+                currentChatId = null;
+                chatWindow.innerHTML = '';
+            }
+            return;
+        }
+        if (data.mode === 'current') return;
+        if (data.mode === 'reset') {
+            const entry = { chatId: data.chatId, epoch: data.epoch, version: data.version, hasMore: data.hasMore, messages: data.history };
+            putCachedHistory(entry);
+            if (data.chatId === currentChatId && !isResponding) {
+                renderHistory(entry);
+            }
+            return;
+        }
+        getCachedHistory(data.chatId).then(cached => {
+            if (!cached) return;
+            putCachedHistory({ ...cached, version: data.version, messages: cached.messages.concat(data.history) });
+            if (data.chatId !== currentChatId || isResponding || data.history.length === 0) return;
+            // Messages sent and streamed in this tab are already on screen;
+            // only re-render when the server has something different.
+            const localMessages = chatWindow.querySelectorAll('.message.local');
+            if (localMessages.length === data.history.length) {
+                localMessages.forEach(el => el.classList.remove('local'));
+                return;
+            }
+            localMessages.forEach(el => el.remove());
+            data.history.forEach(message => {
+                appendMessage(message.role, message.content, false, message.interrupted);
+            });
         });
     });
 
     socket.on('response', (data) => {
-        if (data.chatId !== currentChatId) return;
+        if (data.chatId !== currentChatId || isOtherGeneration(data)) return;
+
+        let content = data.content;
+        if (data.offset !== undefined) {
+            // Offsets count code points; skip anything a replay repeats.
+            const chars = [...content];
+            if (chars.length && data.offset + chars.length <= receivedChars) return;
+            content = chars.slice(Math.max(0, receivedChars - data.offset)).join('');
+            receivedChars = data.offset + chars.length;
+        }
 
         if (data.first_chunk) {
             showThinkingIndicator(false);
+            if (continuingElement) {
+                continuingElement.remove();
+                continuingElement = null;
+            }
             currentResponseContent = '';
             appendMessage('assistant', '...', true);
+            chatWindow.lastElementChild.classList.add('local');
         }
         
         const lastMessage = chatWindow.querySelector('.message.assistant.streaming div');
         if (lastMessage) {
-            currentResponseContent += data.content;
+            currentResponseContent += content;
             lastMessage.innerHTML = converter.makeHtml(currentResponseContent);
             chatWindow.scrollTop = chatWindow.scrollHeight;
         }
     });
 
+    socket.on('queue_position', (data) => {
+        if (data.chatId !== currentChatId || isOtherGeneration(data)) return;
+        const indicator = chatWindow.querySelector('.thinking-indicator');
+        if (indicator) {
+            indicator.textContent = `Waiting for a free slot (${data.position} of ${data.queued} in line)...`;
+        }
+    });
+
+    socket.on('generation_started', (data) => {
+        if (data.chatId === currentChatId) {
+            currentGenerationId = data.generationId;
+        }
+    });
+
     socket.on('response_end', (data) => {
+        if (data.chatId === currentChatId && isOtherGeneration(data)) {
+            // Another tab's reply in this chat finished; pick it up.
+            if (!isResponding) syncChat(data.chatId, false);
+            return;
+        }
         if (data.chatId === currentChatId) {
+            currentGenerationId = null;
+            continuingElement = null;
             const lastMessage = chatWindow.querySelector('.message.assistant.streaming');
             if (lastMessage) {
                 lastMessage.classList.remove('streaming');
@@ -191,9 +462,44 @@ document.addEventListener('DOMContentLoaded', () => {
                 }
             }
             setRespondingState(false);
+            syncChat(data.chatId, false);
         }
     });
 
+    socket.on('search_results', (data) => {
+        if (data.query !== chatSearch.value.trim()) return;
+        searchResults.innerHTML = '';
+        if (data.results.length === 0) {
+            const emptyElement = document.createElement('div');
+            emptyElement.classList.add('search-result');
+            emptyElement.textContent = 'No matching chats';
+            searchResults.appendChild(emptyElement);
+        }
+        data.results.forEach(result => {
+            const chatElement = document.querySelector(`.chat-item[data-chat-id="${result.chatId}"]`);
+            const resultElement = document.createElement('div');
+            resultElement.classList.add('search-result');
+            const titleElement = document.createElement('div');
+            titleElement.classList.add('search-result-title');
+            titleElement.textContent = chatElement ? chatElement.textContent : 'Chat';
+            const snippetElement = document.createElement('div');
+            snippetElement.innerHTML = result.snippet;
+            resultElement.append(titleElement, snippetElement);
+            resultElement.addEventListener('click', () => {
+                if (isResponding) return;
+                chatSearch.value = '';
+                searchResults.style.display = 'none';
+                chatList.style.display = '';
+                const target = document.querySelector(`.chat-item[data-chat-id="${result.chatId}"]`)
+                    || chatList.appendChild(createChatElement({ id: result.chatId, title: 'Chat' }));
+                target.click();
+            });
+            searchResults.appendChild(resultElement);
+        });
+        chatList.style.display = 'none';
+        searchResults.style.display = '';
+    });
+
     socket.on('chat_title_updated', (data) => {
         const chatElement = document.querySelector(`.chat-item[data-chat-id="${data.chatId}"]`);
         if (chatElement) {
@@ -202,7 +508,9 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     socket.on('response_error', (data) => {
+        if (isOtherGeneration(data)) return;
         showThinkingIndicator(false);
+        continuingElement = null;
         appendMessage('assistant', `Error: ${data.error}`);
         setRespondingState(false);
     });
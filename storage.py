@@ -0,0 +1,1622 @@
+import os
+import json
+import time
+import calendar
+import queue
+import sqlite3
+import zlib
+import bisect
+import zipfile
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# --- Chat Storage Backends ---
+# Stores persist the messages of a chat without the system prompt, which the
+# app injects on load. Both backends expose the same methods so app.py can
+# switch between them with CHAT_STORAGE_BACKEND.
+
+class ChatStore:
+    def load_messages(self, user_id, chat_id):
+        raise NotImplementedError
+
+    def save_messages(self, user_id, chat_id, messages):
+        raise NotImplementedError
+
+    def create_chat(self, user_id, chat_id):
+        raise NotImplementedError
+
+    def delete_chat(self, user_id, chat_id):
+        raise NotImplementedError
+
+    def list_chats(self, user_id, limit=None, cursor=None):
+        raise NotImplementedError
+
+    def load_page(self, user_id, chat_id, limit, before=None):
+        return page_messages(self.load_messages(user_id, chat_id), limit, before)
+
+    def load_since(self, user_id, chat_id, after_id):
+        return [msg for msg in self.load_messages(user_id, chat_id) if msg['id'] > after_id]
+
+    def chat_version(self, user_id, chat_id):
+        raise NotImplementedError
+
+    def run_maintenance(self, archive_after_seconds):
+        raise NotImplementedError
+
+    def message_count(self, user_id, chat_id):
+        raise NotImplementedError
+
+    def list_users(self):
+        raise NotImplementedError
+
+    def export_messages(self, user_id, chat_id):
+        # Like load_messages, but leaves archived chats where they are.
+        return self.load_messages(user_id, chat_id)
+
+    def after_persisted(self, user_id, chat_id, callback):
+        # Runs `callback` once everything saved for the chat so far is on
+        # disk; saves are synchronous unless a store says otherwise.
+        callback()
+
+    def import_chats(self, chats):
+        # Bulk load of {user_id, chat_id, messages, updated} dicts, skipping
+        # chats that already exist so imports can be re-run safely.
+        imported = 0
+        for chat in chats:
+            if self.chat_version(chat['user_id'], chat['chat_id']) is None:
+                self.create_chat(chat['user_id'], chat['chat_id'])
+                self.save_messages(chat['user_id'], chat['chat_id'], chat['messages'])
+                imported += 1
+        return imported
+
+
+# Message ids are per-chat integers that never change once assigned, which
+# lets clients page backwards with `before=<id>`. The id of the newest message
+# doubles as the chat's version; the epoch is bumped whenever a history is
+# rewritten instead of extended, telling clients to drop what they cached.
+
+def assign_message_ids(messages):
+    last_id = max((msg['id'] for msg in messages if 'id' in msg), default=0)
+    for msg in messages:
+        if 'id' not in msg:
+            last_id += 1
+            msg['id'] = last_id
+    return messages
+
+# Only these fields identify a stored message. Others are derived and may be
+# filled in after the message was saved (context.py estimates 'tokens' for
+# replies stored without one), which must not read as a rewrite.
+MESSAGE_IDENTITY_FIELDS = ('id', 'role', 'content', 'blob')
+
+def message_identity(msg):
+    return tuple(msg.get(key) for key in MESSAGE_IDENTITY_FIELDS)
+
+def tail_rewritten(messages, stored_count, stored_tail):
+    """Whether a save replaces stored messages rather than only appending to them."""
+    # Length alone misses a reply that is popped and re-appended (same count,
+    # often the same id), so the last stored message is compared as well.
+    if len(messages) < stored_count:
+        return True
+    return stored_count > 0 and (stored_tail is None
+                                 or message_identity(messages[stored_count - 1]) != message_identity(stored_tail))
+
+def page_messages(messages, limit, before=None):
+    end = len(messages)
+    if before is not None:
+        end = bisect.bisect_left([msg['id'] for msg in messages], before)
+    start = max(0, end - limit)
+    return messages[start:end], start > 0
+
+
+def parse_chat_log(text):
+    messages = []
+    for line in text.splitlines():
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if record.get('op') == 'reset':
+            messages = []
+        elif 'role' in record:
+            messages.append(record)
+    return assign_message_ids(messages)
+
+def chat_title(messages):
+    title = next((msg['content'] for msg in messages if msg['role'] == 'user'), 'New Chat')
+    return title[:50]
+
+# Chat list cursors encode the (updated, id) of the last chat on a page, so
+# pages stay stable while other chats are being touched.
+
+def encode_chat_cursor(chat):
+    return f"{chat['updated']!r}|{chat['id']}"
+
+def decode_chat_cursor(cursor):
+    updated, _, chat_id = cursor.partition('|')
+    return float(updated), chat_id
+
+def paginate_chats(chats, limit=None, cursor=None):
+    chats = sorted(chats, key=lambda c: (c['updated'], c['id']), reverse=True)
+    if cursor:
+        position = decode_chat_cursor(cursor)
+        chats = [c for c in chats if (c['updated'], c['id']) < position]
+    if limit is None or len(chats) <= limit:
+        return chats, None
+    page = chats[:limit]
+    return page, encode_chat_cursor(page[-1])
+
+
+# --- File Backend ---
+# Each chat is an append-only JSONL log: one line per message, plus an
+# occasional {"op": "reset"} record when a history is rewritten rather than
+# extended. Dead records (anything before the last reset, torn lines from a
+# crash mid-write) are dropped when the log is compacted.
+#
+# Each user directory also holds a _manifest.jsonl with one upsert or delete
+# record per change (id, title, updated, count), so the sidebar never has to
+# open the chats themselves. It is rebuilt from the chat logs if missing.
+#
+# Chats left untouched for a while are moved by run_maintenance() into a
+# deflate-compressed _archive.zip per user and restored to a hot log the next
+# time they are loaded. Entries left behind in the archive by restores and
+# deletes are purged the next time maintenance rewrites it.
+#
+# The manifest may also be appended to by another process (e.g. migrate.py
+# while the server is running); a size mismatch makes it reload from disk.
+#
+# Reads and writes of a chat log hold that chat's lock (striped over a fixed
+# set), so maintenance never compacts or archives a log while a save is
+# appending to it. A chat saved between maintenance copying it into the
+# archive and removing the hot log keeps its log; the stale archive copy is
+# purged on the next pass.
+
+MANIFEST_FILENAME = '_manifest.jsonl'
+ARCHIVE_FILENAME = '_archive.zip'
+CHAT_LOCK_STRIPES = 64
+
+def log_tail(messages):
+    # A copy, so later in-place edits of the caller's history still show up
+    # as a rewrite.
+    return dict(messages[-1]) if messages else None
+
+def file_signature(filepath):
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class FileChatStore(ChatStore):
+    def __init__(self, root_dir, compact_min_dead=50, compact_ratio=0.5):
+        self.root_dir = root_dir
+        self.compact_min_dead = compact_min_dead
+        self.compact_ratio = compact_ratio
+        self.log_state = {}
+        self.manifests = {}
+        self.manifest_records = {}
+        self.manifest_sizes = {}
+        self.chat_locks = [threading.RLock() for _ in range(CHAT_LOCK_STRIPES)]
+
+    def chat_lock(self, user_id, chat_id):
+        return self.chat_locks[hash((user_id, chat_id)) % len(self.chat_locks)]
+
+    def user_dir(self, user_id):
+        return os.path.join(self.root_dir, user_id)
+
+    def chat_filepath(self, user_id, chat_id):
+        return os.path.join(self.user_dir(user_id), f"{chat_id}.jsonl")
+
+    def legacy_chat_filepath(self, user_id, chat_id):
+        return os.path.join(self.user_dir(user_id), f"{chat_id}.json")
+
+    def read_log(self, filepath):
+        messages, records, torn = [], 0, False
+        with open(filepath, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                records += 1
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    torn = True
+                    continue
+                if record.get('op') == 'reset':
+                    messages = []
+                elif 'role' in record:
+                    messages.append(record)
+        return assign_message_ids(messages), records, torn
+
+    def write_records(self, filepath, records):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        tmp_path = f"{filepath}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+
+    def write_log(self, filepath, messages):
+        self.write_records(filepath, messages)
+        self.log_state[filepath] = {'messages': len(messages), 'records': len(messages), 'tail': log_tail(messages)}
+
+    def append_log(self, filepath, records):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        data = ''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in records).encode('utf-8')
+        with open(filepath, 'ab') as f:
+            f.write(data)
+        return len(data)
+
+    def needs_compaction(self, state):
+        dead = state['records'] - state['messages']
+        return dead >= self.compact_min_dead and dead >= state['messages'] * self.compact_ratio
+
+    def read_legacy_chat(self, legacy_path):
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+            history = json.loads(content) if content else []
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Error reading legacy chat {legacy_path}: {e}")
+            return None
+        if history and history[0].get('role') == 'system':
+            history = history[1:]
+        return assign_message_ids(history)
+
+    def upgrade_legacy_chat(self, user_id, chat_id):
+        legacy_path = self.legacy_chat_filepath(user_id, chat_id)
+        if not os.path.exists(legacy_path):
+            return
+        filepath = self.chat_filepath(user_id, chat_id)
+        if not os.path.exists(filepath):
+            history = self.read_legacy_chat(legacy_path)
+            if history is None:
+                return
+            self.write_log(filepath, history)
+            legacy_stat = os.stat(legacy_path)
+            os.utime(filepath, (legacy_stat.st_atime, legacy_stat.st_mtime))
+            print(f"Upgraded legacy chat {chat_id} to append-only log")
+        os.remove(legacy_path)
+
+    def load_messages(self, user_id, chat_id):
+        with self.chat_lock(user_id, chat_id):
+            self.upgrade_legacy_chat(user_id, chat_id)
+            filepath = self.chat_filepath(user_id, chat_id)
+            if not os.path.exists(filepath) and not self.restore_archived_chat(user_id, chat_id):
+                self.log_state.pop(filepath, None)
+                return []
+            messages, records, torn = self.read_log(filepath)
+            state = {'messages': len(messages), 'records': records, 'tail': log_tail(messages)}
+            self.log_state[filepath] = state
+            if torn or self.needs_compaction(state):
+                self.write_log(filepath, messages)
+            return messages
+
+    def save_messages(self, user_id, chat_id, messages):
+        with self.chat_lock(user_id, chat_id):
+            self.save_log(user_id, chat_id, messages)
+
+    def save_log(self, user_id, chat_id, messages):
+        # Histories mostly grow during a chat, so once the log has been read
+        # in this process only the tail past the stored count is written; a
+        # changed tail is written as a reset and the whole history.
+        assign_message_ids(messages)
+        filepath = self.chat_filepath(user_id, chat_id)
+        state = self.log_state.get(filepath)
+        if state is None:
+            stored = self.load_messages(user_id, chat_id)
+            state = self.log_state.get(filepath)
+            if state is None or list(map(message_identity, messages[:len(stored)])) != list(map(message_identity, stored)):
+                self.write_log(filepath, messages)
+                self.update_manifest(user_id, chat_id, messages, reset=True)
+                return
+        reset = tail_rewritten(messages, state['messages'], state.get('tail'))
+        if reset:
+            self.append_log(filepath, [{'op': 'reset'}] + messages)
+            state['records'] += len(messages) + 1
+            state['messages'] = len(messages)
+        elif len(messages) > state['messages']:
+            new_messages = messages[state['messages']:]
+            self.append_log(filepath, new_messages)
+            state['records'] += len(new_messages)
+            state['messages'] = len(messages)
+        state['tail'] = log_tail(messages)
+        if self.needs_compaction(state):
+            self.write_log(filepath, messages)
+        self.update_manifest(user_id, chat_id, messages, reset=reset)
+
+    def create_chat(self, user_id, chat_id):
+        with self.chat_lock(user_id, chat_id):
+            self.write_log(self.chat_filepath(user_id, chat_id), [])
+            self.update_manifest(user_id, chat_id, [], reset=True)
+
+    def delete_chat(self, user_id, chat_id):
+        with self.chat_lock(user_id, chat_id):
+            for filepath in (self.chat_filepath(user_id, chat_id), self.legacy_chat_filepath(user_id, chat_id)):
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+                self.log_state.pop(filepath, None)
+        manifest = self.load_manifest(user_id)
+        if manifest.pop(chat_id, None) is not None:
+            self.append_manifest(user_id, [{'id': chat_id, 'deleted': True}])
+
+    def manifest_filepath(self, user_id):
+        return os.path.join(self.user_dir(user_id), MANIFEST_FILENAME)
+
+    def manifest_file_size(self, user_id):
+        try:
+            return os.path.getsize(self.manifest_filepath(user_id))
+        except OSError:
+            return None
+
+    def write_manifest(self, user_id, manifest):
+        self.write_records(self.manifest_filepath(user_id), manifest.values())
+        self.manifest_records[user_id] = len(manifest)
+        self.manifest_sizes[user_id] = self.manifest_file_size(user_id)
+
+    def load_manifest(self, user_id):
+        manifest = self.manifests.get(user_id)
+        if manifest is not None and self.manifest_file_size(user_id) == self.manifest_sizes.get(user_id):
+            return manifest
+        filepath = self.manifest_filepath(user_id)
+        if not os.path.exists(filepath):
+            manifest = self.rebuild_manifest(user_id)
+        else:
+            manifest, records = {}, 0
+            with open(filepath, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    records += 1
+                    if record.get('deleted'):
+                        manifest.pop(record['id'], None)
+                    else:
+                        manifest[record['id']] = record
+            self.manifest_records[user_id] = records
+            self.manifest_sizes[user_id] = self.manifest_file_size(user_id)
+            if records > 2 * len(manifest) + self.compact_min_dead:
+                self.write_manifest(user_id, manifest)
+        self.manifests[user_id] = manifest
+        return manifest
+
+    def rebuild_manifest(self, user_id):
+        manifest = {}
+        user_dir = self.user_dir(user_id)
+        if not os.path.exists(user_dir):
+            return manifest
+        for filename in os.listdir(user_dir):
+            chat_id, ext = os.path.splitext(filename)
+            if ext not in ('.json', '.jsonl') or filename == MANIFEST_FILENAME or chat_id in manifest:
+                continue
+            updated = os.path.getmtime(os.path.join(user_dir, filename))
+            messages = self.load_messages(user_id, chat_id)
+            manifest[chat_id] = {
+                'id': chat_id,
+                'title': chat_title(messages),
+                'updated': updated,
+                'count': len(messages),
+                'epoch': 1,
+                'version': messages[-1]['id'] if messages else 0,
+            }
+        archive_path = self.archive_filepath(user_id)
+        if os.path.exists(archive_path):
+            with zipfile.ZipFile(archive_path) as archive:
+                for info in archive.infolist():
+                    chat_id = os.path.splitext(info.filename)[0]
+                    if chat_id in manifest:
+                        continue
+                    messages = parse_chat_log(archive.read(info).decode('utf-8'))
+                    manifest[chat_id] = {
+                        'id': chat_id,
+                        'title': chat_title(messages),
+                        'updated': time.mktime(info.date_time + (0, 0, -1)),
+                        'count': len(messages),
+                        'epoch': 1,
+                        'version': messages[-1]['id'] if messages else 0,
+                        'archived': True,
+                    }
+        self.write_manifest(user_id, manifest)
+        print(f"Rebuilt chat manifest for {user_id} ({len(manifest)} chats)")
+        return manifest
+
+    def append_manifest(self, user_id, records):
+        size = self.manifest_file_size(user_id)
+        written = self.append_log(self.manifest_filepath(user_id), records)
+        self.manifest_records[user_id] = self.manifest_records.get(user_id, 0) + len(records)
+        if size is not None and size == self.manifest_sizes.get(user_id):
+            self.manifest_sizes[user_id] = size + written
+            # A long-running server seldom reloads the manifest, so it is
+            # also compacted here once superseded records pile up.
+            manifest = self.manifests.get(user_id)
+            if manifest is not None and self.manifest_records[user_id] > 2 * len(manifest) + self.compact_min_dead:
+                self.write_manifest(user_id, manifest)
+        else:
+            # Someone else wrote to the manifest since we last read it.
+            self.manifest_sizes.pop(user_id, None)
+
+    def update_manifest(self, user_id, chat_id, messages, reset=False):
+        manifest = self.load_manifest(user_id)
+        entry = manifest.get(chat_id)
+        title = entry['title'] if entry and entry['title'] != 'New Chat' else chat_title(messages)
+        epoch = entry.get('epoch', 1) if entry else 0
+        entry = {
+            'id': chat_id,
+            'title': title,
+            'updated': time.time(),
+            'count': len(messages),
+            'epoch': epoch + 1 if reset else epoch,
+            'version': messages[-1]['id'] if messages else 0,
+        }
+        manifest[chat_id] = entry
+        self.append_manifest(user_id, [entry])
+
+    def list_chats(self, user_id, limit=None, cursor=None):
+        return paginate_chats(self.load_manifest(user_id).values(), limit, cursor)
+
+    def chat_version(self, user_id, chat_id):
+        entry = self.load_manifest(user_id).get(chat_id)
+        if entry is None:
+            return None
+        return {'epoch': entry.get('epoch', 1), 'version': entry.get('version', entry['count'])}
+
+    def message_count(self, user_id, chat_id):
+        entry = self.load_manifest(user_id).get(chat_id)
+        return entry['count'] if entry else None
+
+    def list_users(self):
+        if not os.path.exists(self.root_dir):
+            return []
+        return [
+            user_id for user_id in os.listdir(self.root_dir)
+            if not user_id.startswith('_') and os.path.isdir(self.user_dir(user_id))
+        ]
+
+    def export_messages(self, user_id, chat_id):
+        # Never writes: archived chats stay archived and torn or bloated logs
+        # are left for the server to repair, so CLIs (migrate.py, the search
+        # index backfill) can read next to a running server without
+        # replacing a log it is appending to.
+        entry = self.load_manifest(user_id).get(chat_id)
+        if entry and entry.get('archived'):
+            with zipfile.ZipFile(self.archive_filepath(user_id)) as archive:
+                return parse_chat_log(archive.read(f"{chat_id}.jsonl").decode('utf-8'))
+        with self.chat_lock(user_id, chat_id):
+            filepath = self.chat_filepath(user_id, chat_id)
+            if os.path.exists(filepath):
+                return self.read_log(filepath)[0]
+            legacy_path = self.legacy_chat_filepath(user_id, chat_id)
+            if os.path.exists(legacy_path):
+                return self.read_legacy_chat(legacy_path) or []
+            return []
+
+    def import_chats(self, chats):
+        imported = 0
+        by_user = {}
+        for chat in chats:
+            by_user.setdefault(chat['user_id'], []).append(chat)
+        for user_id, user_chats in by_user.items():
+            manifest = self.load_manifest(user_id)
+            entries = []
+            for chat in user_chats:
+                if chat['chat_id'] in manifest:
+                    continue
+                messages = assign_message_ids(chat['messages'])
+                filepath = self.chat_filepath(user_id, chat['chat_id'])
+                self.write_log(filepath, messages)
+                os.utime(filepath, (chat['updated'], chat['updated']))
+                entry = {
+                    'id': chat['chat_id'],
+                    'title': chat_title(messages),
+                    'updated': chat['updated'],
+                    'count': len(messages),
+                    'epoch': 1,
+                    'version': messages[-1]['id'] if messages else 0,
+                }
+                manifest[chat['chat_id']] = entry
+                entries.append(entry)
+            if entries:
+                self.append_manifest(user_id, entries)
+                imported += len(entries)
+        return imported
+
+    def archive_filepath(self, user_id):
+        return os.path.join(self.user_dir(user_id), ARCHIVE_FILENAME)
+
+    def restore_archived_chat(self, user_id, chat_id):
+        manifest = self.manifests.get(user_id)
+        if manifest is None:
+            if not os.path.exists(self.archive_filepath(user_id)):
+                return False
+            manifest = self.load_manifest(user_id)
+        entry = manifest.get(chat_id)
+        if not entry or not entry.get('archived'):
+            return False
+        try:
+            with zipfile.ZipFile(self.archive_filepath(user_id)) as archive:
+                data = archive.read(f"{chat_id}.jsonl")
+        except (KeyError, IOError, zipfile.BadZipFile) as e:
+            print(f"Error restoring archived chat {chat_id}: {e}")
+            return False
+        filepath = self.chat_filepath(user_id, chat_id)
+        tmp_path = f"{filepath}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, filepath)
+        os.utime(filepath, (entry['updated'], entry['updated']))
+        entry = dict(entry, archived=False)
+        manifest[chat_id] = entry
+        self.append_manifest(user_id, [entry])
+        return True
+
+    def run_maintenance(self, archive_after_seconds):
+        report = {'users': 0, 'archived': 0, 'compacted': 0, 'purged': 0, 'bytes_before': 0, 'bytes_after': 0}
+        for user_id in self.list_users():
+            report['bytes_before'] += directory_size(self.user_dir(user_id))
+            self.maintain_user(user_id, archive_after_seconds, report)
+            report['bytes_after'] += directory_size(self.user_dir(user_id))
+            report['users'] += 1
+            time.sleep(0)
+        report['reclaimed'] = report['bytes_before'] - report['bytes_after']
+        return report
+
+    def maintain_user(self, user_id, archive_after_seconds, report):
+        user_dir = self.user_dir(user_id)
+        manifest = self.load_manifest(user_id)
+        cutoff = time.time() - archive_after_seconds
+
+        for filename in os.listdir(user_dir):
+            if filename.endswith('.tmp'):
+                os.remove(os.path.join(user_dir, filename))
+                report['purged'] += 1
+
+        for filepath, state in list(self.log_state.items()):
+            if os.path.dirname(filepath) != user_dir:
+                continue
+            chat_id = os.path.splitext(os.path.basename(filepath))[0]
+            with self.chat_lock(user_id, chat_id):
+                state = self.log_state.get(filepath)
+                if state and state['records'] > state['messages'] and os.path.exists(filepath):
+                    messages, _, _ = self.read_log(filepath)
+                    self.write_log(filepath, messages)
+                    report['compacted'] += 1
+
+        to_archive = [
+            entry for entry in manifest.values()
+            if not entry.get('archived') and entry['updated'] < cutoff
+            and os.path.exists(self.chat_filepath(user_id, entry['id']))
+        ]
+        archive_path = self.archive_filepath(user_id)
+        live_names = {f"{entry['id']}.jsonl" for entry in manifest.values() if entry.get('archived')}
+        existing_names = set()
+        if os.path.exists(archive_path):
+            with zipfile.ZipFile(archive_path) as archive:
+                existing_names = set(archive.namelist())
+        dead_names = existing_names - live_names
+        if not to_archive and not dead_names:
+            return
+
+        # The archive is rebuilt rather than appended to, which both adds the
+        # newly cold chats and drops entries that were restored or deleted.
+        tmp_path = f"{archive_path}.tmp"
+        snapshots = {}
+        with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED) as new_archive:
+            if existing_names:
+                with zipfile.ZipFile(archive_path) as archive:
+                    for name in existing_names & live_names:
+                        new_archive.writestr(archive.getinfo(name), archive.read(name), compress_type=zipfile.ZIP_DEFLATED)
+            for entry in to_archive:
+                filepath = self.chat_filepath(user_id, entry['id'])
+                with self.chat_lock(user_id, entry['id']):
+                    if not os.path.exists(filepath):
+                        continue
+                    messages, _, _ = self.read_log(filepath)
+                    snapshots[entry['id']] = file_signature(filepath)
+                data = ''.join(json.dumps(msg, ensure_ascii=False) + '\n' for msg in messages)
+                info = zipfile.ZipInfo(f"{entry['id']}.jsonl", date_time=time.localtime(entry['updated'])[:6])
+                new_archive.writestr(info, data, compress_type=zipfile.ZIP_DEFLATED)
+        os.replace(tmp_path, archive_path)
+        report['purged'] += len(dead_names)
+
+        archived_entries = []
+        manifest = self.load_manifest(user_id)
+        for entry in to_archive:
+            filepath = self.chat_filepath(user_id, entry['id'])
+            with self.chat_lock(user_id, entry['id']):
+                current = manifest.get(entry['id'])
+                # Only a log nobody has touched since it was copied is removed.
+                if (entry['id'] not in snapshots or current is None or current['updated'] != entry['updated']
+                        or file_signature(filepath) != snapshots[entry['id']]):
+                    continue
+                os.remove(filepath)
+                self.log_state.pop(filepath, None)
+                entry = dict(current, archived=True)
+                manifest[entry['id']] = entry
+                archived_entries.append(entry)
+        report['archived'] += len(archived_entries)
+
+        if self.manifest_records.get(user_id, 0) + len(archived_entries) > len(manifest):
+            self.write_manifest(user_id, manifest)
+        else:
+            self.append_manifest(user_id, archived_entries)
+
+
+def parse_timestamp(value):
+    # SQLite's CURRENT_TIMESTAMP is 'YYYY-MM-DD HH:MM:SS' in UTC.
+    if not value:
+        return time.time()
+    try:
+        return calendar.timegm(time.strptime(value[:19], '%Y-%m-%d %H:%M:%S'))
+    except ValueError:
+        return time.time()
+
+def directory_size(path):
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file():
+            total += entry.stat().st_size
+    return total
+
+
+# --- SQLite Backend ---
+# Builds on the `messages(id, session_id, role, content, ts)` table shipped in
+# therogpt.db: session_id holds the chat id and a user_id column is added on
+# first use. A `chats` table tracks titles and activity for the sidebar.
+# Maintenance moves the rows of inactive chats into one zlib-compressed blob
+# in `archived_chats`; any read or write of such a chat restores it first.
+
+class SqliteConnectionPool:
+    # queue.Queue is green-aware once eventlet has monkey patched the process,
+    # so waiting for a free connection yields to other greenlets.
+    def __init__(self, db_path, size=4, busy_timeout_ms=5000):
+        self.db_path = db_path
+        self.connections = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self.connections.put(self.connect(busy_timeout_ms))
+
+    def connect(self, busy_timeout_ms):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        conn = self.connections.get()
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+
+MESSAGE_COLUMNS = {'id', 'role', 'content', 'blob', 'tokens'}
+
+class SqliteChatStore(ChatStore):
+    def __init__(self, db_path, pool_size=4):
+        self.pool = SqliteConnectionPool(db_path, size=pool_size)
+        self.init_schema()
+
+    def init_schema(self):
+        with self.pool.transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT,
+                    role TEXT,
+                    content TEXT,
+                    ts DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(messages)")}
+            if 'user_id' not in columns:
+                conn.execute("ALTER TABLE messages ADD COLUMN user_id TEXT")
+            if 'seq' not in columns:
+                conn.execute("ALTER TABLE messages ADD COLUMN seq INTEGER")
+            if 'content_blob' not in columns:
+                conn.execute("ALTER TABLE messages ADD COLUMN content_blob TEXT")
+            if 'tokens' not in columns:
+                conn.execute("ALTER TABLE messages ADD COLUMN tokens INTEGER")
+            if 'extra' not in columns:
+                conn.execute("ALTER TABLE messages ADD COLUMN extra TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_chat ON messages(user_id, session_id, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_chat_seq ON messages(user_id, session_id, seq)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS chats (
+                    user_id TEXT NOT NULL,
+                    chat_id TEXT NOT NULL,
+                    title TEXT NOT NULL DEFAULT 'New Chat',
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    message_count INTEGER NOT NULL DEFAULT 0,
+                    epoch INTEGER NOT NULL DEFAULT 1,
+                    last_seq INTEGER NOT NULL DEFAULT 0,
+                    archived INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, chat_id)
+                )
+            """)
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(chats)")}
+            if 'message_count' not in columns:
+                conn.execute("ALTER TABLE chats ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+            if 'epoch' not in columns:
+                conn.execute("ALTER TABLE chats ADD COLUMN epoch INTEGER NOT NULL DEFAULT 1")
+            if 'last_seq' not in columns:
+                conn.execute("ALTER TABLE chats ADD COLUMN last_seq INTEGER NOT NULL DEFAULT 0")
+            if 'archived' not in columns:
+                conn.execute("ALTER TABLE chats ADD COLUMN archived INTEGER NOT NULL DEFAULT 0")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS archived_chats (
+                    user_id TEXT NOT NULL,
+                    chat_id TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (user_id, chat_id)
+                )
+            """)
+            conn.execute("DROP INDEX IF EXISTS idx_chats_user_updated")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_chats_user_updated_id ON chats(user_id, updated_at, chat_id)")
+
+    def backfill_seq(self, user_id, chat_id):
+        # Rows written before message ids existed get positional ids once.
+        with self.pool.transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, seq FROM messages WHERE user_id = ? AND session_id = ? ORDER BY id",
+                (user_id, chat_id),
+            ).fetchall()
+            last_seq, updates = 0, []
+            for row in rows:
+                if row['seq'] is None:
+                    last_seq += 1
+                    updates.append((last_seq, row['id']))
+                else:
+                    last_seq = row['seq']
+            conn.executemany("UPDATE messages SET seq = ? WHERE id = ?", updates)
+
+    def row_to_message(self, row):
+        message = {'id': row['seq'], 'role': row['role'], 'content': row['content']}
+        if row['content_blob']:
+            message['blob'] = row['content_blob']
+        if row['tokens'] is not None:
+            message['tokens'] = row['tokens']
+        if row['extra']:
+            message.update(json.loads(row['extra']))
+        return message
+
+    def message_extra(self, msg):
+        # Fields without a column of their own (e.g. web_results) ride along as JSON.
+        extra = {key: value for key, value in msg.items() if key not in MESSAGE_COLUMNS}
+        return json.dumps(extra, ensure_ascii=False) if extra else None
+
+    def insert_messages(self, conn, user_id, chat_id, messages):
+        conn.executemany(
+            "INSERT INTO messages (user_id, session_id, seq, role, content, content_blob, tokens, extra) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(user_id, chat_id, msg['id'], msg['role'], msg['content'], msg.get('blob'), msg.get('tokens'),
+              self.message_extra(msg)) for msg in messages],
+        )
+
+    def ensure_restored(self, user_id, chat_id):
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT archived FROM chats WHERE user_id = ? AND chat_id = ?",
+                (user_id, chat_id),
+            ).fetchone()
+        if row is None or not row['archived']:
+            return
+        with self.pool.transaction() as conn:
+            archived = conn.execute(
+                "SELECT data FROM archived_chats WHERE user_id = ? AND chat_id = ?",
+                (user_id, chat_id),
+            ).fetchone()
+            if archived is not None:
+                messages = json.loads(zlib.decompress(archived['data']).decode('utf-8'))
+                self.insert_messages(conn, user_id, chat_id, messages)
+                conn.execute("DELETE FROM archived_chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+            conn.execute("UPDATE chats SET archived = 0 WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+
+    def load_messages(self, user_id, chat_id):
+        self.ensure_restored(user_id, chat_id)
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT seq, role, content, content_blob, tokens, extra FROM messages WHERE user_id = ? AND session_id = ? ORDER BY id",
+                (user_id, chat_id),
+            ).fetchall()
+        if any(row['seq'] is None for row in rows):
+            self.backfill_seq(user_id, chat_id)
+            return self.load_messages(user_id, chat_id)
+        return [self.row_to_message(row) for row in rows]
+
+    def load_page(self, user_id, chat_id, limit, before=None):
+        self.ensure_restored(user_id, chat_id)
+        query = "SELECT seq, role, content, content_blob, tokens, extra FROM messages WHERE user_id = ? AND session_id = ?"
+        params = [user_id, chat_id]
+        if before is not None:
+            query += " AND seq < ?"
+            params.append(before)
+        query += " ORDER BY seq DESC LIMIT ?"
+        params.append(limit + 1)
+        with self.pool.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        if any(row['seq'] is None for row in rows):
+            self.backfill_seq(user_id, chat_id)
+            return self.load_page(user_id, chat_id, limit, before)
+        messages = [self.row_to_message(row) for row in reversed(rows[:limit])]
+        return messages, len(rows) > limit
+
+    def touch_chat(self, conn, user_id, chat_id, messages, reset=False):
+        now = time.time()
+        last_seq = messages[-1]['id'] if messages else 0
+        conn.execute(
+            "INSERT INTO chats (user_id, chat_id, title, created_at, updated_at, message_count, last_seq) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(user_id, chat_id) DO UPDATE SET updated_at = excluded.updated_at, "
+            "message_count = excluded.message_count, last_seq = excluded.last_seq, "
+            f"epoch = epoch + {1 if reset else 0}",
+            (user_id, chat_id, chat_title(messages), now, now, len(messages), last_seq),
+        )
+        if any(msg['role'] == 'user' for msg in messages):
+            conn.execute(
+                "UPDATE chats SET title = ? WHERE user_id = ? AND chat_id = ? AND title = 'New Chat'",
+                (chat_title(messages), user_id, chat_id),
+            )
+
+    def save_messages(self, user_id, chat_id, messages):
+        assign_message_ids(messages)
+        self.ensure_restored(user_id, chat_id)
+        with self.pool.transaction() as conn:
+            stored = conn.execute(
+                "SELECT COUNT(*) FROM messages WHERE user_id = ? AND session_id = ?",
+                (user_id, chat_id),
+            ).fetchone()[0]
+            tail = conn.execute(
+                "SELECT seq, role, content, content_blob, tokens, extra FROM messages "
+                "WHERE user_id = ? AND session_id = ? ORDER BY seq DESC LIMIT 1",
+                (user_id, chat_id),
+            ).fetchone()
+            reset = tail_rewritten(messages, stored, self.row_to_message(tail) if tail else None)
+            if reset:
+                conn.execute("DELETE FROM messages WHERE user_id = ? AND session_id = ?", (user_id, chat_id))
+                stored = 0
+            self.insert_messages(conn, user_id, chat_id, messages[stored:])
+            self.touch_chat(conn, user_id, chat_id, messages, reset=reset)
+
+    def load_since(self, user_id, chat_id, after_id):
+        self.ensure_restored(user_id, chat_id)
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT seq, role, content, content_blob, tokens, extra FROM messages WHERE user_id = ? AND session_id = ? AND seq > ? ORDER BY seq",
+                (user_id, chat_id, after_id),
+            ).fetchall()
+        return [self.row_to_message(row) for row in rows]
+
+    def chat_version(self, user_id, chat_id):
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT epoch, last_seq FROM chats WHERE user_id = ? AND chat_id = ?",
+                (user_id, chat_id),
+            ).fetchone()
+        if row is None:
+            return None
+        return {'epoch': row['epoch'], 'version': row['last_seq']}
+
+    def create_chat(self, user_id, chat_id):
+        with self.pool.transaction() as conn:
+            self.touch_chat(conn, user_id, chat_id, [])
+
+    def delete_chat(self, user_id, chat_id):
+        with self.pool.transaction() as conn:
+            conn.execute("DELETE FROM messages WHERE user_id = ? AND session_id = ?", (user_id, chat_id))
+            conn.execute("DELETE FROM archived_chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+            conn.execute("DELETE FROM chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+
+    def list_chats(self, user_id, limit=None, cursor=None):
+        query = "SELECT chat_id, title, updated_at, message_count FROM chats WHERE user_id = ?"
+        params = [user_id]
+        if cursor:
+            updated, chat_id = decode_chat_cursor(cursor)
+            query += " AND (updated_at < ? OR (updated_at = ? AND chat_id < ?))"
+            params += [updated, updated, chat_id]
+        query += " ORDER BY updated_at DESC, chat_id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit + 1)
+        with self.pool.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        chats = [
+            {'id': row['chat_id'], 'title': row['title'], 'updated': row['updated_at'], 'count': row['message_count']}
+            for row in rows
+        ]
+        if limit is None or len(chats) <= limit:
+            return chats, None
+        page = chats[:limit]
+        return page, encode_chat_cursor(page[-1])
+
+
+    def list_users(self):
+        with self.pool.connection() as conn:
+            return [row['user_id'] for row in conn.execute("SELECT DISTINCT user_id FROM chats")]
+
+    def export_messages(self, user_id, chat_id):
+        with self.pool.connection() as conn:
+            archived = conn.execute(
+                "SELECT data FROM archived_chats WHERE user_id = ? AND chat_id = ?",
+                (user_id, chat_id),
+            ).fetchone()
+        if archived is not None:
+            return json.loads(zlib.decompress(archived['data']).decode('utf-8'))
+        return self.load_messages(user_id, chat_id)
+
+    def message_count(self, user_id, chat_id):
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT message_count FROM chats WHERE user_id = ? AND chat_id = ?",
+                (user_id, chat_id),
+            ).fetchone()
+        return row['message_count'] if row else None
+
+    def import_chats(self, chats):
+        imported = 0
+        with self.pool.transaction() as conn:
+            for chat in chats:
+                messages = assign_message_ids(chat['messages'])
+                inserted = conn.execute(
+                    "INSERT OR IGNORE INTO chats (user_id, chat_id, title, created_at, updated_at, message_count, last_seq) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (chat['user_id'], chat['chat_id'], chat_title(messages), chat['updated'], chat['updated'],
+                     len(messages), messages[-1]['id'] if messages else 0),
+                ).rowcount
+                if inserted:
+                    self.insert_messages(conn, chat['user_id'], chat['chat_id'], messages)
+                    imported += 1
+        return imported
+
+    def adopt_orphan_messages(self, user_id):
+        # Rows written to messages before chats had owners (user_id IS NULL)
+        # are assigned to `user_id` in place, one chat per session_id.
+        with self.pool.connection() as conn:
+            sessions = conn.execute(
+                "SELECT session_id, MAX(ts) AS last_ts FROM messages WHERE user_id IS NULL GROUP BY session_id"
+            ).fetchall()
+        adopted = []
+        for row in sessions:
+            chat_id = row['session_id']
+            with self.pool.transaction() as conn:
+                exists = conn.execute(
+                    "SELECT 1 FROM chats WHERE user_id = ? AND chat_id = ?",
+                    (user_id, chat_id),
+                ).fetchone()
+                if exists:
+                    continue
+                conn.execute(
+                    "UPDATE messages SET user_id = ? WHERE user_id IS NULL AND session_id = ?",
+                    (user_id, chat_id),
+                )
+            self.backfill_seq(user_id, chat_id)
+            messages = self.load_messages(user_id, chat_id)
+            updated = parse_timestamp(row['last_ts'])
+            with self.pool.transaction() as conn:
+                conn.execute(
+                    "INSERT INTO chats (user_id, chat_id, title, created_at, updated_at, message_count, last_seq) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (user_id, chat_id, chat_title(messages), updated, updated,
+                     len(messages), messages[-1]['id'] if messages else 0),
+                )
+            adopted.append((chat_id, len(messages)))
+        return adopted
+
+    def database_size(self):
+        return sum(
+            os.path.getsize(path) for path in (self.pool.db_path, f"{self.pool.db_path}-wal")
+            if os.path.exists(path)
+        )
+
+    def archive_chat(self, user_id, chat_id, cutoff):
+        # Reading, archiving and deleting happen in one write transaction that
+        # re-checks the chat is still cold, so a save that landed after the
+        # scan is neither lost nor archived stale.
+        self.backfill_seq(user_id, chat_id)
+        with self.pool.transaction() as conn:
+            still_cold = conn.execute(
+                "SELECT 1 FROM chats WHERE user_id = ? AND chat_id = ? AND archived = 0 AND updated_at < ?",
+                (user_id, chat_id, cutoff),
+            ).fetchone()
+            if not still_cold:
+                return False
+            rows = conn.execute(
+                "SELECT seq, role, content, content_blob, tokens, extra FROM messages WHERE user_id = ? AND session_id = ? ORDER BY id",
+                (user_id, chat_id),
+            ).fetchall()
+            if any(row['seq'] is None for row in rows):
+                return False
+            messages = [self.row_to_message(row) for row in rows]
+            data = zlib.compress(json.dumps(messages, ensure_ascii=False).encode('utf-8'))
+            conn.execute(
+                "INSERT OR REPLACE INTO archived_chats (user_id, chat_id, data) VALUES (?, ?, ?)",
+                (user_id, chat_id, data),
+            )
+            conn.execute("DELETE FROM messages WHERE user_id = ? AND session_id = ?", (user_id, chat_id))
+            conn.execute("UPDATE chats SET archived = 1 WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+        return True
+
+    def run_maintenance(self, archive_after_seconds):
+        report = {'archived': 0, 'compacted': 0, 'purged': 0, 'bytes_before': self.database_size()}
+        cutoff = time.time() - archive_after_seconds
+        with self.pool.connection() as conn:
+            cold = conn.execute(
+                "SELECT user_id, chat_id FROM chats WHERE archived = 0 AND message_count > 0 AND updated_at < ?",
+                (cutoff,),
+            ).fetchall()
+        for row in cold:
+            if self.archive_chat(row['user_id'], row['chat_id'], cutoff):
+                report['archived'] += 1
+            time.sleep(0)
+        with self.pool.transaction() as conn:
+            purged = conn.execute(
+                "DELETE FROM archived_chats WHERE NOT EXISTS "
+                "(SELECT 1 FROM chats WHERE chats.user_id = archived_chats.user_id AND chats.chat_id = archived_chats.chat_id)"
+            ).rowcount
+            report['purged'] += purged
+        with self.pool.connection() as conn:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if freelist_count and freelist_count >= page_count // 4:
+                conn.execute("VACUUM")
+                report['compacted'] += 1
+        report['bytes_after'] = self.database_size()
+        report['reclaimed'] = report['bytes_before'] - report['bytes_after']
+        return report
+
+
+# --- Message Blob Store ---
+# Message bodies above a size threshold are stored once, keyed by their
+# SHA-256, and the chat keeps a reference plus a short preview (so titles and
+# the manifest still work without resolving). The same document pasted into
+# many chats then costs one copy on disk. Blobs that no chat references any
+# more are swept during maintenance. With min_bytes=0 no new blobs are written
+# but existing references still resolve.
+
+BLOB_PREVIEW_CHARS = 120
+
+def blob_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class FileBlobStore:
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def blob_filepath(self, digest):
+        return os.path.join(self.root_dir, digest[:2], digest)
+
+    def put(self, digest, data):
+        filepath = self.blob_filepath(digest)
+        try:
+            # A new reference makes an existing blob young again for the sweep.
+            os.utime(filepath)
+            return False
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        tmp_path = f"{filepath}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+        return True
+
+    def get(self, digest):
+        try:
+            with open(self.blob_filepath(digest), 'rb') as f:
+                return f.read().decode('utf-8')
+        except FileNotFoundError:
+            return None
+
+    def iter_blobs(self):
+        if not os.path.isdir(self.root_dir):
+            return
+        for prefix in os.listdir(self.root_dir):
+            prefix_dir = os.path.join(self.root_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for entry in os.scandir(prefix_dir):
+                if not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    yield entry.name, stat.st_size, stat.st_mtime
+
+    def delete(self, digests):
+        for digest in digests:
+            try:
+                os.remove(self.blob_filepath(digest))
+            except FileNotFoundError:
+                pass
+
+
+class SqliteBlobStore:
+    def __init__(self, pool):
+        self.pool = pool
+        with self.pool.transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    digest TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+
+    def put(self, digest, data):
+        now = time.time()
+        with self.pool.transaction() as conn:
+            if conn.execute("UPDATE blobs SET created_at = ? WHERE digest = ?", (now, digest)).rowcount:
+                return False
+            conn.execute(
+                "INSERT INTO blobs (digest, data, size, created_at) VALUES (?, ?, ?, ?)",
+                (digest, data, len(data), now),
+            )
+            return True
+
+    def get(self, digest):
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT data FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        return bytes(row['data']).decode('utf-8') if row else None
+
+    def iter_blobs(self):
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT digest, size, created_at FROM blobs").fetchall()
+        for row in rows:
+            yield row['digest'], row['size'], row['created_at']
+
+    def delete(self, digests):
+        with self.pool.transaction() as conn:
+            conn.executemany("DELETE FROM blobs WHERE digest = ?", [(digest,) for digest in digests])
+
+
+class BlobChatStore(ChatStore):
+    def __init__(self, store, blobs, min_bytes=0, cache_bytes=16 * 1024 * 1024):
+        self.store = store
+        self.blobs = blobs
+        self.min_bytes = min_bytes
+        self.cache_bytes = cache_bytes
+        # digest -> body and body -> digest, so re-saving a history that was
+        # just loaded neither re-hashes nor re-reads its large messages.
+        self.cache = OrderedDict()
+        self.digests = {}
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+        self.counters = {'blob_writes': 0, 'blob_bytes_written': 0, 'references_written': 0,
+                         'cache_hits': 0, 'cache_misses': 0, 'missing': 0}
+        self.last_scan = {}
+        # Blobs referenced by saves still in flight, and by saves that finished
+        # while a sweep was running; see run_maintenance.
+        self.saving = {}
+        self.sweep_digests = None
+
+    def remember(self, digest, content):
+        with self.lock:
+            if digest in self.cache:
+                self.cache.move_to_end(digest)
+                return
+            self.cache[digest] = content
+            self.digests[content] = digest
+            self.cached_bytes += len(content)
+            while self.cached_bytes > self.cache_bytes and len(self.cache) > 1:
+                old_digest, old_content = self.cache.popitem(last=False)
+                self.digests.pop(old_content, None)
+                self.cached_bytes -= len(old_content)
+
+    def store_body(self, content):
+        # Every digest handed out is held until release() once the save that
+        # references it is stored.
+        with self.lock:
+            digest = self.digests.get(content)
+            if digest is not None:
+                self.saving[digest] = self.saving.get(digest, 0) + 1
+                return digest
+        data = content.encode('utf-8')
+        digest = blob_digest(data)
+        with self.lock:
+            self.saving[digest] = self.saving.get(digest, 0) + 1
+        if self.blobs.put(digest, data):
+            with self.lock:
+                self.counters['blob_writes'] += 1
+                self.counters['blob_bytes_written'] += len(data)
+        self.remember(digest, content)
+        return digest
+
+    def encode(self, messages):
+        encoded = []
+        for msg in messages:
+            content = msg.get('content')
+            if self.min_bytes and isinstance(content, str) and len(content) >= self.min_bytes:
+                msg = dict(msg, content=content[:BLOB_PREVIEW_CHARS], blob=self.store_body(content))
+            encoded.append(msg)
+        return encoded
+
+    def resolve(self, messages):
+        resolved = []
+        for msg in messages:
+            digest = msg.get('blob')
+            if digest:
+                with self.lock:
+                    content = self.cache.get(digest)
+                    self.counters['cache_hits' if content is not None else 'cache_misses'] += 1
+                if content is None:
+                    content = self.blobs.get(digest)
+                    if content is None:
+                        with self.lock:
+                            self.counters['missing'] += 1
+                        print(f"Missing message blob {digest}, keeping preview")
+                        content = msg['content']
+                    else:
+                        self.remember(digest, content)
+                msg = {key: value for key, value in msg.items() if key != 'blob'}
+                msg['content'] = content
+            resolved.append(msg)
+        return resolved
+
+    def load_messages(self, user_id, chat_id):
+        return self.resolve(self.store.load_messages(user_id, chat_id))
+
+    def release(self, messages):
+        with self.lock:
+            for msg in messages:
+                digest = msg.get('blob')
+                if digest in self.saving:
+                    self.saving[digest] -= 1
+                    if not self.saving[digest]:
+                        del self.saving[digest]
+                    if self.sweep_digests is not None:
+                        self.sweep_digests.add(digest)
+
+    def save_messages(self, user_id, chat_id, messages):
+        assign_message_ids(messages)
+        encoded = self.encode(messages)
+        with self.lock:
+            self.counters['references_written'] += sum(1 for msg in encoded if 'blob' in msg)
+        try:
+            self.store.save_messages(user_id, chat_id, encoded)
+        finally:
+            self.release(encoded)
+
+    def create_chat(self, user_id, chat_id):
+        self.store.create_chat(user_id, chat_id)
+
+    def delete_chat(self, user_id, chat_id):
+        self.store.delete_chat(user_id, chat_id)
+
+    def list_chats(self, user_id, limit=None, cursor=None):
+        return self.store.list_chats(user_id, limit=limit, cursor=cursor)
+
+    def load_page(self, user_id, chat_id, limit, before=None):
+        page, has_more = self.store.load_page(user_id, chat_id, limit, before=before)
+        return self.resolve(page), has_more
+
+    def load_since(self, user_id, chat_id, after_id):
+        messages = self.store.load_since(user_id, chat_id, after_id)
+        return None if messages is None else self.resolve(messages)
+
+    def chat_version(self, user_id, chat_id):
+        return self.store.chat_version(user_id, chat_id)
+
+    def message_count(self, user_id, chat_id):
+        return self.store.message_count(user_id, chat_id)
+
+    def list_users(self):
+        return self.store.list_users()
+
+    def export_messages(self, user_id, chat_id):
+        return self.resolve(self.store.export_messages(user_id, chat_id))
+
+    def import_chats(self, chats):
+        chats = [dict(chat, messages=self.encode(assign_message_ids(chat['messages']))) for chat in chats]
+        try:
+            return self.store.import_chats(chats)
+        finally:
+            self.release([msg for chat in chats for msg in chat['messages']])
+
+    def run_maintenance(self, archive_after_seconds):
+        report = self.store.run_maintenance(archive_after_seconds)
+        if next(iter(self.blobs.iter_blobs()), None) is None:
+            return report
+        # Mark every referenced blob, including those of archived chats, then
+        # sweep the rest. A save running alongside the scan may reference a
+        # blob after the mark has passed its chat, so the sweep also spares
+        # blobs written or re-referenced since the run started (puts refresh
+        # the timestamp, which covers other processes too) and those of saves
+        # still in flight or finished during the scan.
+        started = time.time()
+        with self.lock:
+            self.sweep_digests = set()
+        try:
+            return self.sweep_blobs(report, started)
+        finally:
+            with self.lock:
+                self.sweep_digests = None
+
+    def sweep_blobs(self, report, started):
+        references = {}
+        for user_id in self.store.list_users():
+            chats, _ = self.store.list_chats(user_id)
+            for chat in chats:
+                for msg in self.store.export_messages(user_id, chat['id']):
+                    if msg.get('blob'):
+                        references[msg['blob']] = references.get(msg['blob'], 0) + 1
+                time.sleep(0)
+        blobs, blob_bytes, referenced_bytes, unreferenced = 0, 0, 0, []
+        stored = list(self.blobs.iter_blobs())
+        with self.lock:
+            in_use = self.sweep_digests | set(self.saving)
+        for digest, size, created in stored:
+            if digest in references:
+                blobs += 1
+                blob_bytes += size
+                referenced_bytes += size * references[digest]
+            elif created < started and digest not in in_use:
+                unreferenced.append((digest, size))
+        self.blobs.delete([digest for digest, _ in unreferenced])
+        with self.lock:
+            for digest, _ in unreferenced:
+                content = self.cache.pop(digest, None)
+                if content is not None:
+                    self.digests.pop(content, None)
+                    self.cached_bytes -= len(content)
+        self.last_scan = {
+            'blobs': blobs,
+            'blob_bytes': blob_bytes,
+            'references': sum(references.values()),
+            'referenced_bytes': referenced_bytes,
+            'saved_bytes': referenced_bytes - blob_bytes,
+        }
+        report['blobs_swept'] = len(unreferenced)
+        report['blob_bytes_swept'] = sum(size for _, size in unreferenced)
+        return report
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                self.counters,
+                min_bytes=self.min_bytes,
+                cache_entries=len(self.cache),
+                cache_bytes=self.cached_bytes,
+                last_scan=self.last_scan or None,
+            )
+
+
+# --- History Cache ---
+# Keeps recently used histories in memory, bounded by entry count and an
+# approximate byte size, and hands saves to a background writer so the
+# request path never waits on disk. Loads check pending writes first, so an
+# evicted chat is never read back stale. Unflushed writes are lost if the
+# process dies; flush() is called at exit, and after_persisted() lets callers
+# hold on to anything that would recover a save until it has been written.
+
+MESSAGE_OVERHEAD_BYTES = 64
+
+def estimate_history_bytes(messages):
+    return sum(len(msg.get('content') or '') + MESSAGE_OVERHEAD_BYTES for msg in messages)
+
+
+class CachedChatStore(ChatStore):
+    def __init__(self, store, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.store = store
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.pending = {}
+        self.writing = None
+        self.persist_callbacks = {}
+        self.write_queue = queue.Queue()
+        self.lock = threading.RLock()
+        self.write_lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'writes': 0, 'write_errors': 0}
+        self.writer = threading.Thread(target=self.run_writer, daemon=True)
+        self.writer.start()
+
+    def remember(self, key, messages):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old['size']
+            size = estimate_history_bytes(messages)
+            self.entries[key] = {'messages': messages, 'size': size}
+            self.total_bytes += size
+            while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted['size']
+                self.counters['evictions'] += 1
+
+    def forget(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old['size']
+            self.pending.pop(key, None)
+
+    def load_messages(self, user_id, chat_id):
+        key = (user_id, chat_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return list(entry['messages'])
+            self.counters['misses'] += 1
+            pending = self.pending.get(key)
+        if pending is not None:
+            messages = pending
+        else:
+            messages = self.store.load_messages(user_id, chat_id)
+        self.remember(key, list(messages))
+        return list(messages)
+
+    def save_messages(self, user_id, chat_id, messages):
+        key = (user_id, chat_id)
+        snapshot = list(assign_message_ids(messages))
+        self.remember(key, snapshot)
+        with self.lock:
+            already_queued = key in self.pending
+            self.pending[key] = snapshot
+        if not already_queued:
+            self.write_queue.put(key)
+
+    def run_writer(self):
+        while True:
+            key = self.write_queue.get()
+            try:
+                with self.write_lock:
+                    with self.lock:
+                        messages = self.pending.pop(key, None)
+                        self.writing = key if messages is not None else None
+                    if messages is None:
+                        continue
+                    callbacks = []
+                    try:
+                        self.store.save_messages(key[0], key[1], messages)
+                        self.counters['writes'] += 1
+                    except Exception as e:
+                        self.counters['write_errors'] += 1
+                        print(f"Error writing back chat history for {key[1]}: {e}")
+                    else:
+                        with self.lock:
+                            # A newer snapshot still queued includes whatever
+                            # the callbacks wait for, so they wait for it too.
+                            if key not in self.pending:
+                                callbacks = self.persist_callbacks.pop(key, [])
+                    finally:
+                        with self.lock:
+                            self.writing = None
+                    self.run_callbacks(callbacks)
+            finally:
+                self.write_queue.task_done()
+
+    def run_callbacks(self, callbacks):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error in chat history persist callback: {e}")
+
+    def after_persisted(self, user_id, chat_id, callback):
+        key = (user_id, chat_id)
+        with self.lock:
+            if key in self.pending or self.writing == key:
+                self.persist_callbacks.setdefault(key, []).append(callback)
+                return
+        self.run_callbacks([callback])
+
+    def flush(self):
+        self.write_queue.join()
+
+    def create_chat(self, user_id, chat_id):
+        self.store.create_chat(user_id, chat_id)
+        self.remember((user_id, chat_id), [])
+
+    def delete_chat(self, user_id, chat_id):
+        # Holding the write lock keeps an in-flight write-back from
+        # recreating the chat after it has been removed.
+        with self.write_lock:
+            self.forget((user_id, chat_id))
+            with self.lock:
+                self.persist_callbacks.pop((user_id, chat_id), None)
+            self.store.delete_chat(user_id, chat_id)
+
+    def list_chats(self, user_id, limit=None, cursor=None):
+        return self.store.list_chats(user_id, limit=limit, cursor=cursor)
+
+    def message_count(self, user_id, chat_id):
+        self.flush()
+        return self.store.message_count(user_id, chat_id)
+
+    def list_users(self):
+        return self.store.list_users()
+
+    def export_messages(self, user_id, chat_id):
+        self.flush()
+        return self.store.export_messages(user_id, chat_id)
+
+    def import_chats(self, chats):
+        with self.write_lock:
+            return self.store.import_chats(chats)
+
+    def run_maintenance(self, archive_after_seconds):
+        # Cached histories stay valid when their chat is archived; flushing
+        # first makes sure nothing pending is archived out from under them.
+        # Write-backs keep running during the pass: the backing store guards
+        # each chat itself (per-chat locks and a re-check of the log for
+        # files, one transaction per chat for SQLite), so a save that lands
+        # meanwhile keeps its chat live instead of waiting for the whole run.
+        self.flush()
+        return self.store.run_maintenance(archive_after_seconds)
+
+    def chat_version(self, user_id, chat_id):
+        # Chats are created and deleted synchronously, so the backing store
+        # knows whether one exists; the cache may hold newer messages than
+        # the write-behind has persisted yet.
+        info = self.store.chat_version(user_id, chat_id)
+        if info is None:
+            return None
+        with self.lock:
+            entry = self.entries.get((user_id, chat_id))
+            pending = self.pending.get((user_id, chat_id))
+        messages = pending if pending is not None else entry['messages'] if entry else None
+        if messages:
+            info['version'] = max(info['version'], messages[-1]['id'])
+        return info
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return dict(
+                self.counters,
+                entries=len(self.entries),
+                bytes=self.total_bytes,
+                max_entries=self.max_entries,
+                max_bytes=self.max_bytes,
+                pending_writes=len(self.pending),
+                hit_rate=round(self.counters['hits'] / lookups, 4) if lookups else None,
+            )
+
+
+def create_chat_store(backend, sessions_dir, db_path, **options):
+    if backend == 'file':
+        store = FileChatStore(
+            sessions_dir,
+            compact_min_dead=options.get('compact_min_dead', 50),
+            compact_ratio=options.get('compact_ratio', 0.5),
+        )
+    elif backend == 'sqlite':
+        store = SqliteChatStore(db_path, pool_size=options.get('pool_size', 4))
+    else:
+        raise ValueError(f"Unknown chat storage backend: {backend}")
+    blobs = FileBlobStore(os.path.join(sessions_dir, '_blobs')) if backend == 'file' else SqliteBlobStore(store.pool)
+    store = BlobChatStore(
+        store, blobs,
+        min_bytes=options.get('blob_min_bytes', 0),
+        cache_bytes=options.get('blob_cache_bytes', 16 * 1024 * 1024),
+    )
+    if options.get('cache_entries', 0) > 0:
+        store = CachedChatStore(store, max_entries=options['cache_entries'], max_bytes=options.get('cache_bytes', 64 * 1024 * 1024))
+    return store
+
+def unwrap_store(store, store_class):
+    while store is not None and not isinstance(store, store_class):
+        store = getattr(store, 'store', None)
+    return store
@@ -0,0 +1,235 @@
+import time
+import queue
+import threading
+from collections import OrderedDict
+
+from storage import SqliteConnectionPool
+from context import estimate_tokens, message_tokens, MESSAGE_OVERHEAD_TOKENS
+from scheduler import AdmissionRejected
+
+# --- Rolling Chat Summaries ---
+# Long chats get a stored summary of their older turns so the prompt can be
+# "summary + recent turns" instead of either replaying everything or silently
+# dropping it. Summaries are written by a background worker, extended
+# incrementally (previous summary + the turns since), and only while no reply
+# is being generated. The summary call itself holds a batch ticket from the
+# generation scheduler, so it counts against the same concurrency limits as
+# replies and is only admitted while no interactive request is waiting. A
+# summary is tied to the chat's epoch and is ignored once the history is
+# rewritten.
+
+# Summaries queue under one scheduler user of their own, so they never use up
+# a real user's queue allowance.
+SUMMARY_SCHEDULER_USER = '_summaries'
+
+SUMMARY_INSTRUCTIONS = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Merge the existing summary with the new messages into one concise summary. Keep names, "
+    "facts, decisions, code identifiers and open questions; drop pleasantries. "
+    "Reply with the summary only."
+)
+
+def apply_summary(history, summary):
+    """Replaces the summarized part of `history` with a summary message."""
+    if summary is None:
+        return history
+    head = history[:1] if history and history[0]['role'] == 'system' else []
+    recent = [msg for msg in history[len(head):] if msg.get('id', summary['upto_id'] + 1) > summary['upto_id']]
+    summary_message = {
+        'role': 'system',
+        'content': f"Summary of the earlier conversation:\n{summary['content']}",
+        'tokens': summary['tokens'],
+    }
+    return head + [summary_message] + recent
+
+
+class SummaryStore:
+    def __init__(self, db_path, pool_size=2, cache_entries=1024):
+        self.pool = SqliteConnectionPool(db_path, size=pool_size)
+        self.cache = OrderedDict()
+        self.cache_entries = cache_entries
+        self.lock = threading.Lock()
+        with self.pool.transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_summaries (
+                    user_id TEXT NOT NULL,
+                    chat_id TEXT NOT NULL,
+                    epoch INTEGER NOT NULL,
+                    upto_id INTEGER NOT NULL,
+                    content TEXT NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (user_id, chat_id)
+                )
+            """)
+
+    def remember(self, key, summary):
+        with self.lock:
+            self.cache[key] = summary
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_entries:
+                self.cache.popitem(last=False)
+
+    def get(self, user_id, chat_id):
+        key = (user_id, chat_id)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT epoch, upto_id, content, tokens FROM chat_summaries WHERE user_id = ? AND chat_id = ?",
+                (user_id, chat_id),
+            ).fetchone()
+        summary = dict(row) if row else None
+        self.remember(key, summary)
+        return summary
+
+    def save(self, user_id, chat_id, summary):
+        with self.pool.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO chat_summaries (user_id, chat_id, epoch, upto_id, content, tokens, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, chat_id, summary['epoch'], summary['upto_id'], summary['content'], summary['tokens'], time.time()),
+            )
+        self.remember((user_id, chat_id), summary)
+
+    def remove(self, user_id, chat_id):
+        with self.pool.transaction() as conn:
+            conn.execute("DELETE FROM chat_summaries WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+        self.remember((user_id, chat_id), None)
+
+    def count(self):
+        with self.pool.connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM chat_summaries").fetchone()[0]
+
+
+class RollingSummarizer:
+    def __init__(self, chat_store, summaries, client_factory, model, trigger_tokens=2048,
+                 keep_recent_tokens=1024, chunk_tokens=3072, max_summary_tokens=400, busy=None,
+                 options=None, keep_alive=None, scheduler=None):
+        self.chat_store = chat_store
+        self.summaries = summaries
+        self.client_factory = client_factory
+        self.model = model
+        self.trigger_tokens = trigger_tokens
+        self.keep_recent_tokens = keep_recent_tokens
+        self.chunk_tokens = chunk_tokens
+        self.max_summary_tokens = max_summary_tokens
+        self.busy = busy or (lambda: False)
+        self.scheduler = scheduler
+        # Same options as chat requests when the models are shared, or Ollama
+        # reloads the model to change num_ctx.
+        self.options = options or {}
+        self.keep_alive = keep_alive
+        self.queue = queue.Queue()
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.counters = {'written': 0, 'errors': 0, 'deferred': 0, 'summarized_messages': 0, 'last_ms': None}
+        self.worker = threading.Thread(target=self.run_worker, daemon=True)
+        self.worker.start()
+
+    def request(self, user_id, chat_id):
+        key = (user_id, chat_id)
+        with self.lock:
+            if key in self.queued:
+                return
+            self.queued.add(key)
+        self.queue.put(key)
+
+    def current(self, user_id, chat_id):
+        summary = self.summaries.get(user_id, chat_id)
+        if summary is None:
+            return None
+        version = self.chat_store.chat_version(user_id, chat_id)
+        if version is None or version['epoch'] != summary['epoch']:
+            return None
+        return summary
+
+    def apply(self, user_id, chat_id, history):
+        return apply_summary(history, self.current(user_id, chat_id))
+
+    def run_worker(self):
+        while True:
+            key = self.queue.get()
+            with self.lock:
+                self.queued.discard(key)
+            # A summary competes with replies for the same Ollama, so wait
+            # until nobody is waiting on one.
+            while self.busy():
+                time.sleep(0.5)
+            try:
+                if self.summarize(*key):
+                    self.request(*key)
+            except AdmissionRejected:
+                # Replies kept the scheduler full; the chat's next turn asks again.
+                with self.lock:
+                    self.counters['deferred'] += 1
+            except Exception as e:
+                with self.lock:
+                    self.counters['errors'] += 1
+                print(f"Error summarizing chat {key[1]}: {e}")
+
+    def summarize(self, user_id, chat_id):
+        """Folds the next chunk of old turns into the summary; returns True if more remain."""
+        version = self.chat_store.chat_version(user_id, chat_id)
+        if version is None:
+            return False
+        messages = self.chat_store.load_messages(user_id, chat_id)
+        summary = self.current(user_id, chat_id)
+        upto_id = summary['upto_id'] if summary else 0
+
+        # Leave the most recent turns alone; they are sent verbatim anyway.
+        cut, recent_tokens = len(messages), 0
+        while cut > 0 and recent_tokens + message_tokens(messages[cut - 1]) <= self.keep_recent_tokens:
+            cut -= 1
+            recent_tokens += message_tokens(messages[cut])
+        while cut > 0 and messages[cut - 1]['role'] == 'user':
+            cut -= 1
+        pending = [msg for msg in messages[:cut] if msg['id'] > upto_id]
+        if sum(message_tokens(msg) for msg in pending) < self.trigger_tokens:
+            return False
+
+        chunk, chunk_tokens = [], 0
+        for msg in pending:
+            if chunk and chunk_tokens + message_tokens(msg) > self.chunk_tokens:
+                break
+            chunk.append(msg)
+            chunk_tokens += message_tokens(msg)
+
+        transcript = '\n\n'.join(f"{msg['role'].capitalize()}: {msg['content']}" for msg in chunk)
+        previous = summary['content'] if summary else '(none yet)'
+        ticket = self.scheduler.acquire(SUMMARY_SCHEDULER_USER, 'batch') if self.scheduler else None
+        started = time.time()
+        try:
+            response = self.client_factory().chat(
+                model=self.model,
+                messages=[
+                    {'role': 'system', 'content': SUMMARY_INSTRUCTIONS},
+                    {'role': 'user', 'content': f"Existing summary:\n{previous}\n\nNew messages:\n{transcript}"},
+                ],
+                options=dict(self.options, num_predict=self.max_summary_tokens),
+                keep_alive=self.keep_alive,
+            )
+        finally:
+            if ticket is not None:
+                self.scheduler.release(ticket)
+        content = response['message']['content'].strip()
+        if not content:
+            raise ValueError("empty summary")
+        self.summaries.save(user_id, chat_id, {
+            'epoch': version['epoch'],
+            'upto_id': chunk[-1]['id'],
+            'content': content,
+            'tokens': estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS,
+        })
+        with self.lock:
+            self.counters['written'] += 1
+            self.counters['summarized_messages'] += len(chunk)
+            self.counters['last_ms'] = round((time.time() - started) * 1000, 1)
+        print(f"Summarized {len(chunk)} messages of chat {chat_id} (up to #{chunk[-1]['id']})")
+        return len(chunk) < len(pending)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, queued=len(self.queued), stored=self.summaries.count())
@@ -0,0 +1,60 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from checkpoints import CheckpointStore, ResponseAccumulator
+from storage import CachedChatStore, FileChatStore
+
+
+class BlockedStore(FileChatStore):
+    def __init__(self, root_dir):
+        super().__init__(root_dir)
+        self.unblocked = threading.Event()
+
+    def save_messages(self, user_id, chat_id, messages):
+        self.unblocked.wait(5)
+        super().save_messages(user_id, chat_id, messages)
+
+
+def test_partial_reply_survives_a_restart(tmp_path):
+    db_path = str(tmp_path / 'checkpoints.db')
+    store = CheckpointStore(db_path, pool_size=1)
+    accumulator = ResponseAccumulator(
+        lambda content: store.save('g1', 'u', 'c', 3, content), every_tokens=2, every_seconds=3600,
+    )
+    for chunk in ('Once', ' upon', ' a'):
+        accumulator.add(chunk)
+    assert accumulator.checkpoints == 1
+
+    [checkpoint] = CheckpointStore(db_path, pool_size=1).pending()
+    assert (checkpoint['generation_id'], checkpoint['user_id'], checkpoint['chat_id']) == ('g1', 'u', 'c')
+    assert checkpoint['after_id'] == 3
+    assert checkpoint['content'] == 'Once upon'
+
+
+def test_continued_reply_starts_from_the_checkpoint():
+    saved = []
+    accumulator = ResponseAccumulator(saved.append, every_tokens=100, initial='Once upon')
+    accumulator.checkpoint()
+    accumulator.add(' a time')
+    assert saved == ['Once upon']
+    assert accumulator.text() == 'Once upon a time'
+
+
+def test_checkpoint_is_removed_once_the_reply_is_persisted(tmp_path):
+    checkpoints = CheckpointStore(str(tmp_path / 'checkpoints.db'), pool_size=1)
+    checkpoints.save('g1', 'u', 'c', 1, 'partial')
+    backing = BlockedStore(str(tmp_path / 'chats'))
+    backing.create_chat('u', 'c')
+    store = CachedChatStore(backing)
+
+    store.save_messages('u', 'c', [{'role': 'user', 'content': 'hi'}, {'role': 'assistant', 'content': 'partial reply'}])
+    store.after_persisted('u', 'c', lambda: checkpoints.remove('g1'))
+    assert checkpoints.count() == 1
+
+    backing.unblocked.set()
+    store.flush()
+    assert checkpoints.count() == 0
+    assert [msg['content'] for msg in backing.load_messages('u', 'c')] == ['hi', 'partial reply']
@@ -0,0 +1,48 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context import build_context, estimated, message_tokens
+
+
+def turns(count):
+    history = [{'role': 'system', 'content': 'prompt', 'tokens': 10}]
+    for n in range(count):
+        history.append({'role': 'user', 'content': f'question {n}', 'tokens': 20})
+        history.append({'role': 'assistant', 'content': f'answer {n}', 'tokens': 30})
+    history.append({'role': 'user', 'content': 'current', 'tokens': 20})
+    return history
+
+
+def test_keeps_newest_turns_within_budget():
+    history = turns(5)
+    # Prompt and current turn take 30; room for two whole turns after that.
+    context, used, dropped = build_context(history, 140)
+    assert [msg['content'] for msg in context] == ['prompt', 'question 3', 'answer 3', 'question 4', 'answer 4', 'current']
+    assert used == 130
+    assert dropped == 6
+
+
+def test_does_not_open_on_a_reply_without_its_question():
+    history = turns(2)
+    # Room for 'answer 1' but not 'question 1' as well.
+    context, used, dropped = build_context(history, 70)
+    assert [msg['content'] for msg in context] == ['prompt', 'current']
+    assert used == 30
+    assert dropped == 4
+
+
+def test_pinned_messages_are_kept_over_budget():
+    history = turns(1)
+    context, used, dropped = build_context(history, 0)
+    assert [msg['content'] for msg in context] == ['prompt', 'current']
+    assert used == 30
+    assert dropped == 2
+
+
+def test_estimates_are_not_written_back():
+    msg = {'role': 'user', 'content': 'how long is this?'}
+    tokens = message_tokens(msg)
+    assert 'tokens' not in msg
+    assert estimated(msg)['tokens'] == tokens
@@ -0,0 +1,81 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import GenerationScheduler, AdmissionRejected
+
+
+def granted(tickets):
+    return [name for name, ticket in tickets if ticket.granted.is_set()]
+
+
+def test_waiting_users_are_served_round_robin():
+    scheduler = GenerationScheduler(max_concurrent=1, max_queued_per_user=5)
+    running = scheduler.enqueue('a')
+    tickets = [(name, scheduler.enqueue(name.split('.')[0])) for name in ('a.1', 'a.2', 'a.3', 'b.1', 'c.1')]
+
+    order = []
+    current = running
+    for _ in tickets:
+        scheduler.release(current)
+        name, current = next((name, ticket) for name, ticket in tickets if ticket.granted.is_set() and name not in order)
+        order.append(name)
+    assert order == ['a.1', 'b.1', 'c.1', 'a.2', 'a.3']
+
+
+def test_interactive_work_goes_before_batch():
+    scheduler = GenerationScheduler(max_concurrent=1)
+    running = scheduler.enqueue('a')
+    tickets = [('batch', scheduler.enqueue('b', 'batch')), ('interactive', scheduler.enqueue('c'))]
+    scheduler.release(running)
+    assert granted(tickets) == ['interactive']
+
+
+def test_queue_positions_are_reported():
+    scheduler = GenerationScheduler(max_concurrent=1)
+    running = scheduler.enqueue('a')
+    positions = []
+    scheduler.enqueue('b', on_position=lambda position, total: positions.append((position, total)))
+    scheduler.enqueue('c')
+    assert positions == [(1, 1)]
+    scheduler.release(running)
+    assert positions == [(1, 1)]
+    assert scheduler.stats()['waiting'] == {'interactive': 1, 'batch': 0}
+
+
+def test_too_many_waiting_requests_are_rejected():
+    scheduler = GenerationScheduler(max_concurrent=1, max_queued_per_user=2)
+    scheduler.enqueue('a')
+    scheduler.enqueue('a')
+    scheduler.enqueue('a')
+    with pytest.raises(AdmissionRejected):
+        scheduler.enqueue('a')
+    # Others still get in line.
+    scheduler.enqueue('b')
+    assert scheduler.stats()['rejected'] == 1
+
+
+def test_waiting_past_max_wait_is_rejected():
+    scheduler = GenerationScheduler(max_concurrent=1, max_wait=0)
+    scheduler.enqueue('a')
+    ticket = scheduler.enqueue('b')
+    with pytest.raises(AdmissionRejected):
+        scheduler.wait(ticket)
+    assert scheduler.stats()['timed_out'] == 1
+    assert scheduler.stats()['waiting']['interactive'] == 0
+
+
+def test_withdrawn_ticket_frees_its_place():
+    scheduler = GenerationScheduler(max_concurrent=1)
+    running = scheduler.enqueue('a')
+    withdrawn = scheduler.enqueue('b')
+    waiting = scheduler.enqueue('c')
+    scheduler.release(withdrawn)
+    scheduler.release(withdrawn)
+    scheduler.release(running)
+    assert waiting.granted.is_set()
+    assert not withdrawn.granted.is_set()
+    assert scheduler.stats()['active'] == 1
@@ -0,0 +1,92 @@
+import os
+import sys
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import FileChatStore, SqliteChatStore
+
+
+def run_turns(store):
+    # Simulates a later save adding 'tokens' to messages stored without them
+    # (as chats saved before token counts were kept are); that save must
+    # still only append.
+    store.create_chat('u', 'c')
+    history = [{'role': 'user', 'content': 'hi'}, {'role': 'assistant', 'content': 'hello'}]
+    store.save_messages('u', 'c', history)
+    history = store.load_messages('u', 'c')
+    version = store.chat_version('u', 'c')
+    for msg in history:
+        msg.setdefault('tokens', 5)
+    history += [{'role': 'user', 'content': 'again'}, {'role': 'assistant', 'content': 'sure', 'tokens': 6}]
+    store.save_messages('u', 'c', history)
+    assert store.chat_version('u', 'c') == {'epoch': version['epoch'], 'version': 4}
+    return store.load_messages('u', 'c')
+
+
+def test_file_store_appends_after_tokens_are_filled_in(tmp_path):
+    store = FileChatStore(str(tmp_path))
+    messages = run_turns(store)
+    assert [msg['content'] for msg in messages] == ['hi', 'hello', 'again', 'sure']
+    with open(store.chat_filepath('u', 'c'), encoding='utf-8') as f:
+        assert len(f.readlines()) == 4
+
+
+def test_sqlite_store_appends_after_tokens_are_filled_in(tmp_path):
+    store = SqliteChatStore(str(tmp_path / 'chats.db'), pool_size=1)
+    messages = run_turns(store)
+    assert [msg['content'] for msg in messages] == ['hi', 'hello', 'again', 'sure']
+    with store.pool.connection() as conn:
+        assert conn.execute("SELECT MAX(id) FROM messages").fetchone()[0] == 4
+
+
+def test_file_store_archives_and_restores_cold_chats(tmp_path):
+    store = FileChatStore(str(tmp_path))
+    store.create_chat('u', 'c')
+    store.save_messages('u', 'c', [{'role': 'user', 'content': 'hi'}, {'role': 'assistant', 'content': 'hello', 'tokens': 5}])
+    saved = store.load_messages('u', 'c')
+
+    report = store.run_maintenance(archive_after_seconds=-60)
+    assert report['archived'] == 1
+    assert not os.path.exists(store.chat_filepath('u', 'c'))
+    assert store.export_messages('u', 'c') == saved
+    assert not os.path.exists(store.chat_filepath('u', 'c'))
+
+    assert store.load_messages('u', 'c') == saved
+    assert os.path.exists(store.chat_filepath('u', 'c'))
+    store.save_messages('u', 'c', saved + [{'role': 'user', 'content': 'back'}])
+    assert [msg['content'] for msg in store.load_messages('u', 'c')] == ['hi', 'hello', 'back']
+
+    # The restored chat's copy is dropped from the archive on the next pass.
+    store.run_maintenance(archive_after_seconds=3600)
+    with zipfile.ZipFile(store.archive_filepath('u')) as archive:
+        assert archive.namelist() == []
+
+
+def test_file_store_manifest_stays_compact(tmp_path):
+    store = FileChatStore(str(tmp_path), compact_min_dead=10)
+    store.create_chat('u', 'c')
+    history = []
+    for n in range(50):
+        history.append({'role': 'user', 'content': f'message {n}'})
+        store.save_messages('u', 'c', history)
+    with open(store.manifest_filepath('u'), encoding='utf-8') as f:
+        assert len(f.readlines()) <= 2 + 10
+    assert store.message_count('u', 'c') == 50
+
+
+def test_file_store_export_never_rewrites_the_log(tmp_path):
+    store = FileChatStore(str(tmp_path), compact_min_dead=1)
+    store.create_chat('u', 'c')
+    store.save_messages('u', 'c', [{'role': 'user', 'content': 'hi'}])
+    store.save_messages('u', 'c', [{'role': 'user', 'content': 'edited'}])
+    filepath = store.chat_filepath('u', 'c')
+    with open(filepath, 'a', encoding='utf-8') as f:
+        f.write('{"role": "assistant", "cont')
+    with open(filepath, 'rb') as f:
+        before = f.read()
+
+    exported = FileChatStore(str(tmp_path), compact_min_dead=1).export_messages('u', 'c')
+    assert [msg['content'] for msg in exported] == ['edited']
+    with open(filepath, 'rb') as f:
+        assert f.read() == before
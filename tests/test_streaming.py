@@ -0,0 +1,61 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streaming import StreamCoalescer, flush_window_ms
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def coalescer(**kwargs):
+    frames, clock = [], FakeClock()
+    return StreamCoalescer(lambda content, first: frames.append((content, first)), clock=clock, **kwargs), frames, clock
+
+
+def test_first_chunk_goes_out_at_once():
+    stream, frames, _ = coalescer(window_ms=50)
+    stream.add('Hel')
+    assert frames == [('Hel', True)]
+
+
+def test_chunks_within_the_window_share_a_frame():
+    stream, frames, clock = coalescer(window_ms=50)
+    stream.add('a')
+    for text in ('b', 'c', 'd'):
+        clock.now += 0.01
+        stream.add(text)
+    assert frames == [('a', True)]
+    clock.now += 0.02
+    stream.add('e')
+    assert frames == [('a', True), ('bcde', False)]
+
+
+def test_size_limit_flushes_early():
+    stream, frames, _ = coalescer(window_ms=1000, max_bytes=4)
+    stream.add('a')
+    stream.add('bb')
+    stream.add('é')
+    assert frames == [('a', True), ('bbé', False)]
+
+
+def test_flush_sends_the_remainder_once():
+    stream, frames, _ = coalescer(window_ms=50)
+    stream.add('a')
+    stream.add('b')
+    stream.flush()
+    stream.flush()
+    assert frames == [('a', True), ('b', False)]
+    assert (stream.chunks, stream.frames) == (2, 2)
+
+
+def test_window_follows_round_trip_time():
+    assert flush_window_ms(None) == 30
+    assert flush_window_ms('120') == 60
+    assert flush_window_ms(1000) == 150
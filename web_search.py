@@ -0,0 +1,81 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import html2text
+from duckduckgo_search import DDGS
+
+# --- Web Search ---
+# Looks a query up on DuckDuckGo and returns the readable text of the top
+# results, formatted for the prompt. Used by the chat server and batch runs.
+
+def fetch_and_parse(url):
+    try:
+        print(f"Fetching content from: {url}")
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+        }
+        response = requests.get(url, timeout=10, headers=headers)
+        response.raise_for_status()
+
+        content_type = response.headers.get('Content-Type', '')
+        if 'text/html' not in content_type:
+            print(f"Skipping non-HTML content at {url}")
+            return None
+
+        html = response.text
+
+        if len(html) > 2_000_000:
+            html = html[:2_000_000]
+
+        text_maker = html2text.HTML2Text()
+        text_maker.ignore_links = False
+        text_maker.ignore_images = True
+        text_maker.ignore_emphasis = False
+        text_maker.body_width = 0
+
+        text = text_maker.handle(html)
+        text = re.sub(r'\s+', ' ', text).strip()
+
+        return text
+
+    except requests.exceptions.RequestException as e:
+        print(f"Request failed for {url}: {e}")
+        return None
+    except Exception as e:
+        print(f"An unexpected error occurred processing {url}: {e}")
+        return None
+
+def search_the_web(query):
+    print(f"Performing web search for: {query}")
+    try:
+        with DDGS() as ddgs:
+            results = list(ddgs.text(query, max_results=5))
+
+        if not results:
+            return "No search results found."
+
+        urls_to_fetch = [r['href'] for r in results[:3] if 'href' in r]
+        
+        fetched_contents = []
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            fetched_contents = list(executor.map(fetch_and_parse, urls_to_fetch))
+
+        context_parts = []
+        for i, content in enumerate(fetched_contents):
+            if content:
+                result_meta = results[i]
+                context_parts.append(
+                    f"Source [{i+1}]: {result_meta.get('title', 'N/A')}\n"
+                    f"URL: {result_meta.get('href', 'N/A')}\n"
+                    f"CONTENT:\n{content[:2500]}\n"
+                )
+
+        if not context_parts:
+            return "Could not retrieve content from any search results. Please try a different query."
+            
+        return "\n---\n".join(context_parts)
+
+    except Exception as e:
+        print(f"An error occurred in the main search function: {e}")
+        return "Sorry, an error occurred during the web search."